@@ -1,6 +1,6 @@
 import numpy as np
 import os
-from osgeo import gdal, gdalconst
+from osgeo import gdal, gdalconst, gdal_array
 from osgeo.gdalconst import *
 from skimage.segmentation import slic, felzenszwalb, quickshift
 
@@ -28,7 +28,69 @@ def percentStretch(tifArray, lower_percent=0.5, higher_percent=99.5):
     return out
 
 
-def stretch2GeoTiff(imgPath, resultFolder):
+def getBlockSize(itemSize, maxMemory):
+    '''
+    side length of the square blocks whose working set fits in maxMemory megabytes
+    '''
+    # the bands are stretched one by one: the source pixels, float64 temporaries and the unsigned int8 result
+    pixelBytes = itemSize + 4 * 8 + 1
+    return max(1, int(np.sqrt(maxMemory * 1024.0 * 1024.0 / pixelBytes)))
+
+
+def iterBlocks(cols, rows, blockSize):
+    for yoff in range(0, rows, blockSize):
+        for xoff in range(0, cols, blockSize):
+            yield xoff, yoff, min(blockSize, cols - xoff), min(blockSize, rows - yoff)
+
+
+def histogramPercentile(hist, values, percent):
+    '''
+    percentile from a histogram, same interpolation as np.percentile
+    :param values: the value of every histogram bin
+    '''
+    cumsum = np.cumsum(hist)
+    rank = percent / 100.0 * (cumsum[-1] - 1)
+    lower = int(np.floor(rank))
+    upper = int(np.ceil(rank))
+    lowerValue = values[np.searchsorted(cumsum, lower, side='right')]
+    upperValue = values[np.searchsorted(cumsum, upper, side='right')]
+    return lowerValue + (rank - lower) * (upperValue - lowerValue)
+
+
+def bandPercentiles(band, blockSize, lower_percent=0.5, higher_percent=99.5, bins=65536):
+    '''
+    percentiles of a band from a histogram accumulated over block reads.
+    8 and 16 bit integers are counted exactly, other types in bins between the band minimum and maximum
+    '''
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    cols = band.XSize
+    rows = band.YSize
+    if np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2:
+        offset = int(np.iinfo(dtype).min)
+        size = int(np.iinfo(dtype).max) - offset + 1
+        hist = np.zeros(size, dtype=np.int64)
+        for xoff, yoff, xsize, ysize in iterBlocks(cols, rows, blockSize):
+            data = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            hist += np.bincount((data.astype(np.int32) - offset).ravel(), minlength=size)
+        values = np.arange(size, dtype=float) + offset
+    else:
+        minValue, maxValue = band.ComputeRasterMinMax(False)
+        edges = np.linspace(minValue, maxValue, bins + 1)
+        hist = np.zeros(bins, dtype=np.int64)
+        for xoff, yoff, xsize, ysize in iterBlocks(cols, rows, blockSize):
+            data = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            hist += np.histogram(data, bins=edges)[0]
+        values = (edges[:-1] + edges[1:]) / 2
+    return (histogramPercentile(hist, values, lower_percent),
+            histogramPercentile(hist, values, higher_percent))
+
+
+def stretch2GeoTiff(imgPath, resultFolder, maxMemory=1024, lower_percent=0.5, higher_percent=99.5):
+    '''
+    Percentage Truncation stretch of the whole image in two passes over blocks,
+    the first pass builds the histogram of every band, the second stretches and writes block by block
+    :param maxMemory: approximate peak memory in megabytes, independent of the image size
+    '''
     driver = gdal.GetDriverByName('GTiff')
     driver.Register()
     ds = gdal.Open(imgPath, GA_ReadOnly)
@@ -37,22 +99,32 @@ def stretch2GeoTiff(imgPath, resultFolder):
     rows = ds.RasterYSize
     geoTransform = ds.GetGeoTransform()
     proj = ds.GetProjection()
-    data = np.empty([rows, cols, bands], dtype=float)
+    itemSize = gdal.GetDataTypeSize(ds.GetRasterBand(1).DataType) // 8
+    blockSize = getBlockSize(itemSize, maxMemory)
+    # first pass
+    cutPoints = []
     for i in range(bands):
-        band = ds.GetRasterBand(i + 1)
-        data1 = band.ReadAsArray()
-        data[:, :, i] = data1
-    stretch = percentStretch(data)
+        cutPoints.append(bandPercentiles(ds.GetRasterBand(i + 1), blockSize, lower_percent, higher_percent))
+    # second pass
     imgName = os.path.basename(imgPath)
     resultPath = os.path.join(resultFolder, imgName)
     driver = ds.GetDriver()
     outDataset = driver.Create(resultPath, cols, rows, bands, GDT_Byte)
     outDataset.SetGeoTransform(geoTransform)
     outDataset.SetProjection(proj)
+    for xoff, yoff, xsize, ysize in iterBlocks(cols, rows, blockSize):
+        for i in range(bands):
+            a = 0
+            b = 255
+            c, d = cutPoints[i]
+            data = ds.GetRasterBand(i + 1).ReadAsArray(xoff, yoff, xsize, ysize).astype(float)
+            t = a + (data - c) * (b - a) / (d - c)
+            t[t < a] = a
+            t[t > b] = b
+            outDataset.GetRasterBand(i + 1).WriteArray(t.astype(np.uint8), xoff, yoff)
     for i in range(bands):
-        outBand = outDataset.GetRasterBand(i + 1)
-        outBand.WriteArray(stretch[:, :, i], 0, 0)
-        outBand.FlushCache()
+        outDataset.GetRasterBand(i + 1).FlushCache()
+    outDataset = None
     return resultPath
 
 
@@ -76,8 +148,8 @@ def getDataType(imgPath):
     driver = gdal.GetDriverByName('GTiff')
     driver.Register()
     ds = gdal.Open(imgPath, GA_ReadOnly)
-    da = ds.ReadAsArray()
-    return da.dtype.name
+    dataType = ds.GetRasterBand(1).DataType
+    return np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(dataType)).name
 
 
 def getRGB(data, rgb_list):
@@ -54,6 +54,8 @@ def parse_args():
 
     parser.add_argument('--output-dir', type=str, help='output dir path', default='')
     parser.add_argument('--output-name', type=str, default='segment_slic')
+    parser.add_argument('--max-memory', type=int, default=1024,
+                        help='approximate memory in MB used to stretch the image, independent of the image size')
 
     # parameters for sam (Segment Anything Model)  ---optional
     parser.add_argument('--model-type', type=str, default='vit_h')
@@ -77,7 +79,7 @@ def autodraw(args):
 
     # stretch
     if getDataType(imgPath) != 'uint8':
-        imgPath = stretch2GeoTiff(args.input_image, tempDir)
+        imgPath = stretch2GeoTiff(args.input_image, tempDir, args.max_memory)
 
     # block size
     cutW, cutH  = 512, 512
@@ -10,9 +10,13 @@ import os
 import sys
 import shutil
 import argparse
-from RS_Libs.Polygons import split_large_targets, extentToPolygon
+from RS_Libs.Containers import makeShards, makeArrayStore
+from RS_Libs.Polygons import split_large_targets, extentToPolygon, makePolygon
 from RS_Libs.Rasters import get_raster_info, generateImg
+from RS_Libs.Tiles import TileReader, generateTile, getImageCutPoints
 from RS_Libs.Utils import checkInput, checkInputOutput, copyFeatures
+from RS_Libs.Statistics import ClassCounts, makeBandMoments, writeStatistics
+from RS_Libs.Writers import AsyncWriter
 from tqdm import tqdm
 
 reload(sys)
@@ -51,6 +55,42 @@ def parse_args():
     parser.add_argument('--stretch-parameters', type=str, default=None, required=False,
                         help='stretch parameters used for Percentage Truncation or Standard Deviation')
 
+    parser.add_argument('--stretch-statistics', type=str, default='tile', choices=['tile', 'scene'],
+                        required=False,
+                        help='tile, stretch every tile with its own statistics; '
+                             'scene, compute the statistics once for the whole image (requires GDAL)')
+
+    parser.add_argument('--writer-threads', type=int, default=0, required=False,
+                        help='number of threads encoding and writing tiles, labels and metadata in the background, '
+                             '0 writes synchronously. the arcpy tile engine still clips on the main thread')
+
+    parser.add_argument('--write-aux', type=bool, default=False, required=False,
+                        help='also write the spatial reference of every tile to a .aux.xml file')
+
+    parser.add_argument('--band-statistics', type=str, default='none', choices=['none', 'moments', 'histogram'],
+                        required=False,
+                        help='none, no band statistics; moments, write the mean and std of every band of the output '
+                             'tiles to band_statistics.json; histogram, also count the values of every band. '
+                             'TIFF tiles of the arcpy tile engine are read once more for it')
+
+    parser.add_argument('--output-container', type=str, default='folder', choices=['folder', 'tar'],
+                        required=False,
+                        help='folder, write the files of every sample into the output folders; '
+                             'tar, stream the samples into size bounded tar shards in the shards folder')
+
+    parser.add_argument('--shard-size', type=int, default=1024, required=False,
+                        help='maximum size in MB of a tar shard')
+
+    parser.add_argument('--array-store', type=str, default='none', choices=['none', 'hdf5', 'zarr'], required=False,
+                        help='also write the tiles into a chunked array store in the output folder, '
+                             'samples.h5 (requires h5py) or samples.zarr (requires zarr), '
+                             'an existing store is appended to')
+
+    parser.add_argument('--tile-engine', type=str, default='arcpy', choices=['arcpy', 'gdal'],
+                        required=False,
+                        help='arcpy, clip every tile with Clip_management; '
+                             'gdal, read every tile as a window of the source image in memory')
+
     args = parser.parse_args()
 
     return args
@@ -74,18 +114,31 @@ def classification(inputShp, inputTif, args):
     processingFeatures = copyFeatures(inputShp, resultFolder, create_temp_id=True)
 
     '-------------step1: Split large targets-------------------'
-    boxInfoList = split_large_targets(processingFeatures, tempWorkSpace, img_meta_info, args)
+    boxTable = split_large_targets(processingFeatures, tempWorkSpace, img_meta_info, args)
 
     arcpy.Delete_management(processingFeatures)
 
     '-------------step2: Generate training images -------------'
     count_dict = {}
-    for boxInfo in boxInfoList:
-        if not boxInfo.label in count_dict.keys():
-            count_dict[str(boxInfo.label)] = 0
-    for object in tqdm(boxInfoList, desc='Processing step2'):
-        imgExtent = object.extent
-        label = object.label
+    for label in boxTable.labels:
+        count_dict[str(label)] = 0
+    reader = None
+    if args.tile_engine == 'gdal':
+        reader = TileReader(inputTif, bands_order)
+    writer = None
+    if args.writer_threads > 0:
+        writer = AsyncWriter(args.writer_threads)
+    cut_points = None
+    if args.stretch_statistics == 'scene':
+        cut_points = getImageCutPoints(inputTif, bands_order, args.stretch_method, args.stretch_parameters)
+    statistics = ClassCounts()
+    bandStatistics = makeBandMoments(args.band_statistics)
+    shards = makeShards(args, resultFolder)
+    store = makeArrayStore(args, resultFolder, inputTif)
+    for i in tqdm(range(len(boxTable)), desc='Processing step2'):
+        xmin, ymin, xmax, ymax = boxTable.bounds(i)
+        imgExtent = makePolygon(xmin, xmax, ymin, ymax, img_meta_info['spatial_reference']).extent
+        label = boxTable.label(i)
         imageDir = os.path.join(resultFolder, str(label))
         if not os.path.exists(imageDir):
             os.makedirs(imageDir)
@@ -94,13 +147,44 @@ def classification(inputShp, inputTif, args):
         band_split = False
         if len(bands_order) > 0:
             band_split = True
-        status, _ = generateImg(count_dict[str(label)], inputTif, extentToPolygon(imgExtent), imageDir,
-                                splitBands=band_split, bandsOrder=bands_order, resampling_type=args.resampling_type,
-                                tile_size=int(args.tile_size), output_img_format=args.output_img_format,
-                                stretch_method=args.stretch_method, stretch_parameters=args.stretch_parameters)
+        if reader is not None:
+            status, _ = generateTile(count_dict[str(label)], reader, imgExtent, imageDir,
+                                     resampling_type=args.resampling_type,
+                                     tile_size=int(args.tile_size), output_img_format=args.output_img_format,
+                                     stretch_method=args.stretch_method, stretch_parameters=args.stretch_parameters,
+                                     cut_points=cut_points, writer=writer,
+                                     write_aux=args.write_aux, band_statistics=bandStatistics,
+                                     array_store=store)
+        else:
+            status, _ = generateImg(count_dict[str(label)], inputTif, extentToPolygon(imgExtent), imageDir,
+                                    splitBands=band_split, bandsOrder=bands_order, resampling_type=args.resampling_type,
+                                    tile_size=int(args.tile_size), output_img_format=args.output_img_format,
+                                    stretch_method=args.stretch_method, stretch_parameters=args.stretch_parameters,
+                                    cut_points=cut_points, writer=writer,
+                                    write_aux=args.write_aux, band_statistics=bandStatistics,
+                                    array_store=store)
         if not status:
             continue
+        if shards is not None:
+            # the chips of every class are numbered from 0, so the key is the number of the chip in the dataset
+            name = str(count_dict[str(label)]).zfill(6)
+            shards.addSample(str(statistics.samples).zfill(6), [(imageDir, name, 'image')],
+                             {'cls': u'{}'.format(label).encode('utf-8')}, writer)
+        if store is not None:
+            store.append(statistics.samples, className=label)
         count_dict[str(label)] += 1
+        statistics.add([label])
+    if reader is not None:
+        reader.close()
+    if writer is not None:
+        writer.close()
+    if shards is not None:
+        shards.close()
+    if store is not None:
+        store.close()
+    writeStatistics(os.path.join(resultFolder, 'statistics.json'), statistics.summary('classification'))
+    if bandStatistics is not None:
+        writeStatistics(os.path.join(resultFolder, 'band_statistics.json'), bandStatistics.summary())
     arcpy.Delete_management("in_memory")
     arcpy.ResetEnvironments()
     shutil.rmtree(tempWorkSpace)
@@ -8,18 +8,32 @@ import os
 import sys
 import shutil
 
-from RS_Libs.Labels import writeYoloClass, writeVOCXML, writeYoloTxt, writeKittiTxt
-from RS_Libs.Polygons import split_larget_objects, get_objects_info, extentToPolygon
+from RS_Libs.Containers import makeShards, makeArrayStore
+from RS_Libs.Labels import writeYoloClass, writeVOCXML, writeYoloTxt, writeKittiTxt, CocoAnnotations
+from RS_Libs.Polygons import split_larget_objects, get_objects_info, extentToPolygon, makePolygon
+from RS_Libs.Georeference import worldFileExtension
 from RS_Libs.Rasters import get_raster_info, GeoTransform, generateImg
+from RS_Libs.Tiles import TileReader, generateTile, getImageCutPoints
 from tqdm import tqdm
 import argparse
 import cv2
+import numpy as np
 
-from RS_Libs.Utils import checkInput, copyFeatures, checkInputOutput
+from RS_Libs.Utils import checkInput, copyFeatures, checkInputOutput, linkFile
+from RS_Libs.Statistics import ClassCounts, makeBandMoments, writeStatistics
+from RS_Libs.Writers import AsyncWriter, submitWrite
 
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
+# folder, image folder and label folder of every meta format
+META_FOLDERS = {'PASCAL VOC': ('PASCAL VOC', 'JPEGImages', 'Annotations'),
+                'YOLO': ('YOLO', 'images', 'labels'),
+                'KITTI': ('KITTI', 'images', 'labels'),
+                'COCO': ('COCO', 'images', 'annotations')}
+# member role of the label files of a format in the tar shards, when several formats are written
+META_ROLES = {'PASCAL VOC': 'voc', 'YOLO': 'yolo', 'KITTI': 'kitti'}
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Making Remote Sensing Samples for Object Detection")
@@ -36,8 +50,8 @@ def parse_args():
     parser.add_argument('--output-path', type=str, default='', help='output folder')
 
     parser.add_argument('--meta-format', type=str, default='PASCAL VOC',
-                        choices=['PASCAL VOC', 'YOLO', 'KITTI'],
-                        help='the output sample foramt')
+                        help='the output sample foramt, PASCAL VOC, YOLO, KITTI or COCO, '
+                             'several formats are split with comma, eg. PASCAL VOC,YOLO')
 
     parser.add_argument('--output-img-format', type=str, default='TIFF',
                         choices=['TIFF', 'JPEG', 'PNG'],
@@ -47,6 +61,15 @@ def parse_args():
     parser.add_argument('--overlap-size', type=int, default=16, metavar='N',
                         help='tile overlap size', required=False)
 
+    parser.add_argument('--tile-placement', type=str, default='object', choices=['object', 'cover'],
+                        required=False,
+                        help='object, one tile centred on every object; '
+                             'cover, a small set of tiles which together show every object')
+
+    parser.add_argument('--min-visibility', type=float, default=1.0, required=False,
+                        help='fraction of an object area a tile must show to cover it, '
+                             'used by the cover tile placement')
+
     parser.add_argument('--band-list', type=str, default='3,2,1',
                         help='output bands list, split with comma, eg."3,2,1"', required=False)
 
@@ -60,11 +83,71 @@ def parse_args():
     parser.add_argument('--vision', type=bool, default=True, required=False,
                         help='draws rectangular boxes on images for visualization')
 
+    parser.add_argument('--stretch-statistics', type=str, default='tile', choices=['tile', 'scene'],
+                        required=False,
+                        help='tile, stretch every tile with its own statistics; '
+                             'scene, compute the statistics once for the whole image (requires GDAL)')
+
+    parser.add_argument('--writer-threads', type=int, default=0, required=False,
+                        help='number of threads encoding and writing tiles, labels and metadata in the background, '
+                             '0 writes synchronously. the arcpy tile engine still clips on the main thread')
+
+    parser.add_argument('--write-aux', type=bool, default=False, required=False,
+                        help='also write the spatial reference of every tile to a .aux.xml file')
+
+    parser.add_argument('--band-statistics', type=str, default='none', choices=['none', 'moments', 'histogram'],
+                        required=False,
+                        help='none, no band statistics; moments, write the mean and std of every band of the output '
+                             'tiles to band_statistics.json; histogram, also count the values of every band. '
+                             'TIFF tiles of the arcpy tile engine are read once more for it')
+
+    parser.add_argument('--output-container', type=str, default='folder', choices=['folder', 'tar'],
+                        required=False,
+                        help='folder, write the files of every sample into the output folders; '
+                             'tar, stream the samples into size bounded tar shards in the shards folder')
+
+    parser.add_argument('--shard-size', type=int, default=1024, required=False,
+                        help='maximum size in MB of a tar shard')
+
+    parser.add_argument('--array-store', type=str, default='none', choices=['none', 'hdf5', 'zarr'], required=False,
+                        help='also write the tiles into a chunked array store in the output folder, '
+                             'samples.h5 (requires h5py) or samples.zarr (requires zarr), '
+                             'an existing store is appended to')
+
+    parser.add_argument('--tile-engine', type=str, default='arcpy', choices=['arcpy', 'gdal'],
+                        required=False,
+                        help='arcpy, clip every tile with Clip_management; '
+                             'gdal, read every tile as a window of the source image in memory')
+
     args = parser.parse_args()
 
     return args
 
 
+def parse_meta_formats(metaFormat):
+    '''
+    :param metaFormat: one or more meta formats split with comma, eg. PASCAL VOC,YOLO
+    :return: list of the formats, the first one is the format the images are generated for
+    '''
+    metaFormats = []
+    for format in metaFormat.split(','):
+        format = format.strip()
+        if format not in META_FOLDERS:
+            raise Exception('unknown meta format {}, choose from PASCAL VOC, YOLO, KITTI and COCO'.format(format))
+        if format not in metaFormats:
+            metaFormats.append(format)
+    return metaFormats
+
+
+def link_image(imageFiles, desDir):
+    '''
+    link the image and its sidecar files into the image folder of another format
+    '''
+    for srcFile in imageFiles:
+        if os.path.exists(srcFile):
+            linkFile(srcFile, os.path.join(desDir, os.path.basename(srcFile)))
+
+
 def detection(inputShp, inputTif, tag=0):
 
     arcpy.AddMessage('Creating images and labels for {}'.format(inputTif))
@@ -87,42 +170,89 @@ def detection(inputShp, inputTif, tag=0):
     processingFeatures = copyFeatures(inputShp, resultFolder, create_temp_id=True)
 
     '-------------step1: Split large objects-------------------'
-    boxInfoList = split_larget_objects(processingFeatures, tempWorkSpace, img_meta_info, args)
+    boxTable = split_larget_objects(processingFeatures, tempWorkSpace, img_meta_info, args)
 
     # get labels for Yolo
-    if args.meta_format == 'YOLO':
-        labelList = writeYoloClass(boxInfoList, classNameTxt)
+    if 'YOLO' in metaFormats:
+        labelList = writeYoloClass(boxTable, classNameTxt)
+    # the annotations of all tiles go into one json file
+    if 'COCO' in metaFormats:
+        coco = CocoAnnotations(boxTable.labels)
 
     '------------step2: get objects info----------------------'
-    objectList = get_objects_info(boxInfoList, img_meta_info, geo_transform, args)
+    objectList = get_objects_info(boxTable, img_meta_info, geo_transform, args)
     arcpy.Delete_management(processingFeatures)
 
     '-------------step3: generate samples-------------------------'
     arcpy.env.workspace = imageDir
+    reader = None
+    if args.tile_engine == 'gdal':
+        reader = TileReader(inputTif, bands_order)
+    writer = None
+    if args.writer_threads > 0:
+        writer = AsyncWriter(args.writer_threads)
+    cut_points = None
+    if args.stretch_statistics == 'scene':
+        cut_points = getImageCutPoints(inputTif, bands_order, args.stretch_method, args.stretch_parameters)
+    statistics = ClassCounts()
+    bandStatistics = makeBandMoments(args.band_statistics)
+    shards = makeShards(args, resultFolder)
+    store = makeArrayStore(args, resultFolder, inputTif)
     for object in tqdm(objectList, desc='Processing step3'):
-        imgExtent = object[0]
-        boxes = object[1]
+        bounds, boxes = object.getObject()
+        imgExtent = makePolygon(bounds[0], bounds[2], bounds[1], bounds[3],
+                                img_meta_info['spatial_reference']).extent
         if not img_meta_info['extent'].contains(imgExtent):
             continue
         band_split = False
         if len(bands_order) > 0:
             band_split = True
-        status, ouputImg = generateImg(tag, inputTif, extentToPolygon(imgExtent), imageDir,
-                                splitBands=band_split, bandsOrder=bands_order,
-                                output_img_format=args.output_img_format,
-                                stretch_method=args.stretch_method,
-                                stretch_parameters=args.stretch_parameters)
+        if reader is not None:
+            status, ouputImg = generateTile(tag, reader, imgExtent, imageDir,
+                                            output_img_format=args.output_img_format,
+                                            stretch_method=args.stretch_method,
+                                            stretch_parameters=args.stretch_parameters,
+                                            cut_points=cut_points, writer=writer,
+                                            write_aux=args.write_aux, band_statistics=bandStatistics,
+                                            array_store=store)
+        else:
+            status, ouputImg = generateImg(tag, inputTif, extentToPolygon(imgExtent), imageDir,
+                                    splitBands=band_split, bandsOrder=bands_order,
+                                    output_img_format=args.output_img_format,
+                                    stretch_method=args.stretch_method,
+                                    stretch_parameters=args.stretch_parameters,
+                                    cut_points=cut_points, writer=writer,
+                                    write_aux=args.write_aux, band_statistics=bandStatistics,
+                                    array_store=store)
         if not status:
             continue
-        if args.meta_format == 'PASCAL VOC':
-            xmlPath = os.path.join(labelDir, str(tag).zfill(6) + '.xml')
-            writeVOCXML(xmlPath, inputTif, ouputImg, boxes)
-        elif args.meta_format == 'YOLO':
-            txtPath = os.path.join(labelDir, str(tag).zfill(6) + '.txt')
-            writeYoloTxt(txtPath, boxes, int(args.tile_size), labelList)
-        else:
-            txtPath = os.path.join(labelDir, str(tag).zfill(6) + '.txt')
-            writeKittiTxt(txtPath, boxes)
+        if store is not None:
+            store.append(tag)
+        sides = boxes.pixels[:, 2:] - boxes.pixels[:, :2]
+        statistics.add(boxes.labels, np.sqrt(sides[:, 0] * sides[:, 1]))
+        name = str(tag).zfill(6)
+        # the image is generated once, the other formats link to it
+        imageFiles = [ouputImg, os.path.splitext(ouputImg)[0] + worldFileExtension(ouputImg)]
+        if args.write_aux:
+            imageFiles.append(ouputImg + '.aux.xml')
+        for format in metaFormats:
+            formatImageDir, formatLabelDir = formatDirs[format]
+            if formatImageDir != imageDir and shards is None:
+                submitWrite(writer, os.path.join(formatImageDir, os.path.basename(ouputImg)), link_image,
+                            imageFiles, formatImageDir, depends=imageFiles[:2])
+            if format == 'PASCAL VOC':
+                xmlPath = os.path.join(formatLabelDir, name + '.xml')
+                # the image size is read from the image, so it is written first
+                submitWrite(writer, xmlPath, writeVOCXML, xmlPath, inputTif, ouputImg, boxes, depends=[ouputImg])
+            elif format == 'YOLO':
+                txtPath = os.path.join(formatLabelDir, name + '.txt')
+                submitWrite(writer, txtPath, writeYoloTxt, txtPath, boxes, int(args.tile_size), labelList)
+            elif format == 'COCO':
+                # the boxes are in pixels of a tile_size tile, as for YOLO
+                coco.add(os.path.basename(ouputImg), int(args.tile_size), int(args.tile_size), boxes)
+            else:
+                txtPath = os.path.join(formatLabelDir, name + '.txt')
+                submitWrite(writer, txtPath, writeKittiTxt, txtPath, boxes)
 
         if args.vision and img_meta_info['band_count'] > 3 and not band_split:
             raise Exception('If you want to visualize the annotations and samples, '
@@ -133,75 +263,101 @@ def detection(inputShp, inputTif, tag=0):
             if not os.path.exists(visionDir):
                 os.makedirs(visionDir)
 
-            if args.output_img_format == 'TIFF':
+            if args.output_img_format == 'TIFF' and reader is not None:
+                status, ouputImg = generateTile(tag, reader, imgExtent, visionDir,
+                                                output_img_format='JPEG',
+                                                stretch_method=args.stretch_method,
+                                                stretch_parameters=args.stretch_parameters,
+                                                cut_points=cut_points, writer=writer,
+                                                write_aux=False)
+            elif args.output_img_format == 'TIFF':
                 status, ouputImg = status, ouputImg = generateImg(tag, inputTif,
                                 extentToPolygon(imgExtent), visionDir,
                                 splitBands=band_split, bandsOrder=bands_order,
                                 output_img_format='JPEG',
                                 stretch_method=args.stretch_method,
-                                stretch_parameters=args.stretch_parameters)
-            img = cv2.imread(ouputImg)
-            for object in boxes:
-                upleft_x = int(object[0])
-                upleft_y = int(object[1])
-                lowright_x = int(object[2])
-                lowright_y = int(object[3])
-                label = object[4]
-                truncated = object[5]
-                cv2.rectangle(img, (upleft_x, upleft_y), (lowright_x, lowright_y), (0, 255, 0), 2)
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                cv2.putText(img, str(label), (int((upleft_x + lowright_x) / 2),
-                                              int((upleft_y + lowright_y) / 2)), font,
-                            0.5, (200, 255, 255), 1)
-            cv2.imwrite(os.path.join(visionDir, str(tag).zfill(6) + '.jpg'), img)
-            if os.path.exists(os.path.join(visionDir, str(tag).zfill(6) + '.jgw')):
-                os.remove(os.path.join(visionDir, str(tag).zfill(6) + '.jgw'))
+                                stretch_parameters=args.stretch_parameters,
+                                cut_points=cut_points, writer=writer,
+                                write_aux=False)
+            visionImg = os.path.join(visionDir, str(tag).zfill(6) + '.jpg')
+            visionGeo = os.path.join(visionDir, str(tag).zfill(6) + '.jgw')
+            submitWrite(writer, visionImg, draw_vision, ouputImg, boxes, visionImg,
+                        depends=[ouputImg, visionGeo])
+        if shards is not None:
+            if args.vision and writer is not None:
+                # the visualization reads the image before it is moved into the shard
+                writer.wait(visionImg)
+            sources = [(imageDir, name, 'image')]
+            for format in metaFormats:
+                if format in META_ROLES:
+                    role = META_ROLES[format] if len(metaFormats) > 1 else 'label'
+                    sources.append((formatDirs[format][1], name, role))
+            shards.addSample(name, sources, writer=writer)
         tag += 1
+    if reader is not None:
+        reader.close()
+    if writer is not None:
+        writer.close()
+    if shards is not None:
+        shards.close()
+    if store is not None:
+        store.close()
+    if 'COCO' in metaFormats:
+        coco.write(os.path.join(formatDirs['COCO'][1], 'instances.json'), inputTif)
+    writeStatistics(os.path.join(resultFolder, 'statistics.json'), statistics.summary('object detection'))
+    if bandStatistics is not None:
+        writeStatistics(os.path.join(resultFolder, 'band_statistics.json'), bandStatistics.summary())
     arcpy.Delete_management("in_memory")
     arcpy.ResetEnvironments()
     shutil.rmtree(tempWorkSpace)
     return tag
 
 
+def draw_vision(imgPath, boxes, visionImg):
+    '''
+    draw the boxes on the image for visualization
+    '''
+    img = cv2.imread(imgPath)
+    for object in boxes:
+        upleft_x = int(object[0])
+        upleft_y = int(object[1])
+        lowright_x = int(object[2])
+        lowright_y = int(object[3])
+        label = object[4]
+        truncated = object[5]
+        cv2.rectangle(img, (upleft_x, upleft_y), (lowright_x, lowright_y), (0, 255, 0), 2)
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        cv2.putText(img, str(label), (int((upleft_x + lowright_x) / 2),
+                                      int((upleft_y + lowright_y) / 2)), font,
+                    0.5, (200, 255, 255), 1)
+    cv2.imwrite(visionImg, img)
+    visionGeo = os.path.splitext(visionImg)[0] + '.jgw'
+    if os.path.exists(visionGeo):
+        os.remove(visionGeo)
+
+
 if __name__ == "__main__":
     args = parse_args()
     inputShp = args.input_shpfile
     inputTif = args.input_image
     resultFolder = args.output_path
     checkInputOutput(inputShp, resultFolder)
-    # output images and labels path
-    if args.meta_format == 'PASCAL VOC':
-        vocDir = os.path.join(resultFolder, 'PASCAL VOC')
-        if not os.path.exists(vocDir):
-            os.mkdir(vocDir)
-        imageDir = os.path.join(vocDir, 'JPEGImages')
-        if not os.path.exists(imageDir):
-            os.mkdir(imageDir)
-        labelDir = os.path.join(vocDir, 'Annotations')
-        if not os.path.exists(labelDir):
-            os.mkdir(labelDir)
-    elif args.meta_format == 'YOLO':
-        yoloDir = os.path.join(resultFolder, 'YOLO')
-        if not os.path.exists(yoloDir):
-            os.mkdir(yoloDir)
-        imageDir = os.path.join(yoloDir, 'images')
-        if not os.path.exists(imageDir):
-            os.mkdir(imageDir)
-        labelDir = os.path.join(yoloDir, 'labels')
-        if not os.path.exists(labelDir):
-            os.mkdir(labelDir)
+    # output images and labels path of every format, the images are generated in the folder of the first one
+    metaFormats = parse_meta_formats(args.meta_format)
+    formatDirs = {}
+    for format in metaFormats:
+        formatDir, imageFolder, labelFolder = META_FOLDERS[format]
+        formatDir = os.path.join(resultFolder, formatDir)
+        if not os.path.exists(formatDir):
+            os.mkdir(formatDir)
+        formatDirs[format] = (os.path.join(formatDir, imageFolder), os.path.join(formatDir, labelFolder))
+        for folder in formatDirs[format]:
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+    imageDir, labelDir = formatDirs[metaFormats[0]]
+    if 'YOLO' in metaFormats:
         classNameTxt = os.path.join(resultFolder, 'class_names.txt')
         if os.path.exists(classNameTxt):
             os.remove(classNameTxt)
-    else:
-        kittiDir = os.path.join(resultFolder, 'KITTI')
-        if not os.path.exists(kittiDir):
-            os.mkdir(kittiDir)
-        imageDir = os.path.join(kittiDir, 'images')
-        if not os.path.exists(imageDir):
-            os.mkdir(imageDir)
-        labelDir = os.path.join(kittiDir, 'labels')
-        if not os.path.exists(labelDir):
-            os.mkdir(labelDir)
 
     detection(inputShp, inputTif)
@@ -0,0 +1,248 @@
+# coding=utf-8
+'''
+output containers besides the plain folders. WebDataset style tar shards, the files of every sample are streamed
+into them and removed, and chunked array stores (HDF5 or Zarr) of fixed size tiles for random access
+'''
+import io
+import json
+import os
+import tarfile
+import time
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+# the files a sample may have in the image and label folders, eg. 000012.jpg, 000012.jgw, 000012.jpg.aux.xml
+SAMPLE_EXTENSIONS = ['jpg', 'png', 'tif', 'jgw', 'pgw', 'tfw', 'xml', 'txt',
+                     'jpg.aux.xml', 'png.aux.xml', 'tif.aux.xml']
+
+
+def sampleFiles(folder, name, role):
+    '''
+    the files of a sample in a folder, found by name without listing the folder
+    :param role: kind of the files, eg. image or label, it keeps 000012.png of the image and the label apart
+    :return: list of (path, member extension)
+    '''
+    files = []
+    for extension in SAMPLE_EXTENSIONS:
+        path = os.path.join(folder, name + '.' + extension)
+        if os.path.exists(path):
+            files.append((path, role + '.' + extension))
+    return files
+
+
+class TarShards():
+    '''
+    tar shards named prefix-000000.tar, prefix-000001.tar ... a shard is closed before it would pass maxSize.
+    the members of a sample are key.role.extension, eg. 000012.image.jpg and 000012.label.png,
+    index.json lists the keys of every shard
+    '''
+    def __init__(self, folder, prefix='samples', maxSize=1 << 30):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.prefix = prefix
+        self.maxSize = maxSize
+        self.tar = None
+        self.shards = []
+
+    def nextShard(self):
+        if self.tar is not None:
+            self.tar.close()
+        name = '{}-{}.tar'.format(self.prefix, str(len(self.shards)).zfill(6))
+        self.tar = tarfile.open(os.path.join(self.folder, name), 'w')
+        self.shards.append({'name': name, 'size': 0, 'keys': []})
+
+    def addSample(self, key, sources, data=None, writer=None):
+        '''
+        append the files of a sample to the current shard and remove them
+        :param sources: list of (folder, name, role), the files of name in folder, see sampleFiles
+        :param data: optional dict of member extension to bytes, eg. {'cls': b'water'}
+        :param writer: optional Writers.AsyncWriter, the queued writes of every file the sample may have
+                       are waited for before the files are listed
+        '''
+        if writer is not None:
+            for folder, name, _ in sources:
+                for extension in SAMPLE_EXTENSIONS:
+                    writer.wait(os.path.join(folder, name + '.' + extension))
+            writer.raiseError()
+        files = []
+        for folder, name, role in sources:
+            files += sampleFiles(folder, name, role)
+        data = data or {}
+        # every member takes a 512 bytes header and is padded to 512 bytes
+        size = sum([os.path.getsize(path) for path, _ in files] + [len(value) for value in data.values()])
+        size += 1024 * (len(files) + len(data))
+        if self.tar is None or (len(self.shards[-1]['keys']) > 0 and self.shards[-1]['size'] + size > self.maxSize):
+            self.nextShard()
+        for path, extension in files:
+            self.tar.add(path, arcname=key + '.' + extension)
+            os.remove(path)
+        for extension, value in sorted(data.items()):
+            info = tarfile.TarInfo(key + '.' + extension)
+            info.size = len(value)
+            info.mtime = time.time()
+            self.tar.addfile(info, io.BytesIO(value))
+        self.shards[-1]['size'] += size
+        self.shards[-1]['keys'].append(key)
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        index = {'shards': [{'name': shard['name'], 'samples': len(shard['keys']), 'size': shard['size'],
+                             'keys': shard['keys']} for shard in self.shards]}
+        with open(os.path.join(self.folder, 'index.json'), 'w') as f:
+            json.dump(index, f, indent=2)
+
+
+def makeShards(args, resultFolder):
+    '''
+    TarShards in resultFolder/shards for --output-container tar, None for plain folders
+    '''
+    if args.output_container != 'tar':
+        return None
+    return TarShards(os.path.join(resultFolder, 'shards'), maxSize=int(args.shard_size) * 1024 * 1024)
+
+
+def fitTile(tileArray, tileSize):
+    '''
+    crop or pad with 0 the last two axes to tileSize, a window may be a pixel off the tile size
+    '''
+    out = np.zeros(tileArray.shape[:-2] + (tileSize, tileSize), dtype=tileArray.dtype)
+    rows = min(tileSize, tileArray.shape[-2])
+    cols = min(tileSize, tileArray.shape[-1])
+    out[..., :rows, :cols] = tileArray[..., :rows, :cols]
+    return out
+
+
+class ArrayStore():
+    '''
+    chunked, compressed arrays of the samples in HDF5 (h5py) or Zarr, one tile per chunk:
+    images (N, C, H, W), labels (N, H, W), and tags, sources, geotransforms and class_ids per sample.
+    the source images and class names are json attributes, an existing store is appended to
+    '''
+    def __init__(self, path, backend='hdf5', tileSize=256, source='', mode='a'):
+        if backend == 'hdf5':
+            if h5py is None:
+                raise Exception('h5py is required by the hdf5 array store')
+            self.root = h5py.File(path, mode)
+        else:
+            if zarr is None:
+                raise Exception('zarr is required by the zarr array store')
+            self.root = zarr.open_group(path, mode=mode)
+        self.backend = backend
+        self.tileSize = int(tileSize)
+        self.sources = json.loads(self.root.attrs.get('sources', '[]'))
+        self.classes = json.loads(self.root.attrs.get('classes', '[]'))
+        if mode != 'r' and source not in self.sources:
+            self.sources.append(source)
+            self.root.attrs['sources'] = json.dumps(self.sources)
+        self.source = self.sources.index(source) if source in self.sources else -1
+        self.staged = None
+
+    def __len__(self):
+        if 'tags' not in self.root:
+            return 0
+        return self.root['tags'].shape[0]
+
+    def dataset(self, name, shape, dtype):
+        '''
+        the dataset of a per sample array of shape, created empty and resizable along the first axis
+        '''
+        shape = tuple(shape)
+        if name in self.root:
+            data = self.root[name]
+            if tuple(data.shape[1:]) != shape or data.dtype != dtype:
+                raise Exception('{} of the array store are {} {}, the new samples are {} {}'.format(
+                    name, data.shape[1:], data.dtype, shape, dtype))
+            return data
+        # tiles take one chunk each, small per sample values are chunked together
+        chunks = (1,) + shape if len(shape) >= 2 else (4096,) + shape
+        if self.backend == 'hdf5':
+            return self.root.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape, chunks=chunks,
+                                            dtype=dtype, compression='gzip', compression_opts=4)
+        return self.root.create_dataset(name, shape=(0,) + shape, chunks=chunks, dtype=dtype)
+
+    def push(self, name, value, dtype):
+        value = np.asarray(value, dtype=dtype)
+        data = self.dataset(name, value.shape, value.dtype)
+        count = data.shape[0]
+        data.resize((count + 1,) + tuple(data.shape[1:]))
+        data[count] = value
+
+    def stage(self, tileArray, geoTransform=None):
+        '''
+        keep the array of the tile being written, it is appended once the sample is accepted
+        '''
+        tile = np.asarray(tileArray)
+        if tile.ndim == 2:
+            tile = tile[np.newaxis, :, :]
+        self.staged = (fitTile(tile, self.tileSize), geoTransform)
+
+    def append(self, tag, label=None, className=None):
+        '''
+        append the staged tile as sample tag
+        :param label: optional label array of the tile, for semantic segmentation
+        :param className: optional class of the tile, for classification
+        '''
+        if self.staged is None:
+            raise Exception('no tile is staged for sample {}'.format(tag))
+        tile, geoTransform = self.staged
+        self.staged = None
+        if geoTransform is None:
+            geoTransform = [np.nan] * 6
+        self.push('images', tile, tile.dtype)
+        if label is not None:
+            label = fitTile(np.asarray(label), self.tileSize)
+            self.push('labels', label, label.dtype)
+        if className is not None:
+            if className not in self.classes:
+                self.classes.append(className)
+                self.root.attrs['classes'] = json.dumps(self.classes)
+            self.push('class_ids', self.classes.index(className), np.int32)
+        self.push('tags', tag, np.int64)
+        self.push('sources', self.source, np.int32)
+        self.push('geotransforms', geoTransform, np.float64)
+
+    def read(self, row):
+        '''
+        :return: image, label (None without labels) and geotransform of a sample
+        '''
+        label = None
+        if 'labels' in self.root:
+            label = self.root['labels'][row]
+        return self.root['images'][row], label, tuple([float(v) for v in self.root['geotransforms'][row]])
+
+    def tags(self):
+        if 'tags' not in self.root:
+            return np.zeros(0, dtype=np.int64)
+        return self.root['tags'][:]
+
+    def setAttribute(self, name, value):
+        self.root.attrs[name] = json.dumps(value)
+
+    def close(self):
+        if hasattr(self.root, 'close'):
+            self.root.close()
+
+
+def arrayStorePath(folder, backend):
+    return os.path.join(folder, 'samples.h5' if backend == 'hdf5' else 'samples.zarr')
+
+
+def makeArrayStore(args, folder, source):
+    '''
+    ArrayStore in folder for --array-store hdf5 or zarr, None when no array store is written
+    '''
+    if args.array_store == 'none':
+        return None
+    return ArrayStore(arrayStorePath(folder, args.array_store), args.array_store, args.tile_size, source)
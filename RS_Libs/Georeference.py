@@ -0,0 +1,108 @@
+# coding=utf-8
+'''
+geotransform arithmetic and georeference sidecar files (world files and .aux.xml),
+computed from the source geotransform and the tile window without arcpy
+'''
+import os
+from xml.sax.saxutils import escape
+
+
+def invertGeoTransform(geoTransform):
+    '''
+    inverse of a GDAL geotransform, maps geographic coordinates to pixel coordinates
+    '''
+    originX, a, b, originY, d, e = geoTransform
+    det = a * e - b * d
+    if det == 0:
+        raise Exception('geotransform is not invertible')
+    return (( b * originY - e * originX) / det, e / det, -b / det,
+            (d * originX - a * originY) / det, -d / det, a / det)
+
+
+def applyGeoTransform(geoTransform, x, y):
+    return (geoTransform[0] + x * geoTransform[1] + y * geoTransform[2],
+            geoTransform[3] + x * geoTransform[4] + y * geoTransform[5])
+
+
+def windowGeoTransform(geoTransform, xoff, yoff, xscale=1.0, yscale=1.0):
+    '''
+    geotransform of a window starting at pixel (xoff, yoff),
+    xscale and yscale are the ratio of the window size to the output tile size after resampling
+    '''
+    originX, originY = applyGeoTransform(geoTransform, xoff, yoff)
+    return (originX, geoTransform[1] * xscale, geoTransform[2] * yscale,
+            originY, geoTransform[4] * xscale, geoTransform[5] * yscale)
+
+
+def worldFileValues(geoTransform):
+    '''
+    the six lines of a world file, which refers to the center of the upper left pixel
+    '''
+    originX, pixelWidth, rotateX, originY, rotateY, pixelHeight = geoTransform
+    return [pixelWidth, rotateY, rotateX, pixelHeight,
+            originX + pixelWidth / 2.0 + rotateX / 2.0,
+            originY + rotateY / 2.0 + pixelHeight / 2.0]
+
+
+def worldFileGeoTransform(values):
+    '''
+    GDAL geotransform from the six lines of a world file
+    '''
+    pixelWidth, rotateY, rotateX, pixelHeight, centerX, centerY = [float(v) for v in values]
+    return (centerX - pixelWidth / 2.0 - rotateX / 2.0, pixelWidth, rotateX,
+            centerY - rotateY / 2.0 - pixelHeight / 2.0, rotateY, pixelHeight)
+
+
+def worldFileExtension(imgPath):
+    '''
+    eg. .tif -> .tfw, .jpg -> .jgw, .png -> .pgw
+    '''
+    extension = os.path.splitext(imgPath)[1].lower()
+    return extension[:2] + extension[-1] + 'w'
+
+
+def readWorldFile(worldPath):
+    with open(worldPath, 'r') as f:
+        content = f.read().replace("\n", ",").split(",")
+    return [float(v) for v in content if v.strip() != '']
+
+
+def writeWorldFile(worldPath, geoTransform):
+    values = worldFileValues(geoTransform)
+    with open(worldPath, 'w') as f:
+        f.write('\n'.join([repr(float(v)) for v in values]) + '\n')
+
+
+def writeAuxXML(imgPath, geoTransform, projection):
+    '''
+    GDAL PAM sidecar with the spatial reference and geotransform of the image
+    '''
+    values = ', '.join(['%.16e' % v for v in geoTransform])
+    with open(imgPath + '.aux.xml', 'w') as f:
+        f.write('<PAMDataset>\n')
+        f.write('  <SRS>{}</SRS>\n'.format(escape(projection)))
+        f.write('  <GeoTransform>{}</GeoTransform>\n'.format(values))
+        f.write('</PAMDataset>\n')
+
+
+def writeSidecars(imgPath, geoTransform, projection=None, worldPath=None):
+    '''
+    write the world file of an image, and the .aux.xml when the projection is given
+    :param worldPath: the world file, default is next to the image, eg. 000001.jgw for 000001.jpg
+    '''
+    if worldPath is None:
+        worldPath = os.path.splitext(imgPath)[0] + worldFileExtension(imgPath)
+    writeWorldFile(worldPath, geoTransform)
+    if projection is not None:
+        writeAuxXML(imgPath, geoTransform, projection)
+
+
+def removeSidecars(imgPath, worldPath=None):
+    '''
+    remove the world file and the .aux.xml of an image, eg. of a discarded label
+    '''
+    if worldPath is None:
+        worldPath = os.path.splitext(imgPath)[0] + worldFileExtension(imgPath)
+    for path in [worldPath, imgPath + '.aux.xml']:
+        if os.path.exists(path):
+            os.remove(path)
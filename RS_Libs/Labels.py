@@ -6,10 +6,15 @@ import os
 from xml.dom.minidom import Document
 import time
 import getpass
+import json
 from PIL import Image
 import numpy as np
 import cv2
 
+from RS_Libs.Objects import PixelBoxes
+from RS_Libs.Placement import ForegroundPrefilter, blockCounts
+from RS_Libs.Writers import submitWrite
+
 
 def getImgSize(imgPath):
     width = 0
@@ -26,6 +31,17 @@ def getImgSize(imgPath):
     return width, height, bands
 
 
+def objectArrays(objects):
+    '''
+    :param objects: Objects.PixelBoxes, or rows of [upleft_x, upleft_y, lowright_x, lowright_y, label, truncated]
+    :return: pixel boxes (N, 4), labels, truncated
+    '''
+    if isinstance(objects, PixelBoxes):
+        return objects.pixels, objects.labels, objects.truncated
+    pixels = np.array([object[:4] for object in objects], dtype=np.int64).reshape(-1, 4)
+    return pixels, [object[4] for object in objects], [object[5] for object in objects]
+
+
 def errorMsg(msg):
     arcpy.AddError(msg)
     raise Exception(msg)
@@ -106,13 +122,11 @@ def writeVOCXML(xmlPath, originalImg, imgPath, objects):
     #     childNode.appendChild(data)
 
     # object node
-    for object in objects:
-        upleft_x = object[0]
-        upleft_y = object[1]
-        lowright_x = object[2]
-        lowright_y = object[3]
-        label = object[4]
-        truncated = object[5]
+    pixels, labels, truncateds = objectArrays(objects)
+    for i in range(len(pixels)):
+        upleft_x, upleft_y, lowright_x, lowright_y = pixels[i].tolist()
+        label = labels[i]
+        truncated = truncateds[i]
 
         objectNode = doc.createElement('object')
         Object.appendChild(objectNode)
@@ -146,29 +160,18 @@ def writeVOCXML(xmlPath, originalImg, imgPath, objects):
 
 
 def writeYoloTxt(txtPath, objects, tileSize, labelList):
+    pixels, labels, _ = objectArrays(objects)
+    centers = (pixels[:, 0:2] + pixels[:, 2:4]) / 2.0 / tileSize
+    sizes = np.abs(pixels[:, 2:4] - pixels[:, 0:2]) * 1.0 / tileSize
+    classIds = dict((name, i) for i, name in enumerate(labelList))
     with open(txtPath, "w+") as f:
-        for object in objects:
-            upleft_x = object[0]
-            upleft_y = object[1]
-            lowright_x = object[2]
-            lowright_y = object[3]
-            label = object[4]
-            truncated = object[5]
-            centerX = (upleft_x + lowright_x) / 2.0
-            centerY = (upleft_y + lowright_y) / 2.0
-            x_center = centerX / tileSize
-            y_center = centerY / tileSize
-            width = abs(lowright_x - upleft_x) * 1.0 / tileSize
-            height = abs(lowright_y - upleft_y) * 1.0 / tileSize
-            objectClassID = labelList.index(str(label))
-            f.write(str(objectClassID) + " " + str(x_center) + " " + str(y_center) + " " + str(width) + " " + str(
-                height) + "\n")
-
-def writeYoloClass(boxInfoList, classNameTxt):
-    labelList = []
-    for boxInfo in boxInfoList:
-        if not boxInfo.label in labelList:
-            labelList.append(boxInfo.label)
+        for i in range(len(pixels)):
+            objectClassID = classIds[str(labels[i])]
+            f.write(str(objectClassID) + " " + str(float(centers[i, 0])) + " " + str(float(centers[i, 1])) + " " +
+                    str(float(sizes[i, 0])) + " " + str(float(sizes[i, 1])) + "\n")
+
+def writeYoloClass(boxTable, classNameTxt):
+    labelList = list(boxTable.labels)
     labelList.sort()
     labelList = list(map(str, labelList))
     with open(classNameTxt, "w+") as f:
@@ -176,43 +179,116 @@ def writeYoloClass(boxInfoList, classNameTxt):
     return labelList
 
 def writeKittiTxt(txtPath, objects):
+    pixels, labels, truncateds = objectArrays(objects)
     with open(txtPath, "w+") as f:
-        for object in objects:
-            upleft_x = object[0]
-            upleft_y = object[1]
-            lowright_x = object[2]
-            lowright_y = object[3]
-            label = str(object[4]).replace(" ", "")
-            truncated = object[5]
+        for i in range(len(pixels)):
+            upleft_x, upleft_y, lowright_x, lowright_y = pixels[i].tolist()
+            label = str(labels[i]).replace(" ", "")
+            truncated = truncateds[i]
             f.write(label + " " + str(truncated) + " 0 0 " + str(upleft_x) + " " + str(
                 upleft_y) + " " + str(lowright_x) + " " + str(lowright_y) + " 0 0 0 0 0 0 0" + "\n")
 
 
-def getLabelMappingList(infeatures, classAttribute, method, mappingParameters):
+COCO_IMAGE_DTYPE = np.dtype([('width', np.int32), ('height', np.int32)])
+
+COCO_ANNOTATION_DTYPE = np.dtype([('image_id', np.int64), ('category_id', np.int32),
+                                  ('xmin', np.int64), ('ymin', np.int64), ('xmax', np.int64), ('ymax', np.int64),
+                                  ('truncated', np.float64)])
+
+
+def growRecords(records, size):
+    if size <= len(records):
+        return records
+    grown = np.zeros(max(size, 2 * len(records)), dtype=records.dtype)
+    grown[:len(records)] = records
+    return grown
+
+
+class CocoAnnotations():
+    '''
+    the images and annotations of a COCO dataset kept in structured arrays during the run,
+    written once as a single json file. category ids are the sorted class names numbered from 1
+    '''
+    def __init__(self, labelList, capacity=1024):
+        self.categories = sorted(map(str, labelList))
+        self.categoryIds = dict((name, i + 1) for i, name in enumerate(self.categories))
+        self.fileNames = []
+        self.images = np.zeros(capacity, dtype=COCO_IMAGE_DTYPE)
+        self.annotations = np.zeros(capacity, dtype=COCO_ANNOTATION_DTYPE)
+        self.count = 0
+
+    def add(self, fileName, width, height, objects):
+        '''
+        :param objects: Objects.PixelBoxes of the image
+        '''
+        pixels, labels, truncateds = objectArrays(objects)
+        imageId = len(self.fileNames) + 1
+        self.images = growRecords(self.images, imageId)
+        self.images[imageId - 1] = (width, height)
+        self.fileNames.append(fileName)
+        self.annotations = growRecords(self.annotations, self.count + len(pixels))
+        rows = self.annotations[self.count:self.count + len(pixels)]
+        rows['image_id'] = imageId
+        rows['category_id'] = [self.categoryIds[str(label)] for label in labels]
+        rows['xmin'], rows['ymin'], rows['xmax'], rows['ymax'] = pixels[:, 0], pixels[:, 1], pixels[:, 2], pixels[:, 3]
+        rows['truncated'] = truncateds
+        self.count += len(pixels)
+
+    def write(self, jsonPath, originalImg='', chunkSize=10000):
+        '''
+        the images and annotations are serialised chunk by chunk, the whole document is never built in memory
+        '''
+        with open(jsonPath, 'w') as f:
+            f.write('{"info": ' + json.dumps({'description': os.path.basename(str(originalImg)),
+                                              'date_created': time.strftime("%Y-%m-%d %H:%M:%S")}))
+            f.write(',\n"categories": ' + json.dumps([{'id': self.categoryIds[name], 'name': name}
+                                                       for name in self.categories]))
+            f.write(',\n"images": [')
+            for start in range(0, len(self.fileNames), chunkSize):
+                sizes = self.images[start:min(start + chunkSize, len(self.fileNames))]
+                items = [json.dumps({'id': start + i + 1, 'file_name': self.fileNames[start + i],
+                                     'width': int(sizes[i]['width']), 'height': int(sizes[i]['height'])})
+                         for i in range(len(sizes))]
+                f.write((',' if start > 0 else '') + '\n' + ',\n'.join(items))
+            f.write('\n],\n"annotations": [')
+            for start in range(0, self.count, chunkSize):
+                rows = self.annotations[start:min(start + chunkSize, self.count)]
+                widths = (rows['xmax'] - rows['xmin']).tolist()
+                heights = (rows['ymax'] - rows['ymin']).tolist()
+                items = [json.dumps({'id': start + i + 1, 'image_id': int(rows[i]['image_id']),
+                                     'category_id': int(rows[i]['category_id']),
+                                     'bbox': [int(rows[i]['xmin']), int(rows[i]['ymin']), widths[i], heights[i]],
+                                     'area': widths[i] * heights[i], 'iscrowd': 0,
+                                     'truncated': float(rows[i]['truncated'])})
+                         for i in range(len(rows))]
+                f.write((',' if start > 0 else '') + '\n' + ',\n'.join(items))
+            f.write('\n]}\n')
+
+
+def getLabelMappingList(infeatures, classAttribute, method, mappingParameters, maxValue=255):
     # 0:None, 1:Maximum Contrast, 2:Positive Integer, 3:Custom
+    # maxValue is the largest gray level of the label tiles, 65535 for 16 bit labels
     mapping_dict = {}
     method=int(method)
     field_names = [f.name for f in arcpy.ListFields(infeatures)]
     if not str(classAttribute) in field_names:
         errorMsg("the field {} does not exist".format(classAttribute))
     fields = ['FID', classAttribute]
-    values = []
+    values = set()
     with arcpy.da.SearchCursor(infeatures, fields) as cursor:
         for row in cursor:
-            classValue = str(row[1])
-            if not classValue in values:
-                values.append(classValue)
-    values.sort()
+            values.add(str(row[1]))
+    values = sorted(values)
     if values[0].isdigit() and values[-1].isdigit():  # class value is digital
-        if int(values[0]) < 0 or int(values[-1]) > 255:
+        if int(values[0]) < 0 or int(values[-1]) > maxValue:
             if method in [0,1]:
-                errorMsg('The label value is not in the range of 0 to 255,'
-                         'gray level transformation must be Positive Integer or Custom')
+                errorMsg('The label value is not in the range of 0 to {},'
+                         'gray level transformation must be Positive Integer or Custom'.format(maxValue))
         if method == 0:
             for i in values:
                 mapping_dict[int(i)] = int(i)
         if method == 1:
-            a = int(255 / len(values))
+            a = int(maxValue / len(values))
             for i in range(len(values)):
                 mapping_dict[int(values[i])] = a * (i + 1)
     else:  # class value is string
@@ -220,19 +296,8 @@ def getLabelMappingList(infeatures, classAttribute, method, mappingParameters):
             errorMsg('when class is string, '
                      'gray level transformation must be Positive Integer or Custom')
     if method == 2:
-        # add a field
-        arcpy.AddField_management(infeatures, "ClassValue", "SHORT")
-        # get all label values
-        fields = ["ClassValue", classAttribute]
         for i in range(len(values)):
             mapping_dict[str(values[i])] = i + 1
-        # mapping dict
-        with arcpy.da.UpdateCursor(infeatures, fields) as cursor:
-            for row in cursor:
-                for key in mapping_dict.keys():
-                    if key == str(row[1]):
-                        row[0] = mapping_dict[key]
-                        cursor.updateRow(row)
     if method == 3:
         if len(mappingParameters) == 0:
             errorMsg('glt parameters is required')
@@ -244,27 +309,41 @@ def getLabelMappingList(infeatures, classAttribute, method, mappingParameters):
             value = p.split(':')[1]
             if not str(key) in values:
                 errorMsg('glt parameters not match')
-            if int(value) < 0 or int(value) > 255:
+            if int(value) < 0 or int(value) > maxValue:
                 errorMsg('glt parameters are illegal')
             mapping_dict[key] = int(value)
-
+    if method in [2, 3]:
         # add a field
-        arcpy.AddField_management(infeatures, "ClassValue", "SHORT")
-        # get all label values
+        arcpy.AddField_management(infeatures, "ClassValue", "SHORT" if maxValue <= 32767 else "LONG")
+        # map the class of every feature in one pass
         fields = ["ClassValue", classAttribute]
-        # mapping dict
         with arcpy.da.UpdateCursor(infeatures, fields) as cursor:
             for row in cursor:
-                for key in mapping_dict.keys():
-                    if key == str(row[1]):
-                        row[0] = mapping_dict[key]
-                        cursor.updateRow(row)
+                classValue = mapping_dict.get(str(row[1]))
+                if classValue is not None:
+                    row[0] = classValue
+                    cursor.updateRow(row)
     return mapping_dict
 
 
-def writeLabelXML(xmlPath, originalImg, labelPath, overlapSize, gltMethod, labelMappingDict, spatialReference):
+def labelLUT(method, mapping_dict):
+    '''
+    lookup table of the gray level transformation over every 16 bit label value.
+    only Maximum Contrast remaps the label raster, the other methods are burnt into it already
+    '''
+    lut = np.arange(65536, dtype=np.uint16)
+    if int(method) == 1:
+        for key, value in mapping_dict.items():
+            if 0 <= int(key) < len(lut):
+                lut[int(key)] = int(value)
+    return lut
+
+
+def writeLabelXML(xmlPath, originalImg, labelPath, overlapSize, gltMethod, labelMappingDict, spatialReference,
+                  size=None):
     '''
     create a xml file for label, includes create date, time, format, source image...
+    :param size: width, height of the label, the label is not opened again when it is given
     '''
     if os.path.exists(xmlPath):
         os.remove(xmlPath)
@@ -280,8 +359,9 @@ def writeLabelXML(xmlPath, originalImg, labelPath, overlapSize, gltMethod, label
     Creater = str(getpass.getuser())  # 获取当前用户名
     SourceImage = os.path.basename(originalImg)
     Format = 'PNG'
-    img = Image.open(labelPath)
-    Width, Height = img.size
+    if size is None:
+        size = Image.open(labelPath).size
+    Width, Height = size
     Overlap = overlapSize
     gltMethod=int(gltMethod)
     LabelMappingMethod='None'
@@ -332,51 +412,140 @@ def checkLabel(labelPath,sampleQuality):
     :param sampleQuality:
     :return:
     '''
-    valid=True
-    img = Image.open(labelPath)
-    clrs = img.getcolors()
-    blackGround = 0
-    foreGround = 0
-    for num, value in clrs:
-        if value == 0:
-            blackGround = num
-        else:
-            foreGround += num
+    return checkLabelArray(np.array(Image.open(labelPath)), sampleQuality)
+
+def checkLabelArray(labelArray, sampleQuality):
+    '''
+    checkLabel of a label array in memory
+    '''
+    if labelArray.size == 0:
+        return False
+    foreGround = np.count_nonzero(labelArray)
     if foreGround == 0:
-        valid=False
-    else:
-        rate = 1 - blackGround * 1.0 / (foreGround + blackGround)
-        if rate < sampleQuality:
-            valid=False
-    return valid
-
-def labelMapping(inputLabel,method,mapping_dict,tileSize):
-    img = Image.open(inputLabel)
-    width,height=img.size
+        return False
+    return foreGround * 1.0 / labelArray.size >= sampleQuality
+
+def foregroundPrefilter(labelTiff, block=8, stripRows=4096):
+    '''
+    ForegroundPrefilter of a label raster, the foreground is counted in blocks of block x block pixels
+    while the raster is read in strips
+    '''
+    raster = arcpy.Raster(labelTiff)
+    width, height = raster.width, raster.height
+    cellWidth, cellHeight = raster.meanCellWidth, raster.meanCellHeight
+    extent = raster.extent
+    stripRows = max(stripRows // block, 1) * block
+    counts = np.zeros((int(np.ceil(height * 1.0 / block)), int(np.ceil(width * 1.0 / block))), dtype=np.int32)
+    for top in range(0, height, stripRows):
+        rows = min(stripRows, height - top)
+        corner = arcpy.Point(extent.XMin, extent.YMax - (top + rows) * cellHeight)
+        strip = arcpy.RasterToNumPyArray(labelTiff, corner, width, rows, 0)
+        counts[top // block:top // block + int(np.ceil(rows * 1.0 / block)), :] = blockCounts(strip != 0, block)
+    return ForegroundPrefilter(counts, extent.XMin, extent.YMax, cellWidth, cellHeight, width, height, block)
+
+
+def labelPalette():
+    '''
+    PASCAL VOC colour map, 0 is black and every class value gets its own colour
+    '''
+    palette = []
+    for i in range(256):
+        r, g, b, c = 0, 0, 0, i
+        for j in range(8):
+            r |= (c & 1) << (7 - j)
+            g |= ((c >> 1) & 1) << (7 - j)
+            b |= ((c >> 2) & 1) << (7 - j)
+            c >>= 3
+        palette.extend([r, g, b])
+    return palette
+
+
+LABEL_PALETTE = labelPalette()
+
+
+def labelMapping(inputLabel,method,mapping_dict,tileSize,labelMode='rgb'):
+    labelArray = mapLabelArray(np.array(Image.open(inputLabel)), method, mapping_dict, tileSize, labelMode)
+    return labelImage(labelArray, labelMode)
+
+
+def mapLabelArray(img,method,mapping_dict,tileSize,labelMode='rgb'):
+    '''
+    :param mapping_dict: mapping dict of getLabelMappingList, or its lookup table from labelLUT
+    :param labelMode: gray16 keeps 16 bit gray levels, the other modes 8 bit
+    :return: the gray levels of the label tile
+    '''
+    height, width = img.shape[:2]
     if width!=tileSize or height!=tileSize:
-        img = img.resize((tileSize, tileSize), Image.NEAREST)
-    img = np.array(img)
+        img = np.array(Image.fromarray(img).resize((tileSize, tileSize), Image.NEAREST))
     if int(method) == 1:
-        for key, values in mapping_dict.items():
-            np.putmask(img, img == int(key), int(values))
-    mask = Image.fromarray(img.astype('uint8')).convert('RGB')
+        lut = mapping_dict
+        if not isinstance(lut, np.ndarray):
+            lut = labelLUT(method, mapping_dict)
+        if img.dtype in [np.uint8, np.uint16]:
+            img = lut[img]
+        else:
+            inside = (img >= 0) & (img < len(lut))
+            img = img.copy()
+            img[inside] = lut[img[inside]]
+    if labelMode == 'gray16':
+        return img.astype('uint16')
+    return img.astype('uint8')
+
+
+def labelImage(labelArray,labelMode='rgb'):
+    '''
+    :param labelMode: rgb, three identical channels; gray, 8 bit single channel;
+                      palette, 8 bit with the class colour table; gray16, 16 bit single channel
+    '''
+    mask = Image.fromarray(labelArray)
+    if labelMode == 'gray16':
+        return mask
+    if labelMode == 'palette':
+        mask.putpalette(LABEL_PALETTE)
+    elif labelMode != 'gray':
+        mask = mask.convert('RGB')
     return mask
 
 
-def makeLabel(tag,inputFeature,label,labelDir,gltMethod,glt_dict,tileSize,filter=0.05):
-    status = False
+def saveLabel(outLabel, labelArray, labelMode='rgb'):
+    labelImage(labelArray, labelMode).save(outLabel)
+
+
+def makeLabel(tag,inputFeature,label,labelDir,gltMethod,glt_dict,tileSize,filter=0.05,labelMode='rgb',writer=None):
+    '''
+    :param writer: optional Writers.AsyncWriter, the label png is encoded and written in the background
+    :return: the gray levels of the label, None if the label is discarded
+    '''
     fileName = str(tag).zfill(6)
     outLabel = os.path.join(labelDir, fileName + '.png')
     arcpy.env.workspace=labelDir
     arcpy.Clip_management(label, "#", outLabel, inputFeature, "0", "None", "MAINTAIN_EXTENT")
-    if not checkLabel(outLabel, filter):
-        arcpy.Delete_management(outLabel)
-        return status
-    # label mapping
-    labelArray = labelMapping(outLabel, gltMethod,glt_dict,tileSize)
+    # the clipped label is read once, checked and mapped in memory
+    labelArray = np.array(Image.open(outLabel))
     arcpy.Delete_management(outLabel)
-    labelArray.save(outLabel)
-    status=True
-    return status
+    if not checkLabelArray(labelArray, filter):
+        return None
+    # label mapping
+    labelArray = mapLabelArray(labelArray, gltMethod, glt_dict, tileSize, labelMode)
+    submitWrite(writer, outLabel, saveLabel, outLabel, labelArray, labelMode)
+    return labelArray
+
+
+def makeWindowLabel(tag,extent,rasterizer,labelDir,gltMethod,glt_dict,tileSize,filter=0.05,labelMode='rgb',
+                    writer=None):
+    '''
+    makeLabel without the scene label raster, the features intersecting the tile are burnt in memory
+    :param extent: xmin, ymin, xmax, ymax of the tile
+    :param rasterizer: Rasterize.FeatureRasterizer of the label features
+    :param writer: optional Writers.AsyncWriter, the label png is encoded and written in the background
+    :return: the gray levels of the label, None if the label is discarded
+    '''
+    outLabel = os.path.join(labelDir, str(tag).zfill(6) + '.png')
+    labelArray = rasterizer.burn(*extent)
+    if not checkLabelArray(labelArray, filter):
+        return None
+    labelArray = mapLabelArray(labelArray, gltMethod, glt_dict, tileSize, labelMode)
+    submitWrite(writer, outLabel, saveLabel, outLabel, labelArray, labelMode)
+    return labelArray
 
 
@@ -1,7 +1,171 @@
 # coding=utf-8
+import numpy as np
 
 
-class ObjectInfo():
+def clipBoxes(boxes, tileExtent, truncated=None):
+    '''
+    clip boxes to a tile and score how much of every box is cut off, closed form rectangle math
+    :param boxes: array (N, 4) of [xmin, ymin, xmax, ymax]
+    :param tileExtent: xmin, ymin, xmax, ymax of the tile
+    :param truncated: truncated fractions the boxes already have, eg. parts of split large objects
+    :return: indices of the boxes overlapping the tile, clipped boxes (M, 4), truncated fractions (M,)
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    xmin, ymin, xmax, ymax = tileExtent
+    clipped = np.stack([np.maximum(boxes[:, 0], xmin), np.maximum(boxes[:, 1], ymin),
+                        np.minimum(boxes[:, 2], xmax), np.minimum(boxes[:, 3], ymax)], axis=1)
+    keep = np.nonzero((clipped[:, 0] < clipped[:, 2]) & (clipped[:, 1] < clipped[:, 3]))[0]
+    boxes, clipped = boxes[keep], clipped[keep]
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    clippedArea = (clipped[:, 2] - clipped[:, 0]) * (clipped[:, 3] - clipped[:, 1])
+    fraction = np.maximum(1 - clippedArea / area, 0)
+    if truncated is not None:
+        # a part of a split object which is clipped again keeps both fractions
+        before = np.asarray(truncated, dtype=np.float64)[keep]
+        fraction = np.where(before == 0, fraction,
+                            np.where(fraction == 0, before, fraction * before))
+    return keep, clipped, fraction
+
+
+def geoToPixelBoxes(boxes, geoTransform, originX, originY, tileSize):
+    '''
+    geographic boxes (N, 4) of [xmin, ymin, xmax, ymax] to pixel boxes (N, 4) of
+    [upleft_x, upleft_y, lowright_x, lowright_y] in a tile whose upper left corner is (originX, originY).
+    the four corners go through the inverse of the full affine transform, rotation terms included,
+    and the pixel box is their bounding box clamped to the tile
+    :param geoTransform: Rasters.GeoTransform, its values are in world file order
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    a, d, b, e = geoTransform.pixelWidth, geoTransform.rotateX, geoTransform.rotateY, geoTransform.pixelHeight
+    det = a * e - b * d
+    if det == 0:
+        raise Exception('geotransform is not invertible')
+    # corners in the order of the columns xmin, ymin, xmax, ymax
+    x = boxes[:, [0, 2, 2, 0]] - originX
+    y = boxes[:, [3, 3, 1, 1]] - originY
+    cols = (e * x - b * y) / det
+    rows = (a * y - d * x) / det
+    pixels = np.stack([cols.min(axis=1), rows.min(axis=1), cols.max(axis=1), rows.max(axis=1)], axis=1)
+    return np.clip(np.trunc(pixels), 0, tileSize - 1).astype(np.int64)
+
+
+class PixelBoxes(object):
+    '''
+    pixel boxes of a tile as arrays, iterating gives the rows
+    [upleft_x, upleft_y, lowright_x, lowright_y, label, truncated] the label writers used to take
+    '''
+    __slots__ = ('pixels', 'labels', 'truncated')
+
+    def __init__(self, pixels, labels, truncated):
+        self.pixels = np.asarray(pixels, dtype=np.int64).reshape(-1, 4)
+        self.labels = list(labels)
+        self.truncated = list(truncated)
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def __getitem__(self, i):
+        p = self.pixels[i]
+        return [int(p[0]), int(p[1]), int(p[2]), int(p[3]), self.labels[i], self.truncated[i]]
+
+    def __iter__(self):
+        for i in range(len(self.pixels)):
+            yield self[i]
+
+
+BOX_DTYPE = np.dtype([('xmin', np.float64), ('ymin', np.float64), ('xmax', np.float64), ('ymax', np.float64),
+                      ('label_id', np.int32), ('truncated', np.float64)])
+
+
+class BoxTable(object):
+    '''
+    columnar store of object boxes, a numpy structured array of BOX_DTYPE and the list of class labels
+    which label_id points into. replaces lists of BoxInfo, which keep an arcpy Extent per object
+    '''
+    __slots__ = ('records', 'size', 'labels', 'labelIds')
+
+    def __init__(self, capacity=1024):
+        self.records = np.zeros(max(int(capacity), 1), dtype=BOX_DTYPE)
+        self.size = 0
+        self.labels = []
+        self.labelIds = {}
+
+    def __len__(self):
+        return self.size
+
+    def labelId(self, label):
+        if label not in self.labelIds:
+            self.labelIds[label] = len(self.labels)
+            self.labels.append(label)
+        return self.labelIds[label]
+
+    def reserve(self, size):
+        if size > len(self.records):
+            records = np.zeros(max(size, 2 * len(self.records)), dtype=BOX_DTYPE)
+            records[:self.size] = self.records[:self.size]
+            self.records = records
+
+    def append(self, xmin, ymin, xmax, ymax, label, truncated=0):
+        self.reserve(self.size + 1)
+        self.records[self.size] = (xmin, ymin, xmax, ymax, self.labelId(label), truncated)
+        self.size += 1
+
+    def appendExtent(self, extent, label, truncated=0):
+        self.append(extent.XMin, extent.YMin, extent.XMax, extent.YMax, label, truncated)
+
+    def extend(self, table):
+        rows = table.records[:table.size].copy()
+        if len(rows) > 0:
+            ids = np.array([self.labelId(label) for label in table.labels], dtype=np.int32)
+            rows['label_id'] = ids[rows['label_id']]
+        self.reserve(self.size + len(rows))
+        self.records[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+
+    def view(self):
+        return self.records[:self.size]
+
+    def extents(self, indices=None):
+        '''
+        :return: array (N, 4) of [xmin, ymin, xmax, ymax]
+        '''
+        rows = self.view() if indices is None else self.records[indices]
+        return np.stack([rows['xmin'], rows['ymin'], rows['xmax'], rows['ymax']], axis=1)
+
+    def bounds(self, i):
+        row = self.records[i]
+        return float(row['xmin']), float(row['ymin']), float(row['xmax']), float(row['ymax'])
+
+    def label(self, i):
+        return self.labels[self.records[i]['label_id']]
+
+
+class TileBoxes(object):
+    '''
+    the boxes near one tile, kept as indices into the BoxTable until the labels of the tile are written
+    '''
+    __slots__ = ('bounds', 'table', 'indices', 'geoTransform', 'tileSize')
+
+    def __init__(self, bounds, table, indices, geo_transform, tile_size):
+        self.bounds = bounds
+        self.table = table
+        self.indices = indices
+        self.geoTransform = geo_transform
+        self.tileSize = tile_size
+
+    def getObject(self):
+        '''
+        :return: tile bounds (xmin, ymin, xmax, ymax) and PixelBoxes of the boxes clipped to it
+        '''
+        rows = self.table.records[self.indices]
+        keep, clipped, truncated = clipBoxes(self.table.extents(self.indices), self.bounds, rows['truncated'])
+        pixels = geoToPixelBoxes(clipped, self.geoTransform, self.bounds[0], self.bounds[3], self.tileSize)
+        labels = [self.table.labels[l] for l in rows['label_id'][keep]]
+        return [self.bounds, PixelBoxes(pixels, labels, ['{:.3f}'.format(t) for t in truncated])]
+
+
+class ObjectInfo(object):
+    __slots__ = ('geoTransform', 'imgExtent', 'tileSize', 'boxesGeo', 'boxesPixel')
 
     def __init__(self, img_extent, boxes, geo_transform, tile_size):
 
@@ -12,44 +176,23 @@ class ObjectInfo():
         self.boxesPixel = self.geoExtent2pixelExtent(boxes)
 
     def geoExtent2pixelExtent(self, box_info_list):
+        extents = [[b.extent.XMin, b.extent.YMin, b.extent.XMax, b.extent.YMax] for b in box_info_list]
+        return PixelBoxes(self.geoArray2pixelArray(extents),
+                          [b.label for b in box_info_list], [b.truncated for b in box_info_list])
 
-        pixel_width = self.geoTransform.pixelWidth
-        pixel_height = self.geoTransform.pixelHeight
-        box_list = []
-        for i in range(len(box_info_list)):
-            box_info = box_info_list[i]
-            box = box_info.extent
-            label = box_info.label
-            truncated = box_info.truncated
-            xmin_geo = box.XMin
-            xmax_geo = box.XMax
-            ymin_geo = box.YMin
-            ymax_geo = box.YMax
-
-            original_x = self.imgExtent.XMin
-            original_y = self.imgExtent.YMax
-
-            upleft_x = int((xmin_geo - original_x) / pixel_width)
-            if upleft_x < 0:
-                upleft_x = 0
-            upleft_y = int((ymax_geo - original_y) / pixel_height)
-            if upleft_y < 0:
-                upleft_y = 0
-            lowright_x = int((xmax_geo - original_x) / pixel_width)
-            if lowright_x > (self.tileSize - 1):
-                lowright_x = self.tileSize - 1
-            lowright_y = int((ymin_geo - original_y) / pixel_height)
-            if lowright_y > (self.tileSize - 1):
-                lowright_y = self.tileSize - 1
-
-            box_list.append([upleft_x, upleft_y, lowright_x, lowright_y, label, truncated])
-        return box_list
+    def geoArray2pixelArray(self, extents):
+        '''
+        batched geoExtent2pixelExtent, geographic boxes (N, 4) to pixel boxes (N, 4) of this tile
+        '''
+        return geoToPixelBoxes(extents, self.geoTransform, self.imgExtent.XMin, self.imgExtent.YMax, self.tileSize)
 
     def getObject(self):
         return [self.imgExtent, self.boxesPixel]
 
 
-class BoxInfo():
+class BoxInfo(object):
+    __slots__ = ('extent', 'label', 'truncated')
+
     def __init__(self, extent, label, truncated):
         self.extent = extent
         self.label = label
@@ -0,0 +1,301 @@
+# coding=utf-8
+'''
+tile placement, a greedy set cover of objects for object detection, sliding window grids for segmentation
+and a foreground prefilter of the grid cells
+'''
+import heapq
+import cv2
+import numpy as np
+
+from RS_Libs.Objects import clipBoxes
+from RS_Libs.SpatialIndex import GridIndex
+
+
+def centeredTiles(boxes, tileWidth, tileHeight):
+    '''
+    one tile centred on every box, array (N, 4) of [xmin, ymin, xmax, ymax]
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    centerX = (boxes[:, 0] + boxes[:, 2]) / 2
+    centerY = (boxes[:, 1] + boxes[:, 3]) / 2
+    return np.stack([centerX - tileWidth / 2.0, centerY - tileHeight / 2.0,
+                     centerX + tileWidth / 2.0, centerY + tileHeight / 2.0], axis=1)
+
+
+def snappedSize(length, cellSize):
+    '''
+    size in pixels rounded half up, like round() of python 2
+    '''
+    return np.floor(length / cellSize + 0.5)
+
+
+def gridTiles(extents, cellWidth, cellHeight, tileSize, overlapSize, multiple=1):
+    '''
+    sliding window tiles over feature extents, the array counterpart of the loops of Polygons.splitPolygons.
+    an extent smaller than multiple tiles gets one centred tile, an extent larger in one direction a row or column
+    of tiles through its centre, otherwise a grid starting at its upper left corner
+    :param extents: array (N, 4) of [xmin, ymin, xmax, ymax]
+    :return: array (M, 4) of tile [xmin, ymin, xmax, ymax]
+    '''
+    extents = np.asarray(extents, dtype=np.float64).reshape(-1, 4)
+    halfWidth = tileSize * cellWidth / 2.0
+    halfHeight = tileSize * cellHeight / 2.0
+    strideX = (tileSize - overlapSize) * cellWidth
+    strideY = (tileSize - overlapSize) * cellHeight
+    limit = multiple * tileSize
+    tiles = []
+    for XMin, YMin, XMax, YMax in extents:
+        width = snappedSize(XMax - XMin, cellWidth)
+        height = snappedSize(YMax - YMin, cellHeight)
+        center_x = (XMin + XMax) / 2
+        center_y = (YMin + YMax) / 2
+        if width < limit and height < limit:
+            centersX = np.array([center_x])
+            centersY = np.array([center_y])
+        elif width > limit and height < limit:
+            # walk left from the centre while the tile reaches XMin, then right while it reaches XMax
+            left = center_x - strideX * np.arange(max(np.ceil((center_x + halfWidth - XMin) / strideX), 0))
+            right = center_x + strideX * np.arange(1, max(np.ceil((XMax + halfWidth - center_x) / strideX), 1))
+            centersX = np.concatenate([left, right])
+            centersY = np.array([center_y])
+        elif width < limit and height > limit:
+            down = center_y - strideY * np.arange(max(np.ceil((center_y + halfHeight - YMin) / strideY), 0))
+            up = center_y + strideY * np.arange(1, max(np.ceil((YMax + halfHeight - center_y) / strideY), 1))
+            centersX = np.array([center_x])
+            centersY = np.concatenate([down, up])
+        else:
+            centersX = XMin + halfWidth + strideX * np.arange(max(np.ceil((XMax - XMin) / strideX), 1))
+            centersY = YMax - halfHeight - strideY * np.arange(max(np.ceil((YMax - YMin) / strideY), 1))
+        gridX, gridY = np.meshgrid(centersX, centersY)
+        gridX, gridY = gridX.ravel(), gridY.ravel()
+        tiles.append(np.stack([gridX - halfWidth, gridY - halfHeight, gridX + halfWidth, gridY + halfHeight], axis=1))
+    if len(tiles) == 0:
+        return np.zeros((0, 4))
+    return np.concatenate(tiles)
+
+
+def visibility(boxes, tile):
+    '''
+    indices of the boxes overlapping the tile and the fraction of their area inside it
+    '''
+    keep, _, truncated = clipBoxes(boxes, tile)
+    return keep, 1 - truncated
+
+
+def shiftTiles(tiles, clipBounds):
+    '''
+    shift the tiles into clipBounds, eg. the image extent, the tiles larger than it are dropped
+    :param clipBounds: xmin, ymin, xmax, ymax
+    '''
+    tiles = np.asarray(tiles, dtype=np.float64).reshape(-1, 4)
+    xmin, ymin, xmax, ymax = [float(v) for v in clipBounds]
+    widths = tiles[:, 2] - tiles[:, 0]
+    heights = tiles[:, 3] - tiles[:, 1]
+    tiles = tiles[(widths <= xmax - xmin) & (heights <= ymax - ymin)]
+    widths = tiles[:, 2] - tiles[:, 0]
+    heights = tiles[:, 3] - tiles[:, 1]
+    left = np.clip(tiles[:, 0], xmin, xmax - widths)
+    bottom = np.clip(tiles[:, 1], ymin, ymax - heights)
+    # the far sides are clipped too, so round off never puts a tile a hair outside
+    return np.stack([left, bottom, np.minimum(left + widths, xmax), np.minimum(bottom + heights, ymax)], axis=1)
+
+
+def coverTiles(boxes, tileWidth, tileHeight, minVisibility=1.0, clipBounds=None):
+    '''
+    greedy set cover over candidate tiles, a tile centred on every box and a tile with every box in its upper left
+    corner. an object is covered by a tile showing at least minVisibility of its area, objects larger than a tile
+    need the visibility they get in their centred tile
+    :param boxes: array (N, 4) of [xmin, ymin, xmax, ymax]
+    :param clipBounds: xmin, ymin, xmax, ymax, eg. the image extent, the candidates are shifted inside it
+    :return: chosen tiles (M, 4) in row order and a dict of statistics
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    count = len(boxes)
+    widths = boxes[:, 2] - boxes[:, 0]
+    heights = boxes[:, 3] - boxes[:, 1]
+    best = np.minimum(tileWidth / np.maximum(widths, 1e-12), 1) * np.minimum(tileHeight / np.maximum(heights, 1e-12), 1)
+    # tolerance for the float round off of clipping
+    required = np.minimum(float(minVisibility), best) - 1e-9
+    anchored = np.stack([boxes[:, 0], boxes[:, 3] - tileHeight, boxes[:, 0] + tileWidth, boxes[:, 3]], axis=1)
+    candidates = np.concatenate([centeredTiles(boxes, tileWidth, tileHeight), anchored])
+    if clipBounds is not None:
+        candidates = shiftTiles(candidates, clipBounds)
+    index = GridIndex(boxes, max(tileWidth, tileHeight))
+    covered = np.zeros(count, dtype=bool)
+
+    def coveredBy(tile):
+        found = index.candidates(tile[0], tile[1], tile[2], tile[3])
+        if len(found) == 0:
+            return found
+        keep, visible = visibility(boxes[found], tile)
+        found = found[keep]
+        found = found[visible >= required[found]]
+        return found[~covered[found]]
+
+    # lazy greedy, a stale gain is an upper bound of the current one because coverage only grows
+    heap = [(-len(coveredBy(candidates[i])), i) for i in range(len(candidates))]
+    heapq.heapify(heap)
+    chosen = []
+    while heap and not covered.all():
+        gain, i = heapq.heappop(heap)
+        found = coveredBy(candidates[i])
+        if len(found) == 0:
+            continue
+        if heap and len(found) < -heap[0][0]:
+            heapq.heappush(heap, (-len(found), i))
+            continue
+        covered[found] = True
+        chosen.append(i)
+    tiles = candidates[chosen].reshape(-1, 4)
+    if len(tiles) > 0:
+        tiles = tiles[np.lexsort((tiles[:, 0], -tiles[:, 3]))]
+    full = np.zeros(count, dtype=bool)
+    for tile in tiles:
+        found = index.candidates(tile[0], tile[1], tile[2], tile[3])
+        if len(found) > 0:
+            keep, visible = visibility(boxes[found], tile)
+            full[found[keep][visible >= 1 - 1e-9]] = True
+    statistics = {'objects': count, 'candidates': len(candidates), 'tiles': len(tiles),
+                  'covered': int(covered.sum()), 'uncovered': int(count - covered.sum()),
+                  'fully_contained': int(full.sum()),
+                  'reduction': count * 1.0 / max(len(tiles), 1)}
+    return tiles, statistics
+
+
+def rasterizeRings(rings, originX, originY, cellWidth, cellHeight, rows, cols):
+    '''
+    boolean occupancy grid, a cell is occupied when a polygon covers it or a polygon edge passes through it.
+    holes are filled, which only keeps a few more cells
+    :param rings: iterable of polygon rings, sequences of (x, y)
+    :param originX: x of the upper left corner of the grid
+    :param originY: y of the upper left corner of the grid
+    '''
+    grid = np.zeros((rows, cols), dtype=np.uint8)
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+        # opencv puts integer coordinates at cell centres, 4 fractional bits keep the sub cell position
+        points = np.stack([(ring[:, 0] - originX) / cellWidth - 0.5, (originY - ring[:, 1]) / cellHeight - 0.5], axis=1)
+        points = np.round(points * 16).astype(np.int32)
+        cv2.fillPoly(grid, [points], 1, lineType=8, shift=4)
+        cv2.polylines(grid, [points], True, 1, lineType=8, shift=4)
+    return grid
+
+
+def occupancyTiles(rings, bounds, cellWidth, cellHeight, tileSize, overlapSize, bufferDistance, clipBounds=None,
+                   subdivisions=4):
+    '''
+    tiles of a regular sliding window grid whose window, widened by bufferDistance, holds a label.
+    the labels are rasterized into an occupancy grid with subdivisions cells per stride, which is dilated
+    by the shape of a widened tile window, so every tile is decided by a single cell
+    :param rings: iterable of polygon rings of the labels, sequences of (x, y)
+    :param bounds: xmin, ymin, xmax, ymax of the labels
+    :param clipBounds: xmin, ymin, xmax, ymax, only the tiles intersecting it are kept, eg. the image extent
+    :param subdivisions: occupancy cells per stride, more cells keep fewer tiles beyond the buffer
+    :return: array (N, 4) of tile [xmin, ymin, xmax, ymax] in row order
+    '''
+    strideX = (tileSize - overlapSize) * cellWidth
+    strideY = (tileSize - overlapSize) * cellHeight
+    tileWidth = tileSize * cellWidth
+    tileHeight = tileSize * cellHeight
+    gridWidth = strideX / subdivisions
+    gridHeight = strideY / subdivisions
+    # the window of tile (r, c) widened by the buffer covers the occupancy cells
+    # r * subdivisions - bufferY to r * subdivisions + spanY - 1, and the same for the columns
+    bufferX = int(np.ceil(bufferDistance / gridWidth))
+    bufferY = int(np.ceil(bufferDistance / gridHeight))
+    spanX = int(np.ceil((tileWidth + bufferDistance) / gridWidth))
+    spanY = int(np.ceil((tileHeight + bufferDistance) / gridHeight))
+    xmin, ymin, xmax, ymax = bounds
+    # tile (r, c) has its upper left corner at (originX + c * strideX, originY - r * strideY)
+    tileCols = int(np.ceil((xmax - xmin + tileWidth + 2 * bufferDistance) / strideX)) + 1
+    tileRows = int(np.ceil((ymax - ymin + tileHeight + 2 * bufferDistance) / strideY)) + 1
+    originX = xmin - (np.ceil((tileWidth + bufferDistance) / strideX)) * strideX
+    originY = ymax + (np.ceil((tileHeight + bufferDistance) / strideY)) * strideY
+    cols = tileCols * subdivisions + spanX
+    rows = tileRows * subdivisions + spanY
+    occupied = rasterizeRings(rings, originX, originY, gridWidth, gridHeight, rows, cols)
+    kernel = np.ones((spanY + bufferY, spanX + bufferX), dtype=np.uint8)
+    occupied = cv2.dilate(occupied, kernel, anchor=(bufferX, bufferY))
+    keepRows, keepCols = np.nonzero(occupied[:tileRows * subdivisions:subdivisions,
+                                             :tileCols * subdivisions:subdivisions])
+    left = originX + keepCols * strideX
+    top = originY - keepRows * strideY
+    tiles = np.stack([left, top - tileHeight, left + tileWidth, top], axis=1)
+    if clipBounds is not None:
+        keep = (tiles[:, 0] < clipBounds[2]) & (tiles[:, 2] > clipBounds[0]) & \
+               (tiles[:, 1] < clipBounds[3]) & (tiles[:, 3] > clipBounds[1])
+        tiles = tiles[keep]
+    return tiles
+
+
+def summedAreaTable(counts):
+    '''
+    integral image with a leading row and column of zeros, sat[r, c] is the sum of counts[:r, :c]
+    '''
+    sat = np.zeros((counts.shape[0] + 1, counts.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(counts, axis=0, dtype=np.int64), axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def blockCounts(mask, block):
+    '''
+    number of True pixels in every block x block block of the mask, the last blocks may be partial
+    '''
+    rows = int(np.ceil(mask.shape[0] * 1.0 / block))
+    cols = int(np.ceil(mask.shape[1] * 1.0 / block))
+    padded = np.zeros((rows * block, cols * block), dtype=np.int32)
+    padded[:mask.shape[0], :mask.shape[1]] = mask
+    return padded.reshape(rows, block, cols, block).sum(axis=(1, 3))
+
+
+class ForegroundPrefilter(object):
+    '''
+    foreground ratio of any window of a label raster in O(1), from a summed area table of the foreground pixel
+    counts per block, built once per scene. a window is scored by all the blocks it touches,
+    so the ratio is never underestimated and a cell is only rejected when its label would fail checkLabel too
+    '''
+    def __init__(self, counts, originX, originY, cellWidth, cellHeight, width, height, block=1):
+        '''
+        :param counts: foreground pixels per block, see blockCounts
+        :param originX: x of the upper left corner of the label raster
+        :param originY: y of the upper left corner of the label raster
+        :param width: columns of the label raster in pixels
+        :param height: rows of the label raster in pixels
+        '''
+        self.sat = summedAreaTable(counts)
+        self.originX = originX
+        self.originY = originY
+        self.cellWidth = cellWidth
+        self.cellHeight = cellHeight
+        self.width = width
+        self.height = height
+        self.block = block
+
+    def foreground(self, xmin, ymin, xmax, ymax):
+        '''
+        foreground pixels of the window, counted in the blocks it touches, and the pixels of the window
+        inside the raster
+        '''
+        x0 = (xmin - self.originX) / self.cellWidth
+        x1 = (xmax - self.originX) / self.cellWidth
+        y0 = (self.originY - ymax) / self.cellHeight
+        y1 = (self.originY - ymin) / self.cellHeight
+        blocks = self.sat.shape[1] - 1, self.sat.shape[0] - 1
+        c0 = min(max(int(np.floor(x0 / self.block)), 0), blocks[0])
+        c1 = min(max(int(np.ceil(x1 / self.block)), 0), blocks[0])
+        r0 = min(max(int(np.floor(y0 / self.block)), 0), blocks[1])
+        r1 = min(max(int(np.ceil(y1 / self.block)), 0), blocks[1])
+        count = self.sat[r1, c1] - self.sat[r0, c1] - self.sat[r1, c0] + self.sat[r0, c0]
+        pixels = (min(int(round(x1)), self.width) - max(int(round(x0)), 0)) * \
+                 (min(int(round(y1)), self.height) - max(int(round(y0)), 0))
+        return int(count), max(pixels, 0)
+
+    def passes(self, xmin, ymin, xmax, ymax, filter=0.05):
+        '''
+        False when the foreground ratio of the window is surely below filter
+        '''
+        count, pixels = self.foreground(xmin, ymin, xmax, ymax)
+        if count == 0 or pixels == 0:
+            return False
+        return count * 1.0 / pixels >= filter
+
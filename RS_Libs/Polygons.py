@@ -3,10 +3,13 @@
 import arcpy
 import os
 import shutil
+import numpy as np
 from tqdm import tqdm
 import arcpy.cartography as CA
 
-from RS_Libs.Objects import ObjectInfo, BoxInfo
+from RS_Libs.Objects import BoxTable, TileBoxes
+from RS_Libs.SpatialIndex import GridIndex
+from RS_Libs.Placement import centeredTiles, coverTiles, gridTiles, occupancyTiles
 
 
 def getExtent(infeatures,workspace):
@@ -21,7 +24,7 @@ def getExtent(infeatures,workspace):
     return polygonList
 
 def getExtentWithClass(infeatures,attribute,workspace):
-    boxInfoList=[]
+    boxTable=BoxTable()
     field_names = [f.name for f in arcpy.ListFields(infeatures)]
     assert str(attribute) in field_names,"class attribute not exist"
     fields = ['FID','SHAPE@',str(attribute)]
@@ -31,9 +34,8 @@ def getExtentWithClass(infeatures,attribute,workspace):
             poly=row[1]
             label=row[2]
             extent=poly.extent
-            boxInfo=BoxInfo(extent,label,0)
-            boxInfoList.append(boxInfo)
-    return boxInfoList
+            boxTable.appendExtent(extent,label,0)
+    return boxTable
 
 def getWidthHeight(extent,meanCellWidth,meanCellHeight):
     xmin = extent.XMin
@@ -99,93 +101,51 @@ def findNeighborPolygons(srcExtent,extentList,cellWidth,tileSize):
             neighbors.append(ex)
     return neighbors
 
-def findNeighborBoxes(srcExtent,boxInfoList,cellWidth,tileSize):
-
-    neighbors=[]
-    srcPoly=extentToPolygon(srcExtent)
+def boxesIndex(boxTable,cellWidth,tileSize):
+    '''
+    grid index over the boxes of a BoxTable, the cell size is the size of a tile
+    '''
+    return GridIndex(boxTable.extents(), cellWidth * tileSize)
+
+def findNeighborBoxes(srcExtent,boxTable,cellWidth,tileSize,boxIndex=None):
+    '''
+    boxes closer than half a tile to srcExtent
+    :param srcExtent: (xmin, ymin, xmax, ymax) of the tile
+    :param boxIndex: GridIndex of boxTable, built by boxesIndex, pass it when searching many times
+    :return: indices of the boxes in boxTable, in input order
+    '''
     neighborDis=cellWidth * tileSize/2
-
-    for i in range(len(boxInfoList)):
-        boxInfo=boxInfoList[i]
-        ex=boxInfo.extent
-        polygon = extentToPolygon(ex)
-        distance = polygon.distanceTo(srcPoly)
-        if distance < neighborDis:
-            neighbors.append(boxInfo)
-    return neighbors
-
-
-def splitPolygons(inputFeatures,cellWidth,cellHeight,tileSize,overlapSize,tempWorkSpace,outputPath,multiple=1):
-
-    desc = arcpy.Describe(inputFeatures)
-    spatial_reference = desc.spatialReference
-
-    extents = getExtent(inputFeatures, tempWorkSpace)
-    polygonList = []
-    for ex in extents:
-        width, height = getWidthHeight(ex, cellWidth, cellHeight)
-        center_x, center_y = getCenter(ex)
-        XMin = ex.XMin
-        XMax = ex.XMax
-        YMin = ex.YMin
-        YMax = ex.YMax
-        if width < multiple*tileSize and height < multiple*tileSize:
-            xmin, xmax, ymin, ymax = getBoundry(center_x, center_y, tileSize * cellWidth / 2,
-                                                tileSize * cellHeight / 2)
-            polygonList.append(makePolygon(xmin, xmax, ymin, ymax, spatial_reference))
-
-        elif width > multiple * tileSize and height < multiple * tileSize:
-
-            center_x_right = center_x
-
-            while center_x + tileSize * cellWidth / 2 > XMin:
-                xmin, xmax, ymin, ymax = getBoundry(center_x, center_y, tileSize * cellWidth / 2,
-                                                    tileSize * cellHeight / 2)
-                polygonList.append(makePolygon(xmin, xmax, ymin, ymax, spatial_reference))
-                center_x = center_x - (tileSize - overlapSize) * cellWidth
-
-            center_x_right = center_x_right + (tileSize - overlapSize) * cellWidth
-            while center_x_right - tileSize * cellWidth / 2 < XMax:
-                xmin, xmax, ymin, ymax = getBoundry(center_x_right, center_y, tileSize * cellWidth / 2,
-                                                    tileSize * cellHeight / 2)
-                polygonList.append(makePolygon(xmin, xmax, ymin, ymax, spatial_reference))
-                center_x_right = center_x_right + (tileSize - overlapSize) * cellWidth
-
-        elif width < multiple * tileSize and height > multiple*tileSize:
-
-            center_y_up = center_y
-            while center_y + tileSize * cellHeight / 2 > YMin:
-                xmin, xmax, ymin, ymax = getBoundry(center_x, center_y, tileSize * cellWidth / 2,
-                                                    tileSize * cellHeight / 2)
-                polygonList.append(makePolygon(xmin, xmax, ymin, ymax, spatial_reference))
-                center_y = center_y - (tileSize - overlapSize) * cellHeight
-
-            center_y_up = center_y_up + (tileSize - overlapSize) * cellHeight
-            while center_y_up - tileSize * cellHeight / 2 < YMax:
-                xmin, xmax, ymin, ymax = getBoundry(center_x, center_y_up, tileSize * cellWidth / 2,
-                                                    tileSize * cellHeight / 2)
-                polygonList.append(makePolygon(xmin, xmax, ymin, ymax, spatial_reference))
-                center_y_up = center_y_up + (tileSize - overlapSize) * cellHeight
-
-        else:
-            leftTop_x = XMin + tileSize * cellWidth / 2
-            leftTop_y = YMax - tileSize * cellHeight / 2
-            centerY = leftTop_y
-            centerX = leftTop_x
-            while centerY + tileSize * cellHeight / 2 > YMin:
-                while centerX - tileSize * cellWidth / 2 < XMax:
-                    xmin, xmax, ymin, ymax = getBoundry(centerX, centerY, tileSize * cellWidth / 2,
-                                                        tileSize * cellHeight / 2)
-                    polygonList.append(makePolygon(xmin, xmax, ymin, ymax, spatial_reference))
-                    centerX = centerX + (tileSize - overlapSize) * cellWidth
-                centerY = centerY - (tileSize - overlapSize) * cellHeight
-                centerX = leftTop_x
-
-    polygon_path = outputPath
-    if os.path.exists(polygon_path):
-        arcpy.DeleteFeatures_management(polygon_path)
-    arcpy.CopyFeatures_management(polygonList, polygon_path)
-    return polygon_path
+    if boxIndex is None:
+        boxIndex = boxesIndex(boxTable, cellWidth, tileSize)
+    xmin, ymin, xmax, ymax = srcExtent
+    return boxIndex.query(xmin, ymin, xmax, ymax, neighborDis)
+
+
+def writeExtents(extents, outputPath, spatial_reference):
+    '''
+    write an array (N, 4) of [xmin, ymin, xmax, ymax] as polygons to a new feature class
+    '''
+    if arcpy.Exists(outputPath):
+        arcpy.Delete_management(outputPath)
+    folder, name = os.path.split(outputPath)
+    arcpy.CreateFeatureclass_management(folder, name, 'POLYGON', spatial_reference=spatial_reference)
+    with arcpy.da.InsertCursor(outputPath, ['SHAPE@']) as cursor:
+        for xmin, ymin, xmax, ymax in extents:
+            cursor.insertRow([makePolygon(float(xmin), float(xmax), float(ymin), float(ymax), spatial_reference)])
+    return outputPath
+
+
+def splitPolygons(inputFeatures,cellWidth,cellHeight,tileSize,overlapSize,tempWorkSpace,outputPath=None,multiple=1):
+    '''
+    sliding window tiles over the extents of the features, see Placement.gridTiles
+    :param outputPath: feature class the tiles are written to, when None the array (N, 4) of tile extents is returned
+    '''
+    extents = [[ex.XMin, ex.YMin, ex.XMax, ex.YMax] for ex in getExtent(inputFeatures, tempWorkSpace)]
+    tiles = gridTiles(extents, cellWidth, cellHeight, tileSize, overlapSize, multiple)
+    if outputPath is None:
+        return tiles
+    spatial_reference = arcpy.Describe(inputFeatures).spatialReference
+    return writeExtents(tiles, outputPath, spatial_reference)
 
 
 def classificationPolygons(inputFeatures,cellWidth,cellHeight,tileSize,overlapSize,tempWorkSpace,multiple=1):
@@ -277,7 +237,7 @@ def copyShpfile2(sourceShp,desDir):
                 shutil.copyfile(sourceFile,destinationFile)
 
 def split_large_targets(shpfile, workspace, img_meta_info, args):
-    boxInfoList = []
+    boxTable = BoxTable()
     fields = ['FID', 'SHAPE@', str(args.class_field), 'tempID']
     cell_width = img_meta_info['cell_width']
     cell_height = img_meta_info['cell_height']
@@ -304,17 +264,17 @@ def split_large_targets(shpfile, workspace, img_meta_info, args):
                 clipPolygons = classificationPolygons(tempShp, cell_width, cell_height, tile_size,
                                                          overlap_size, workspace)
                 for polygon in clipPolygons:
-                    boxInfoList.append(BoxInfo(polygon.extent, label, 0))
+                    boxTable.appendExtent(polygon.extent, label, 0)
                 arcpy.Delete_management(tempShp)
             else:
-                boxInfoList.append(BoxInfo(extent, label, 0))
+                boxTable.appendExtent(extent, label, 0)
             pbar.update(1)
     pbar.close()
-    return boxInfoList
+    return boxTable
 
 
 def split_larget_objects(shpfile, workspace, img_meta_info, args):
-    boxInfoList = []
+    boxTable = BoxTable()
     fields = ['FID', 'SHAPE@', str(args.class_field), 'tempID']
     cell_width = img_meta_info['cell_width']
     cell_height = img_meta_info['cell_height']
@@ -338,20 +298,17 @@ def split_larget_objects(shpfile, workspace, img_meta_info, args):
             if not imgPolygon.contains(poly):  # find large target
                 tempShp = 'temp.shp'
                 arcpy.FeatureClassToFeatureClass_conversion(poly, workspace, tempShp)
-                clipPolygon = os.path.join(workspace, 'clipPolygon.shp')
-                splitPolygons(tempShp, cell_width, cell_height, tile_size, overlap_size, workspace, clipPolygon)
-                with arcpy.da.SearchCursor(clipPolygon, ['SHAPE@']) as cursor1:
-                    for r in cursor1:
-                        polygon = r[0]
-                        if poly.contains(polygon) or not poly.disjoint(polygon):
-                            intersectArea = poly.intersect(polygon, 4)
-                            truncated = 1 - intersectArea.getArea() / (poly.getArea())
-                            if truncated < 0: truncated = 0
-                            boxInfo = BoxInfo(intersectArea.extent, label, truncated)
-                            boxInfoList.append(boxInfo)
+                tiles = splitPolygons(tempShp, cell_width, cell_height, tile_size, overlap_size, workspace)
+                for tile in tiles:
+                    xmin, ymin, xmax, ymax = [float(v) for v in tile]
+                    polygon = makePolygon(xmin, xmax, ymin, ymax, spatial_reference)
+                    if poly.contains(polygon) or not poly.disjoint(polygon):
+                        intersectArea = poly.intersect(polygon, 4)
+                        truncated = 1 - intersectArea.getArea() / (poly.getArea())
+                        if truncated < 0: truncated = 0
+                        boxTable.appendExtent(intersectArea.extent, label, truncated)
                 deleteIDs.append(row[0])
                 arcpy.Delete_management(tempShp)
-                arcpy.Delete_management(clipPolygon)
             pbar.set_description("Processing step1")
             pbar.update(1)
     pbar.close()
@@ -368,47 +325,42 @@ def split_larget_objects(shpfile, workspace, img_meta_info, args):
         arcpy.DeleteFeatures_management(input_lyr)
     arcpy.Delete_management(input_lyr)
     boxinfos = getExtentWithClass(shpfile, str(args.class_field), workspace)
-    boxInfoList.extend(boxinfos)
-    return boxInfoList
+    boxTable.extend(boxinfos)
+    return boxTable
 
 
-def get_objects_info(boxInfoList, img_meta_info, geo_transform, args):
+def get_objects_info(boxTable, img_meta_info, geo_transform, args):
+    '''
+    place the tiles and find the boxes around every tile
+    :param boxTable: BoxTable of all objects
+    :return: list of TileBoxes
+    '''
     objectList = []
     cell_width = img_meta_info['cell_width']
     cell_height = img_meta_info['cell_height']
-    spatial_reference = img_meta_info['spatial_reference']
     tile_size = int(args.tile_size)
-    for i in tqdm(range(len(boxInfoList)), desc='Processing step2'):
-        boxInfo = boxInfoList[i]
-        ex = boxInfo.extent
-        center_x, center_y = getCenter(ex)
-        xmin, xmax, ymin, ymax = getBoundry(center_x, center_y, tile_size * cell_width / 2,
-                                               tile_size * cell_height / 2)
-        imgPolygon = makePolygon(xmin, xmax, ymin, ymax, spatial_reference)
-        neighbors = findNeighborBoxes(imgPolygon.extent, boxInfoList, cell_width, tile_size)
-        boxList = []
+    boxes = boxTable.extents()
+    boxIndex = boxesIndex(boxTable, cell_width, tile_size)
+    if args.tile_placement == 'cover':
+        # few tiles which together show every object, only tiles inside the image are samples
+        extent = img_meta_info['extent']
+        tiles, statistics = coverTiles(boxes, tile_size * cell_width, tile_size * cell_height,
+                                       float(args.min_visibility),
+                                       (extent.XMin, extent.YMin, extent.XMax, extent.YMax))
+        arcpy.AddMessage('Tile placement: {} tiles for {} objects ({:.1f}x fewer), {} objects covered, '
+                         '{} fully contained, {} not covered by any tile inside the image'.format(
+                             statistics['tiles'], statistics['objects'], statistics['reduction'],
+                             statistics['covered'], statistics['fully_contained'], statistics['uncovered']))
+    else:
+        # one tile centred on every object
+        tiles = centeredTiles(boxes, tile_size * cell_width, tile_size * cell_height)
+    for i in tqdm(range(len(tiles)), desc='Processing step2'):
+        xmin, ymin, xmax, ymax = [float(v) for v in tiles[i]]
+        neighbors = findNeighborBoxes((xmin, ymin, xmax, ymax), boxTable, cell_width, tile_size, boxIndex)
         if len(neighbors) == 0:
             continue
-        for j in range(len(neighbors)):
-            neigBox = neighbors[j]
-            ext = neigBox.extent
-            value = neigBox.label
-            trunca = neigBox.truncated
-            poly = extentToPolygon(ext)
-            if imgPolygon.contains(poly) or not imgPolygon.disjoint(poly):
-                intersectArea = imgPolygon.intersect(poly, 4)
-                truncated = 1 - intersectArea.getArea() / (poly.getArea())
-                if truncated < 0: truncated = 0
-                if trunca == 0 and truncated != 0:
-                    boxList.append(BoxInfo(intersectArea.extent, value, '{:.3f}'.format(truncated)))
-                elif trunca != 0 and truncated == 0:
-                    boxList.append(BoxInfo(intersectArea.extent, value, '{:.3f}'.format(trunca)))
-                else:
-                    truncated = truncated * trunca
-                    boxList.append(BoxInfo(intersectArea.extent, value, '{:.3f}'.format(truncated)))
-        object = ObjectInfo(imgPolygon.extent, boxList, geo_transform, tile_size)
-        objectInfos = object.getObject()
-        objectList.append(objectInfos)
+        objectList.append(TileBoxes((xmin, ymin, xmax, ymax), boxTable, neighbors.astype(np.int32),
+                                    geo_transform, tile_size))
 
     return objectList
 
@@ -443,3 +395,73 @@ def simplify_polygon(workspace, shpfile, outputFolder, img_meta_info, tile_size,
     arcpy.Delete_management('poly.shp')
     arcpy.Delete_management(gridLyr)
     return gridsPath, matchcount
+
+
+def polygonRings(polygon):
+    '''
+    every ring of an arcpy Polygon, lists of (x, y)
+    '''
+    rings = []
+    for part in polygon:
+        ring = []
+        for point in part:
+            # interior rings are separated by None
+            if point is None:
+                if len(ring) > 0:
+                    rings.append(ring)
+                ring = []
+            else:
+                ring.append((point.X, point.Y))
+        if len(ring) > 0:
+            rings.append(ring)
+    return rings
+
+
+def featureRings(infeatures):
+    '''
+    every ring of the polygons, lists of (x, y)
+    '''
+    with arcpy.da.SearchCursor(infeatures, ['SHAPE@']) as cursor:
+        for row in cursor:
+            if row[0] is None:
+                continue
+            for ring in polygonRings(row[0]):
+                yield ring
+
+
+def labelFeatures(infeatures, valueField):
+    '''
+    the rings and the label value of every polygon, in the order PolygonToRaster_conversion reads them
+    :return: list of (value, rings)
+    '''
+    features = []
+    with arcpy.da.SearchCursor(infeatures, [valueField, 'SHAPE@']) as cursor:
+        for row in cursor:
+            if row[1] is None or row[0] is None:
+                continue
+            try:
+                value = int(row[0])
+            except (TypeError, ValueError):
+                raise Exception('the window label engine requires numeric values in field {}, '
+                                'use the Positive Integer or Custom gray level transformation'.format(valueField))
+            features.append((value, polygonRings(row[1])))
+    return features
+
+
+def occupancy_grids(workspace, shpfile, outputFolder, img_meta_info, tile_size, overlap_size):
+    '''
+    the grids of simplify_polygon from an occupancy bitmap of the labels, without simplify, buffer and overlay
+    '''
+    arcpy.env.workspace = workspace
+    cell_width = img_meta_info['cell_width']
+    cell_height = img_meta_info['cell_height']
+    buffer_dis = cell_width * tile_size / 2
+    extent = arcpy.Describe(shpfile).extent
+    image = img_meta_info['extent']
+    tiles = occupancyTiles(featureRings(shpfile), (extent.XMin, extent.YMin, extent.XMax, extent.YMax),
+                           cell_width, cell_height, tile_size, overlap_size, buffer_dis,
+                           (image.XMin, image.YMin, image.XMax, image.YMax))
+    gridsPath = os.path.join(outputFolder, 'grids.shp')
+    writeExtents(tiles, gridsPath, img_meta_info['spatial_reference'])
+    arcpy.AddMessage('Creating vector grids done !')
+    return gridsPath, len(tiles)
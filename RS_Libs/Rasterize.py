@@ -0,0 +1,76 @@
+# coding=utf-8
+'''
+in memory label rasterization, the label polygons are burnt into every tile window on demand
+instead of rasterizing the whole scene with PolygonToRaster
+'''
+import cv2
+import numpy as np
+
+from RS_Libs.SpatialIndex import GridIndex
+
+
+class FeatureRasterizer(object):
+    '''
+    keep the label polygons with a grid index over their extents, a window only draws the features intersecting it
+    '''
+    def __init__(self, features, geoTransform, cellSize):
+        '''
+        :param features: list of (value, rings), every ring is a sequence of (x, y), holes are rings of the feature too
+        :param geoTransform: GDAL geotransform of the image, windows are snapped to its pixels
+        :param cellSize: cell size of the grid index in map units, eg. the size of a tile
+        '''
+        if geoTransform[2] != 0 or geoTransform[4] != 0:
+            raise Exception('rotated images are not supported by the window label engine')
+        self.geoTransform = tuple(geoTransform)
+        self.values = []
+        self.rings = []
+        extents = []
+        for value, rings in features:
+            rings = [np.asarray(ring, dtype=np.float64).reshape(-1, 2) for ring in rings]
+            rings = [ring for ring in rings if len(ring) > 0]
+            if len(rings) == 0:
+                continue
+            points = np.concatenate(rings)
+            extents.append([points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()])
+            self.values.append(value)
+            self.rings.append(rings)
+        self.values = np.array(self.values, dtype=np.int64)
+        self.dtype = np.uint8
+        if len(self.values) > 0 and (self.values.min() < 0 or self.values.max() > 65535):
+            self.dtype = np.int32
+        elif len(self.values) > 0 and self.values.max() > 255:
+            self.dtype = np.uint16
+        self.index = GridIndex(np.array(extents).reshape(-1, 4), cellSize)
+
+    def window(self, xmin, ymin, xmax, ymax):
+        '''
+        pixel window of the image covering the extent, same rounding as Tiles.TileReader.extentToWindow
+        :return: xoff, yoff, xsize, ysize
+        '''
+        originX, pixelWidth, _, originY, _, pixelHeight = self.geoTransform
+        xoff = int(np.floor((xmin - originX) / pixelWidth + 0.5))
+        yoff = int(np.floor((ymax - originY) / pixelHeight + 0.5))
+        xsize = int(np.floor((xmax - originX) / pixelWidth + 0.5)) - xoff
+        ysize = int(np.floor((ymin - originY) / pixelHeight + 0.5)) - yoff
+        return xoff, yoff, xsize, ysize
+
+    def burn(self, xmin, ymin, xmax, ymax):
+        '''
+        label array of the window covering the extent, 0 where no feature is.
+        overlapping features are drawn in input order, the last one wins
+        '''
+        originX, pixelWidth, _, originY, _, pixelHeight = self.geoTransform
+        xoff, yoff, xsize, ysize = self.window(xmin, ymin, xmax, ymax)
+        label = np.zeros((max(ysize, 0), max(xsize, 0)), dtype=self.dtype)
+        if label.size == 0:
+            return label
+        left = originX + xoff * pixelWidth
+        top = originY + yoff * pixelHeight
+        found = np.sort(self.index.candidates(left, top + ysize * pixelHeight, left + xsize * pixelWidth, top))
+        for i in found:
+            # opencv puts integer coordinates at pixel centres, 4 fractional bits keep the sub pixel position
+            contours = [np.round(np.stack([(ring[:, 0] - left) / pixelWidth - 0.5,
+                                           (ring[:, 1] - top) / pixelHeight - 0.5], axis=1) * 16).astype(np.int32)
+                        for ring in self.rings[i]]
+            cv2.fillPoly(label, contours, int(self.values[i]), lineType=8, shift=4)
+        return label
@@ -5,6 +5,11 @@ import cv2
 import numpy as np
 import shutil
 
+from RS_Libs.Stretch import percentStretch, stdStretch, minmaxStretch, stretchArray
+from RS_Libs.Tiles import checkArray, encodeImage, collectTile
+from RS_Libs.Georeference import readWorldFile, worldFileValues, writeWorldFile, writeSidecars
+from RS_Libs.Writers import submitWrite
+
 
 class GeoTransform():
     def __init__(self, tif_path):
@@ -20,90 +25,16 @@ class GeoTransform():
         return [self.pixelWidth, self.rotateX, self.rotateY, self.pixelHeight, self.originX, self.originY]
 
 def readTransform(tifPath):
+    '''
+    the six world file parameters of an image, from its .tfw if it exists, otherwise from the raster itself
+    '''
     folder, baseName = os.path.split(tifPath)
     name = os.path.splitext(baseName)[0]
     tfw = os.path.join(folder, name + '.tfw')
-    if not os.path.exists(tfw):
-        arcpy.env.workspace = folder
-        arcpy.ExportRasterWorldFile_management(tifPath)
-        arcpy.ResetEnvironments()
-    with open(tfw, 'r') as f:
-        content = f.read().replace("\n", ",").split(",")
-    return content
-
-
-def percentStretch(tifArray, lower_percent=0.5, higher_percent=99.5):
-    '''
-    Percentage Truncation stretch
-    :param tifArray: remote sensing image of numpy format
-    :param lower_percent: The pixels in the bottom lower_percent are assigned 0
-    :param higher_percent: The pixels in the top higher_percent are assigned 255
-    :return: image array range from 0 to 255
-    '''
-    data = tifArray
-    n = data.shape[0]
-    out = np.zeros_like(data, dtype=np.uint8)
-    for i in range(n):
-        a = 0
-        b = 255
-        c = np.percentile(data[i, :, :], lower_percent)
-        d = np.percentile(data[i, :, :], higher_percent)
-        t = a + (data[i, :, :] - c) * (b - a) / (d - c)
-        t[t < a] = a
-        t[t > b] = b
-        out[i, :, :] = t
-    return out
-
+    if os.path.exists(tfw):
+        return readWorldFile(tfw)
+    return worldFileValues(getRasterGeoTransform(tifPath))
 
-def stdStretch(tifArray, multiple=2.5):
-    '''
-    Standard Deviation stretch
-    :param tifArray: remote sensing image of numpy format
-    :param multiple: Multiple of standard deviation, default 2.5
-    :return: image of unsigned int8 (0-255)
-    '''
-    data = tifArray
-    n = data.shape[0]
-    out = np.zeros_like(data, dtype=np.uint8)
-    for i in range(n):
-        band = data[i, :, :]
-        mean = np.mean(band)
-        stdDev = np.std(band, ddof=1)
-        max = mean + multiple * stdDev
-        min = mean - multiple * stdDev
-        k = 255 / (max - min)
-        b = (0 - min * 255) / (max - min)
-        if min <= 0:
-            min = 0
-        band = np.select([band <= min, band >= max, k * band + b < 0,
-                          k * band + b > 255, (k * band + b > 0) & (k * band + b < 255)],
-                         [0, 255, 0, 255, k * band + b], band)
-        out[i, :, :] = band
-    return out
-
-
-def minmaxStretch(tifArray):
-    '''
-    Maximum and Minimum stretch
-    :param tifArray: remote sensing image of numpy format
-    :return:
-    '''
-    data = tifArray
-    n = data.shape[0]
-    out = np.zeros_like(data, dtype=np.uint8)
-    for i in range(n):
-        band = data[i, :, :]
-        min = np.min(band)
-        max = np.max(band)
-        if max == min:
-            out[i, :, :] = band
-        else:
-            k = 255 * 1.0 / (max - min)
-            b = (0 - min * 255) * 1.0 / (max - min)
-            band = np.select([k * band + b < 0, k * band + b > 255, (k * band + b >= 0) & (k * band + b <= 255)],
-                             [0, 255, k * band + b], band)
-            out[i, :, :] = band
-    return out
 
 def checkFile(imgPath):
     legal = True
@@ -124,31 +55,44 @@ def checkFile(imgPath):
 
 
 def generateImg(tag, inputImg, inputFeature, imageDir, splitBands=False, bandsOrder=None, resampling_type=None, labelDir=None, **kwargs):
+    '''
+    :param writer: optional Writers.AsyncWriter, the JPEG and PNG tiles are encoded and the sidecars written
+                   in the background, Clip_management still writes the tif on the main thread
+    '''
+    writer = kwargs.get('writer')
     outTif = os.path.join(imageDir, str(tag).zfill(6) + '.tif')
     arcpy.Clip_management(inputImg, "#", outTif, inputFeature, "0", "None", "MAINTAIN_EXTENT")
     tfw = os.path.join(imageDir, str(tag).zfill(6) + '.tfw')
     label_png, label_pgw = '', ''
-    if not os.path.exists(tfw):
-        arcpy.env.workspace = imageDir
-        arcpy.ExportRasterWorldFile_management(outTif)
+    geoTransform = getRasterGeoTransform(outTif)
+    projection = None
+    if kwargs.get('write_aux'):
+        projection = arcpy.Describe(outTif).spatialReference.exportToString().split(';')[0]
     if splitBands:
         split_rgb_bands(imageDir, outTif, bandsOrder)
     if labelDir is not None:
         label_png = os.path.join(labelDir, str(tag).zfill(6) + '.png')
         label_pgw = os.path.join(labelDir, str(tag).zfill(6) + '.pgw')
-        shutil.copy(tfw, label_pgw)
-    if not checkFile(outTif):
+    isTiff = kwargs['output_img_format'] in ['TIFF', 'TIF', 'tiff', 'tif']
+    # JPEG and PNG tiles are checked in memory by stretch_tif
+    if isTiff and not checkFile(outTif):
         arcpy.Delete_management(outTif)
-        if labelDir is not None:
-            if os.path.exists(label_pgw):
-                os.remove(label_pgw)
-            if os.path.exists(label_png):
-                os.remove(label_png)
+        if labelDir is not None and os.path.exists(label_png):
+            os.remove(label_png)
         return False, ''
     if resampling_type is not None:
         resample(outTif, kwargs['tile_size'], resampling_type)
-    if kwargs['output_img_format'] in ['TIFF', 'TIF', 'tiff', 'tif']:
+        geoTransform = getRasterGeoTransform(outTif)
+    if isTiff:
+        if kwargs.get('band_statistics') is not None or kwargs.get('array_store') is not None:
+            collectTile(arcpy.RasterToNumPyArray(outTif), geoTransform, **kwargs)
+        # the .aux.xml arcpy leaves with the clipped tif is replaced by ours or removed like before
+        if os.path.exists(outTif + '.aux.xml'):
+            os.remove(outTif + '.aux.xml')
         removeTempFiles(imageDir)
+        submitWrite(writer, tfw, writeSidecars, outTif, geoTransform, projection, tfw)
+        if labelDir is not None:
+            submitWrite(writer, label_pgw, writeSidecars, label_png, geoTransform, projection, label_pgw)
         return True, outTif
     if kwargs['output_img_format'] in ['JPEG', 'jpg']:
         outputImg = os.path.join(imageDir, str(tag).zfill(6) + '.jpg')
@@ -156,25 +100,21 @@ def generateImg(tag, inputImg, inputFeature, imageDir, splitBands=False, bandsOr
     else:
         outputImg = os.path.join(imageDir, str(tag).zfill(6) + '.png')
         outputGeo = os.path.join(imageDir, str(tag).zfill(6) + '.pgw')
-    stretch_tif(imageDir, outTif, outputImg,
-                stretch_method=kwargs['stretch_method'],
-                stretch_parameters=kwargs['stretch_parameters'])
-    tfw = str(tag).zfill(6) + '.tfw'
-    if not os.path.exists(os.path.join(imageDir, tfw)):
-        arcpy.env.workspace = imageDir
-        arcpy.ExportRasterWorldFile_management(outTif)
-    shutil.copy(os.path.join(imageDir, tfw), outputGeo)
+    legal = stretch_tif(imageDir, outTif, outputImg,
+                        stretch_method=kwargs['stretch_method'],
+                        stretch_parameters=kwargs['stretch_parameters'],
+                        cut_points=kwargs.get('cut_points'), geoTransform=geoTransform,
+                        band_statistics=kwargs.get('band_statistics'), array_store=kwargs.get('array_store'),
+                        writer=writer)
     arcpy.Delete_management(outTif)
     removeTempFiles(imageDir)
-    if not checkFile(outputImg):
-        os.remove(outputImg)
-        os.remove(outputGeo)
-        if labelDir is not None:
-            if os.path.exists(label_pgw):
-                os.remove(label_pgw)
-            if os.path.exists(label_png):
-                os.remove(label_png)
+    if not legal:
+        if labelDir is not None and os.path.exists(label_png):
+            os.remove(label_png)
         return False, ''
+    submitWrite(writer, outputGeo, writeSidecars, outputImg, geoTransform, projection, outputGeo)
+    if labelDir is not None:
+        submitWrite(writer, label_pgw, writeSidecars, label_png, geoTransform, projection, label_pgw)
     return True, outputImg
 
 
@@ -226,34 +166,35 @@ def get_raster_info(raster_path):
     return info_dict
 
 
-def stretch_tif(imageDir, outTif, outputImg, stretch_method=0, stretch_parameters=None):
+def getRasterGeoTransform(raster_path):
+    '''
+    GDAL style geotransform of a north up raster
+    '''
+    raster = arcpy.Raster(raster_path)
+    extent = raster.extent
+    return (extent.XMin, raster.meanCellWidth, 0.0, extent.YMax, 0.0, -raster.meanCellHeight)
+
+
+def stretch_tif(imageDir, outTif, outputImg, stretch_method=0, stretch_parameters=None, cut_points=None,
+                geoTransform=None, **kwargs):
+    '''
+    stretch the tile and encode it to JPEG or PNG directly,
+    return False without writing anything if the tile or the stretched tile is of a single value
+    :param kwargs: optional band_statistics and array_store the stretched tile is handed to, see Tiles.collectTile,
+                   and an optional writer, Writers.AsyncWriter the tile is encoded by
+    '''
     arcpy.env.workspace = imageDir
-    my_array = arcpy.RasterToNumPyArray(outTif)  #
-    min = np.min(my_array)
-    max = np.max(my_array)
-    if stretch_parameters == '' or stretch_parameters == 0:
-        stretch_parameters = None
-    # default is Percentage Truncation stretch
-    stretch = percentStretch(my_array)
-    if stretch_method == 0:  # Percentage Truncation
-        if stretch_parameters is not None:
-            stretchParameters = stretch_parameters.split(',')
-            stretchParameters.sort()
-            stretchPercentMin = float(stretchParameters[0])
-            stretchPercentMax = float(stretchParameters[1])
-            stretch = percentStretch(my_array, stretchPercentMin, stretchPercentMax)
-    if stretch_method == 1:  # Standard Deviation
-        if stretch_parameters is not None:
-            stdDevStretch = float(stretch_parameters)
-            stretch = stdStretch(my_array, stdDevStretch)
-        else:
-            stretch = stdStretch(my_array)  # default is 2.5
-    if stretch_method == 2:  # Maximum and Minimum
-        stretch = minmaxStretch(my_array)
-    new_raster = arcpy.NumPyArrayToRaster(stretch)
-    arcpy.CopyRaster_management(new_raster, outputImg, "DEFAULTS", "0", "0", "", "",
-                                "8_BIT_UNSIGNED")
-    arcpy.Delete_management(new_raster)
+    my_array = arcpy.RasterToNumPyArray(outTif)
+    if my_array.ndim == 2:
+        my_array = my_array[np.newaxis, :, :]
+    if not checkArray(my_array):
+        return False
+    stretch = stretchArray(my_array, stretch_method, stretch_parameters, cut_points)
+    if not checkArray(stretch):
+        return False
+    collectTile(stretch, geoTransform, **kwargs)
+    submitWrite(kwargs.get('writer'), outputImg, encodeImage, outputImg, stretch)
+    return True
 
 
 def removeTempFiles(imageDir):
@@ -263,5 +204,8 @@ def removeTempFiles(imageDir):
         else:
             extensions = ['.jpg', '.png', '.jgw', '.pgw', '.tif', '.tfw']
             _, extension = os.path.splitext(file)
+            # the .aux.xml of a kept sample, written with --write-aux
+            if file.endswith('.aux.xml') and os.path.splitext(file[:-len('.aux.xml')])[1] in extensions:
+                continue
             if not extension in extensions:
                 os.remove(os.path.join(imageDir, file))
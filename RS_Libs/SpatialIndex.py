@@ -0,0 +1,81 @@
+# coding=utf-8
+'''
+spatial index over axis aligned boxes, replaces the pairwise arcpy distanceTo in neighbour searches
+'''
+import numpy as np
+
+
+def rectDistance(boxes, xmin, ymin, xmax, ymax):
+    '''
+    euclidean distance between the boxes (N, 4) [xmin, ymin, xmax, ymax] and a rectangle,
+    0 when they touch or overlap, same as arcpy Polygon.distanceTo for rectangles
+    '''
+    dx = np.maximum(np.maximum(boxes[:, 0] - xmax, xmin - boxes[:, 2]), 0)
+    dy = np.maximum(np.maximum(boxes[:, 1] - ymax, ymin - boxes[:, 3]), 0)
+    return np.sqrt(dx * dx + dy * dy)
+
+
+class GridIndex():
+    '''
+    uniform grid hash over box extents. every box is hashed into the cell of its lower left corner,
+    a query visits the cells of the searched window widened by the largest box size,
+    one binary search per row of cells
+    '''
+    def __init__(self, boxes, cellSize):
+        '''
+        :param boxes: array (N, 4) of [xmin, ymin, xmax, ymax]
+        :param cellSize: grid cell size in map units, about the query window size works best
+        '''
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.cellSize = float(cellSize)
+        if self.cellSize <= 0:
+            raise Exception('cell size of the grid index must be positive')
+        if len(self.boxes) == 0:
+            self.order = np.zeros(0, dtype=np.int64)
+            self.keys = np.zeros(0, dtype=np.int64)
+            return
+        self.originX = self.boxes[:, 0].min()
+        self.originY = self.boxes[:, 1].min()
+        self.maxWidth = (self.boxes[:, 2] - self.boxes[:, 0]).max()
+        self.maxHeight = (self.boxes[:, 3] - self.boxes[:, 1]).max()
+        cols = np.floor((self.boxes[:, 0] - self.originX) / self.cellSize).astype(np.int64)
+        rows = np.floor((self.boxes[:, 1] - self.originY) / self.cellSize).astype(np.int64)
+        self.cols = int(cols.max()) + 1
+        self.rows = int(rows.max()) + 1
+        keys = rows * self.cols + cols
+        self.order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def candidates(self, xmin, ymin, xmax, ymax):
+        '''
+        indices of the boxes whose lower left corner falls in the cells that may hold
+        a box intersecting the window
+        '''
+        if len(self.boxes) == 0:
+            return self.order
+        col0 = int(np.floor((xmin - self.maxWidth - self.originX) / self.cellSize))
+        col1 = int(np.floor((xmax - self.originX) / self.cellSize))
+        row0 = int(np.floor((ymin - self.maxHeight - self.originY) / self.cellSize))
+        row1 = int(np.floor((ymax - self.originY) / self.cellSize))
+        col0, col1 = max(col0, 0), min(col1, self.cols - 1)
+        row0, row1 = max(row0, 0), min(row1, self.rows - 1)
+        if col0 > col1 or row0 > row1:
+            return np.zeros(0, dtype=np.int64)
+        starts = np.arange(row0, row1 + 1, dtype=np.int64) * self.cols
+        lo = np.searchsorted(self.keys, starts + col0, side='left')
+        hi = np.searchsorted(self.keys, starts + col1, side='right')
+        return np.concatenate([self.order[l:h] for l, h in zip(lo, hi)])
+
+    def query(self, xmin, ymin, xmax, ymax, distance=0.0):
+        '''
+        indices of the boxes closer than distance to the rectangle, in input order
+        '''
+        found = self.candidates(xmin - distance, ymin - distance, xmax + distance, ymax + distance)
+        if len(found) == 0:
+            return found
+        found = np.sort(found)
+        dist = rectDistance(self.boxes[found], xmin, ymin, xmax, ymax)
+        return found[dist < distance]
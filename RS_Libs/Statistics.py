@@ -0,0 +1,215 @@
+# coding=utf-8
+'''
+class balance statistics collected with np.bincount while the samples are generated,
+so the class frequencies do not need another pass over the output folders
+'''
+import json
+import numpy as np
+
+# object sizes are binned by the square root of the box area in pixels, the last bin is open
+SIZE_BINS = [0, 8, 16, 32, 64, 128, 256, 512]
+
+
+def growCounts(counts, size):
+    '''
+    pad the first axis of a count array with zeros up to size
+    '''
+    if counts.shape[0] >= size:
+        return counts
+    grown = np.zeros((size,) + counts.shape[1:], dtype=counts.dtype)
+    grown[:counts.shape[0]] = counts
+    return grown
+
+
+class PixelCounts():
+    '''
+    pixels and tiles of every gray level of the label tiles, for semantic segmentation
+    '''
+    def __init__(self):
+        self.samples = 0
+        self.pixels = np.zeros(0, dtype=np.int64)
+        self.tiles = np.zeros(0, dtype=np.int64)
+
+    def add(self, labelArray):
+        counts = np.bincount(np.asarray(labelArray).ravel(), minlength=len(self.pixels))
+        self.pixels = growCounts(self.pixels, len(counts))
+        self.tiles = growCounts(self.tiles, len(counts))
+        self.pixels += counts
+        self.tiles += counts > 0
+        self.samples += 1
+
+    def merge(self, other):
+        self.pixels = growCounts(self.pixels, len(other.pixels))
+        self.tiles = growCounts(self.tiles, len(other.tiles))
+        self.pixels[:len(other.pixels)] += other.pixels
+        self.tiles[:len(other.tiles)] += other.tiles
+        self.samples += other.samples
+
+    def summary(self, names=None):
+        '''
+        :param names: optional dict of gray level to class name
+        '''
+        total = max(int(self.pixels.sum()), 1)
+        classes = []
+        for value in np.nonzero(self.pixels)[0]:
+            classes.append({'value': int(value),
+                            'name': names.get(int(value), int(value)) if names else int(value),
+                            'pixels': int(self.pixels[value]),
+                            'tiles': int(self.tiles[value]),
+                            'frequency': float(self.pixels[value]) / total})
+        return {'type': 'semantic segmentation', 'samples': self.samples, 'classes': classes}
+
+
+class ClassCounts():
+    '''
+    objects and tiles of every class, and a histogram of the object sizes,
+    for object detection and classification
+    '''
+    def __init__(self):
+        self.samples = 0
+        self.names = []
+        self.ids = {}
+        self.objects = np.zeros(0, dtype=np.int64)
+        self.tiles = np.zeros(0, dtype=np.int64)
+        self.sizes = np.zeros((0, len(SIZE_BINS)), dtype=np.int64)
+
+    def classId(self, name):
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+    def add(self, labels, sizes=None):
+        '''
+        :param labels: class of every object of a sample
+        :param sizes: optional square root of the area in pixels of every object
+        '''
+        ids = np.array([self.classId(label) for label in labels], dtype=np.int64)
+        classes = len(self.names)
+        counts = np.bincount(ids, minlength=classes)
+        self.objects = growCounts(self.objects, classes) + counts
+        self.tiles = growCounts(self.tiles, classes) + (counts > 0)
+        self.sizes = growCounts(self.sizes, classes)
+        if sizes is not None and len(ids) > 0:
+            bins = np.clip(np.digitize(sizes, SIZE_BINS) - 1, 0, len(SIZE_BINS) - 1)
+            self.sizes += np.bincount(ids * len(SIZE_BINS) + bins,
+                                      minlength=classes * len(SIZE_BINS)).reshape(classes, len(SIZE_BINS))
+        self.samples += 1
+
+    def merge(self, other):
+        ids = np.array([self.classId(name) for name in other.names], dtype=np.int64)
+        classes = len(self.names)
+        self.objects = growCounts(self.objects, classes)
+        self.tiles = growCounts(self.tiles, classes)
+        self.sizes = growCounts(self.sizes, classes)
+        if len(ids) > 0:
+            self.objects[ids] += other.objects
+            self.tiles[ids] += other.tiles
+            self.sizes[ids] += other.sizes
+        self.samples += other.samples
+
+    def summary(self, kind='object detection'):
+        total = max(int(self.objects.sum()), 1)
+        classes = []
+        for i in range(len(self.names)):
+            item = {'name': self.names[i], 'objects': int(self.objects[i]), 'tiles': int(self.tiles[i]),
+                    'frequency': float(self.objects[i]) / total}
+            if self.sizes[i].sum() > 0:
+                item['size_histogram'] = [int(v) for v in self.sizes[i]]
+            classes.append(item)
+        result = {'type': kind, 'samples': self.samples, 'classes': classes}
+        if self.sizes.sum() > 0:
+            result['size_bins'] = SIZE_BINS
+        return result
+
+
+def writeStatistics(jsonPath, summary):
+    with open(jsonPath, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+
+class BandMoments():
+    '''
+    per band count, mean and M2 of the tile pixels. every tile is folded in with the pairwise update
+    of Welford's algorithm (Chan et al.), so the accumulators of worker processes merge exactly
+    '''
+    def __init__(self, histogram=False):
+        '''
+        :param histogram: also count the values of 8 and 16 bit unsigned tiles per band
+        '''
+        self.histogram = histogram
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.counts = None
+
+    def combine(self, count, mean, m2):
+        if count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean.copy(), m2.copy()
+            return
+        if len(mean) != len(self.mean):
+            raise Exception('band count of the tiles is not the same')
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count * 1.0 / total)
+        self.m2 = self.m2 + m2 + delta * delta * (self.count * 1.0 * count / total)
+        self.count = total
+
+    def combineCounts(self, counts):
+        if self.counts is None:
+            self.counts = counts.copy()
+            return
+        bins = max(self.counts.shape[1], counts.shape[1])
+        merged = np.zeros((self.counts.shape[0], bins), dtype=np.int64)
+        merged[:, :self.counts.shape[1]] += self.counts
+        merged[:, :counts.shape[1]] += counts
+        self.counts = merged
+
+    def add(self, tileArray):
+        '''
+        :param tileArray: tile of shape (bands, rows, cols) or (rows, cols)
+        '''
+        tile = np.asarray(tileArray)
+        if tile.ndim == 2:
+            tile = tile[np.newaxis, :, :]
+        values = tile.reshape(tile.shape[0], -1)
+        if values.shape[1] == 0:
+            return
+        mean = values.mean(axis=1, dtype=np.float64)
+        centered = values - mean[:, np.newaxis]
+        self.combine(values.shape[1], mean, np.einsum('ij,ij->i', centered, centered))
+        if self.histogram and tile.dtype in [np.uint8, np.uint16]:
+            bins = 256 if tile.dtype == np.uint8 else 65536
+            self.combineCounts(np.stack([np.bincount(band, minlength=bins) for band in values]))
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self.combine(other.count, other.mean, other.m2)
+        if other.counts is not None:
+            self.combineCounts(other.counts)
+
+    def summary(self):
+        if self.count == 0:
+            return {'pixels': 0, 'bands': []}
+        variance = self.m2 / self.count
+        bands = []
+        for i in range(len(self.mean)):
+            band = {'band': i + 1, 'mean': float(self.mean[i]), 'std': float(np.sqrt(variance[i])),
+                    'variance': float(variance[i])}
+            if self.counts is not None:
+                band['histogram'] = [int(v) for v in self.counts[i]]
+            bands.append(band)
+        return {'pixels': int(self.count), 'bands': bands}
+
+
+def makeBandMoments(method):
+    '''
+    :param method: none, moments or histogram
+    :return: BandMoments, None when no band statistics are collected
+    '''
+    if method == 'none':
+        return None
+    return BandMoments(histogram=method == 'histogram')
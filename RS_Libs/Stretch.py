@@ -0,0 +1,315 @@
+# coding=utf-8
+'''
+Band stretching of remote sensing images, only depends on numpy
+'''
+import os
+import json
+import numpy as np
+
+
+def lookupTableRange(dtype):
+    '''
+    offset and size of the value range of 8 and 16 bit integer types,
+    None for the data types which are not stretched with a lookup table
+    '''
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2:
+        offset = int(np.iinfo(dtype).min)
+        return offset, int(np.iinfo(dtype).max) - offset + 1
+    return None
+
+
+def bandHistogram(band, offset, size):
+    if offset == 0:
+        return np.bincount(band.ravel(), minlength=size)
+    return np.bincount((band.astype(np.int32) - offset).ravel(), minlength=size)
+
+
+def applyLookupTable(band, lut, offset):
+    '''
+    map every pixel through the lookup table with one gather
+    '''
+    if offset == 0:
+        return lut[band]
+    return lut[band.astype(np.int32) - offset]
+
+
+def percentMapping(band, c, d):
+    a = 0
+    b = 255
+    t = a + (band - c) * (b - a) / (d - c)
+    t[t < a] = a
+    t[t > b] = b
+    return t
+
+
+def stdMapping(band, mean, stdDev, multiple):
+    max = mean + multiple * stdDev
+    min = mean - multiple * stdDev
+    k = 255 / (max - min)
+    b = (0 - min * 255) / (max - min)
+    if min <= 0:
+        min = 0
+    return np.select([band <= min, band >= max, k * band + b < 0,
+                      k * band + b > 255, (k * band + b > 0) & (k * band + b < 255)],
+                     [0, 255, 0, 255, k * band + b], band)
+
+
+def minmaxMapping(band, min, max):
+    if max == min:
+        return band
+    k = 255 * 1.0 / (max - min)
+    b = (0 - min * 255) * 1.0 / (max - min)
+    return np.select([k * band + b < 0, k * band + b > 255, (k * band + b >= 0) & (k * band + b <= 255)],
+                     [0, 255, k * band + b], band)
+
+
+def percentStretch(tifArray, lower_percent=0.5, higher_percent=99.5):
+    '''
+    Percentage Truncation stretch,
+    8 and 16 bit integer bands are stretched with a histogram and a lookup table
+    :param tifArray: remote sensing image of numpy format
+    :param lower_percent: The pixels in the bottom lower_percent are assigned 0
+    :param higher_percent: The pixels in the top higher_percent are assigned 255
+    :return: image array range from 0 to 255
+    '''
+    data = tifArray
+    n = data.shape[0]
+    out = np.zeros_like(data, dtype=np.uint8)
+    lutRange = lookupTableRange(data.dtype)
+    for i in range(n):
+        if lutRange is not None:
+            offset, size = lutRange
+            hist = bandHistogram(data[i, :, :], offset, size)
+            c = histogramPercentile(hist, offset, lower_percent)
+            d = histogramPercentile(hist, offset, higher_percent)
+            values = np.arange(size, dtype=np.float64) + offset
+            lut = percentMapping(values, c, d).astype(np.uint8)
+            out[i, :, :] = applyLookupTable(data[i, :, :], lut, offset)
+        else:
+            c = np.percentile(data[i, :, :], lower_percent)
+            d = np.percentile(data[i, :, :], higher_percent)
+            out[i, :, :] = percentMapping(data[i, :, :], c, d)
+    return out
+
+
+def stdStretch(tifArray, multiple=2.5):
+    '''
+    Standard Deviation stretch,
+    8 and 16 bit integer bands are stretched with a histogram and a lookup table
+    :param tifArray: remote sensing image of numpy format
+    :param multiple: Multiple of standard deviation, default 2.5
+    :return: image of unsigned int8 (0-255)
+    '''
+    data = tifArray
+    n = data.shape[0]
+    out = np.zeros_like(data, dtype=np.uint8)
+    lutRange = lookupTableRange(data.dtype)
+    for i in range(n):
+        band = data[i, :, :]
+        if lutRange is not None:
+            offset, size = lutRange
+            mean, stdDev = histogramMeanStd(bandHistogram(band, offset, size), offset)
+            values = np.arange(size, dtype=np.float64) + offset
+            lut = stdMapping(values, mean, stdDev, multiple).astype(np.uint8)
+            out[i, :, :] = applyLookupTable(band, lut, offset)
+        else:
+            mean = np.mean(band)
+            stdDev = np.std(band, ddof=1)
+            out[i, :, :] = stdMapping(band, mean, stdDev, multiple)
+    return out
+
+
+def minmaxStretch(tifArray):
+    '''
+    Maximum and Minimum stretch,
+    8 and 16 bit integer bands are stretched with a lookup table
+    :param tifArray: remote sensing image of numpy format
+    :return:
+    '''
+    data = tifArray
+    n = data.shape[0]
+    out = np.zeros_like(data, dtype=np.uint8)
+    lutRange = lookupTableRange(data.dtype)
+    for i in range(n):
+        band = data[i, :, :]
+        # python numbers, the integer scalars of the band overflow in min * 255
+        min = np.min(band).item()
+        max = np.max(band).item()
+        if lutRange is not None:
+            offset, size = lutRange
+            values = np.arange(size, dtype=np.float64) + offset
+            lut = minmaxMapping(values, min, max).astype(np.uint8)
+            out[i, :, :] = applyLookupTable(band, lut, offset)
+        else:
+            out[i, :, :] = minmaxMapping(band, min, max)
+    return out
+
+
+def parseStretchParameters(stretch_method=0, stretch_parameters=None):
+    if stretch_parameters == '' or stretch_parameters == 0:
+        stretch_parameters = None
+    if stretch_method == 1:
+        if stretch_parameters is None:
+            return (2.5,)
+        return (float(stretch_parameters),)
+    if stretch_method == 2:
+        return ()
+    if stretch_parameters is None:
+        return (0.5, 99.5)
+    stretchParameters = stretch_parameters.split(',')
+    stretchParameters.sort()
+    return float(stretchParameters[0]), float(stretchParameters[1])
+
+
+def stretchArray(tifArray, stretch_method=0, stretch_parameters=None, cutPoints=None):
+    '''
+    stretch an image array of shape (bands, rows, cols) to unsigned int8
+    :param stretch_method: 0,Percentage Truncation; 1,Standard Deviation; 2,Maximum and Minimum
+    :param stretch_parameters: eg. "0.5,99.5" for Percentage Truncation, "2.5" for Standard Deviation
+    :param cutPoints: scene cut points from getSceneCutPoints, the tile statistics are used if None
+    '''
+    if cutPoints is not None:
+        return cutPointsStretch(tifArray, cutPoints)
+    stretch_parameters = parseStretchParameters(stretch_method, stretch_parameters)
+    if stretch_method == 1:  # Standard Deviation
+        return stdStretch(tifArray, stretch_parameters[0])
+    if stretch_method == 2:  # Maximum and Minimum
+        return minmaxStretch(tifArray)
+    # default is Percentage Truncation stretch
+    return percentStretch(tifArray, stretch_parameters[0], stretch_parameters[1])
+
+
+def histogramPercentile(hist, offset, percent):
+    '''
+    percentile of integer data from its histogram, same as np.percentile with linear interpolation
+    :param hist: pixel counts of values offset, offset + 1, ...
+    '''
+    cumsum = np.cumsum(hist)
+    rank = percent / 100.0 * (cumsum[-1] - 1)
+    lower = int(np.floor(rank))
+    upper = int(np.ceil(rank))
+    lowerValue = np.searchsorted(cumsum, lower, side='right') + offset
+    upperValue = np.searchsorted(cumsum, upper, side='right') + offset
+    return lowerValue + (rank - lower) * (upperValue - lowerValue)
+
+
+def histogramMeanStd(hist, offset):
+    '''
+    mean and standard deviation (ddof=1) of integer data from its histogram
+    '''
+    values = np.arange(len(hist), dtype=np.float64) + offset
+    count = float(np.sum(hist))
+    mean = np.sum(values * hist) / count
+    stdDev = np.sqrt(np.sum(hist * (values - mean) ** 2) / (count - 1))
+    return mean, stdDev
+
+
+def histogramCutPoints(hist, offset, stretch_method=0, stretch_parameters=None):
+    '''
+    the lower and upper value of a band mapped to 0 and 255, computed from its histogram
+    '''
+    stretch_parameters = parseStretchParameters(stretch_method, stretch_parameters)
+    if stretch_method == 1:
+        mean, stdDev = histogramMeanStd(hist, offset)
+        return mean - stretch_parameters[0] * stdDev, mean + stretch_parameters[0] * stdDev
+    if stretch_method == 2:
+        nonzero = np.nonzero(hist)[0]
+        return nonzero[0] + offset, nonzero[-1] + offset
+    return (histogramPercentile(hist, offset, stretch_parameters[0]),
+            histogramPercentile(hist, offset, stretch_parameters[1]))
+
+
+def arrayCutPoints(band, stretch_method=0, stretch_parameters=None):
+    '''
+    the lower and upper value of a band mapped to 0 and 255, computed from its pixels
+    '''
+    stretch_parameters = parseStretchParameters(stretch_method, stretch_parameters)
+    if stretch_method == 1:
+        mean = np.mean(band)
+        stdDev = np.std(band, ddof=1)
+        return mean - stretch_parameters[0] * stdDev, mean + stretch_parameters[0] * stdDev
+    if stretch_method == 2:
+        return np.min(band), np.max(band)
+    return (np.percentile(band, stretch_parameters[0]),
+            np.percentile(band, stretch_parameters[1]))
+
+
+def cutPointsStretch(tifArray, cutPoints):
+    '''
+    linear stretch with fixed cut points, used to give every tile of a scene the same radiometry
+    :param cutPoints: [(lower, upper), ...] for each band, lower is mapped to 0 and upper to 255
+    '''
+    n = tifArray.shape[0]
+    out = np.zeros_like(tifArray, dtype=np.uint8)
+    lutRange = lookupTableRange(tifArray.dtype)
+    for i in range(n):
+        lower, upper = float(cutPoints[i][0]), float(cutPoints[i][1])
+        band = tifArray[i, :, :]
+        if lutRange is not None:
+            offset, size = lutRange
+            band = np.arange(size, dtype=np.float64) + offset
+        if upper <= lower:
+            t = np.where(band > lower, 255, 0)
+        else:
+            t = (band.astype(np.float64) - lower) * (255.0 / (upper - lower))
+            np.clip(t, 0, 255, out=t)
+        if lutRange is not None:
+            out[i, :, :] = applyLookupTable(tifArray[i, :, :], t.astype(np.uint8), offset)
+        else:
+            out[i, :, :] = t
+    return out
+
+
+def computeSceneCutPoints(reader, stretch_method=0, stretch_parameters=None, maxPixels=16777216):
+    '''
+    compute the cut points of every band once for the whole scene.
+    8 and 16 bit integer images are accumulated into exact histograms strip by strip,
+    other data types are estimated from a decimated read of at most maxPixels pixels per band
+    :param reader: Tiles.TileReader of the source image
+    '''
+    lutRange = lookupTableRange(reader.dtype)
+    if lutRange is not None:
+        offset, size = lutRange
+        hists = [np.zeros(size, dtype=np.int64) for _ in reader.bandsOrder]
+        stripRows = max(1, maxPixels // reader.width)
+        for yoff in range(0, reader.height, stripRows):
+            rows = min(stripRows, reader.height - yoff)
+            strip = reader.readWindow(0, yoff, reader.width, rows)
+            for i in range(strip.shape[0]):
+                hists[i] += bandHistogram(strip[i], offset, size)
+        return [histogramCutPoints(hist, offset, stretch_method, stretch_parameters) for hist in hists]
+    scale = min(1.0, np.sqrt(maxPixels * 1.0 / (reader.width * reader.height)))
+    sample = reader.readOverview(max(1, int(reader.width * scale)), max(1, int(reader.height * scale)))
+    return [arrayCutPoints(sample[i], stretch_method, stretch_parameters) for i in range(sample.shape[0])]
+
+
+def getSceneCutPoints(reader, stretch_method=0, stretch_parameters=None, cachePath=None):
+    '''
+    scene cut points cached in a json sidecar of the image,
+    keyed by image path, modification time and band list
+    '''
+    if cachePath is None:
+        cachePath = os.path.splitext(reader.imgPath)[0] + '.stretch.json'
+    imageKey = '{}|{}|{}'.format(os.path.abspath(reader.imgPath), os.path.getmtime(reader.imgPath),
+                                 ','.join(map(str, reader.bandsOrder)))
+    stretchKey = '{}|{}'.format(stretch_method, ','.join(map(str, parseStretchParameters(stretch_method,
+                                                                                       stretch_parameters))))
+    cache = {}
+    if os.path.exists(cachePath):
+        try:
+            with open(cachePath, 'r') as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+    if imageKey in cache and stretchKey in cache[imageKey]:
+        return cache[imageKey][stretchKey]
+    cutPoints = computeSceneCutPoints(reader, stretch_method, stretch_parameters)
+    cutPoints = [[float(lower), float(upper)] for lower, upper in cutPoints]
+    cache.setdefault(imageKey, {})[stretchKey] = cutPoints
+    try:
+        with open(cachePath, 'w') as f:
+            json.dump(cache, f, indent=2)
+    except (IOError, OSError):
+        pass
+    return cutPoints
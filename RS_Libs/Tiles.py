@@ -0,0 +1,218 @@
+# coding=utf-8
+'''
+GDAL based tile engine. The source image is opened once and every tile is served as a window read,
+clipping, band selection, resampling, stretch and encode are done in memory without arcpy
+'''
+import os
+import cv2
+import numpy as np
+
+from RS_Libs.Stretch import stretchArray, getSceneCutPoints
+from RS_Libs.Writers import submitWrite
+from RS_Libs.Georeference import invertGeoTransform, applyGeoTransform, windowGeoTransform, \
+    worldFileExtension, writeSidecars
+
+try:
+    from osgeo import gdal, gdal_array
+except ImportError:
+    gdal = None
+
+
+def getBounds(extent):
+    '''
+    :param extent: arcpy Extent or (xmin, ymin, xmax, ymax)
+    :return: xmin, ymin, xmax, ymax
+    '''
+    if hasattr(extent, 'XMin'):
+        return extent.XMin, extent.YMin, extent.XMax, extent.YMax
+    xmin, ymin, xmax, ymax = extent
+    return xmin, ymin, xmax, ymax
+
+
+def checkArray(tifArray):
+    return tifArray.size > 0 and tifArray.min() != tifArray.max()
+
+
+def resampleArray(tifArray, tileSize, resample):
+    # 0,Nearest; 1,Bilinear; 2,Cubic
+    methods = {0: cv2.INTER_NEAREST, 1: cv2.INTER_LINEAR, 2: cv2.INTER_CUBIC}
+    method = methods[int(resample)]
+    out = np.empty((tifArray.shape[0], tileSize, tileSize), dtype=tifArray.dtype)
+    for i in range(tifArray.shape[0]):
+        out[i, :, :] = cv2.resize(tifArray[i, :, :], (tileSize, tileSize), interpolation=method)
+    return out
+
+
+def encodeImage(imgPath, tifArray):
+    '''
+    write an unsigned int8 array of shape (bands, rows, cols) as JPEG or PNG
+    '''
+    if tifArray.shape[0] == 1:
+        img = tifArray[0, :, :]
+    else:
+        # opencv expects the first three channels in BGR order
+        order = [2, 1, 0] + list(range(3, tifArray.shape[0]))
+        img = tifArray[order, :, :].transpose(1, 2, 0)
+    cv2.imwrite(imgPath, np.ascontiguousarray(img))
+
+
+def collectTile(tileArray, geoTransform, **kwargs):
+    '''
+    hand the array of a written tile to the optional band_statistics and array_store of the generator
+    '''
+    if kwargs.get('band_statistics') is not None:
+        kwargs['band_statistics'].add(tileArray)
+    if kwargs.get('array_store') is not None:
+        kwargs['array_store'].stage(tileArray, geoTransform)
+
+
+def writeGeoTiff(tifPath, tifArray, geoTransform, projection):
+    driver = gdal.GetDriverByName('GTiff')
+    bands, rows, cols = tifArray.shape
+    dataType = gdal_array.NumericTypeCodeToGDALTypeCode(tifArray.dtype.type)
+    outDataset = driver.Create(tifPath, cols, rows, bands, dataType)
+    outDataset.SetGeoTransform(geoTransform)
+    outDataset.SetProjection(projection)
+    for i in range(bands):
+        outDataset.GetRasterBand(i + 1).WriteArray(tifArray[i, :, :])
+    outDataset.FlushCache()
+    outDataset = None
+
+
+class TileReader():
+    '''
+    keep the source image open and read tiles from it by extent
+    '''
+    def __init__(self, imgPath, bandsOrder=None):
+        if gdal is None:
+            raise Exception('GDAL is required by the gdal tile engine')
+        self.imgPath = imgPath
+        self.dataset = gdal.Open(imgPath, gdal.GA_ReadOnly)
+        if self.dataset is None:
+            raise Exception('can not open {}'.format(imgPath))
+        self.width = self.dataset.RasterXSize
+        self.height = self.dataset.RasterYSize
+        self.bandCount = self.dataset.RasterCount
+        self.geoTransform = self.dataset.GetGeoTransform()
+        self.projection = self.dataset.GetProjection()
+        if bandsOrder is None or len(bandsOrder) == 0:
+            bandsOrder = list(range(1, self.bandCount + 1))
+        self.bandsOrder = list(bandsOrder)
+        self.bands = [self.dataset.GetRasterBand(i) for i in self.bandsOrder]
+        self.dtype = gdal_array.GDALTypeCodeToNumericTypeCode(self.bands[0].DataType)
+
+    def extentToWindow(self, extent):
+        '''
+        :return: xoff, yoff, xsize, ysize of the pixel window covering the extent
+        '''
+        xmin, ymin, xmax, ymax = getBounds(extent)
+        inverse = invertGeoTransform(self.geoTransform)
+        cols, rows = [], []
+        for x, y in [(xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin)]:
+            col, row = applyGeoTransform(inverse, x, y)
+            cols.append(col)
+            rows.append(row)
+        xoff = int(np.floor(min(cols) + 0.5))
+        yoff = int(np.floor(min(rows) + 0.5))
+        xsize = int(np.floor(max(cols) + 0.5)) - xoff
+        ysize = int(np.floor(max(rows) + 0.5)) - yoff
+        return xoff, yoff, xsize, ysize
+
+    def readWindow(self, xoff, yoff, xsize, ysize):
+        '''
+        read a window of shape (bands, ysize, xsize), pixels outside the image are filled with 0
+        '''
+        out = np.zeros((len(self.bands), ysize, xsize), dtype=self.dtype)
+        x0 = max(xoff, 0)
+        y0 = max(yoff, 0)
+        x1 = min(xoff + xsize, self.width)
+        y1 = min(yoff + ysize, self.height)
+        if x1 <= x0 or y1 <= y0:
+            return out
+        for i in range(len(self.bands)):
+            out[i, y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = \
+                self.bands[i].ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        return out
+
+    def readOverview(self, xsize, ysize):
+        '''
+        read the whole image decimated to shape (bands, ysize, xsize)
+        '''
+        out = np.empty((len(self.bands), ysize, xsize), dtype=self.dtype)
+        for i in range(len(self.bands)):
+            out[i, :, :] = self.bands[i].ReadAsArray(0, 0, self.width, self.height, xsize, ysize)
+        return out
+
+    def readExtent(self, extent):
+        '''
+        :return: tile array and the geotransform of the tile
+        '''
+        xoff, yoff, xsize, ysize = self.extentToWindow(extent)
+        tile = self.readWindow(xoff, yoff, xsize, ysize)
+        return tile, windowGeoTransform(self.geoTransform, xoff, yoff)
+
+    def close(self):
+        self.bands = []
+        self.dataset = None
+
+
+def getImageCutPoints(imgPath, bandsOrder=None, stretch_method=0, stretch_parameters=None):
+    '''
+    scene level stretch cut points of an image, cached next to the image
+    '''
+    reader = TileReader(imgPath, bandsOrder)
+    cutPoints = getSceneCutPoints(reader, stretch_method, stretch_parameters)
+    reader.close()
+    return cutPoints
+
+
+def generateTile(tag, reader, extent, imageDir, resampling_type=None, labelDir=None, **kwargs):
+    '''
+    in memory counterpart of Rasters.generateImg
+    :param reader: TileReader of the source image
+    :param extent: arcpy Extent or (xmin, ymin, xmax, ymax) of the tile
+    :param writer: optional Writers.AsyncWriter, the tile is encoded and written in the background
+    :param band_statistics: optional Statistics.BandMoments the written tile is accumulated in
+    :param array_store: optional Containers.ArrayStore the written tile is staged in
+    '''
+    writer = kwargs.get('writer')
+    name = str(tag).zfill(6)
+    label_png, label_pgw = '', ''
+    if labelDir is not None:
+        label_png = os.path.join(labelDir, name + '.png')
+        label_pgw = os.path.join(labelDir, name + '.pgw')
+    tile, geoTransform = reader.readExtent(extent)
+    if not checkArray(tile):
+        if os.path.exists(label_png):
+            os.remove(label_png)
+        return False, ''
+    if resampling_type is not None:
+        tileSize = int(kwargs['tile_size'])
+        geoTransform = windowGeoTransform(geoTransform, 0, 0, tile.shape[2] * 1.0 / tileSize,
+                                          tile.shape[1] * 1.0 / tileSize)
+        tile = resampleArray(tile, tileSize, resampling_type)
+    projection = None
+    if kwargs.get('write_aux'):
+        projection = reader.projection
+    if kwargs['output_img_format'] in ['TIFF', 'TIF', 'tiff', 'tif']:
+        outputImg = os.path.join(imageDir, name + '.tif')
+        collectTile(tile, geoTransform, **kwargs)
+        submitWrite(writer, outputImg, writeGeoTiff, outputImg, tile, geoTransform, reader.projection)
+    else:
+        if kwargs['output_img_format'] in ['JPEG', 'jpg']:
+            outputImg = os.path.join(imageDir, name + '.jpg')
+        else:
+            outputImg = os.path.join(imageDir, name + '.png')
+        stretch = stretchArray(tile, kwargs['stretch_method'], kwargs['stretch_parameters'],
+                               kwargs.get('cut_points'))
+        if not checkArray(stretch):
+            if os.path.exists(label_png):
+                os.remove(label_png)
+            return False, ''
+        collectTile(stretch, geoTransform, **kwargs)
+        submitWrite(writer, outputImg, encodeImage, outputImg, stretch)
+    worldPath = os.path.splitext(outputImg)[0] + worldFileExtension(outputImg)
+    submitWrite(writer, worldPath, writeSidecars, outputImg, geoTransform, projection)
+    if labelDir is not None:
+        submitWrite(writer, label_pgw, writeSidecars, label_png, geoTransform, projection)
+    return True, outputImg
@@ -42,6 +42,28 @@ def copyFeatures(inputShp, output_dir, create_temp_id=False):
                 cursor.updateRow(row)
     return processingFeatures
 
+def groupSampleFiles(folder):
+    '''
+    group the files of a folder by sample name, eg. 000012.jpg and 000012.jgw belong to 000012
+    '''
+    samples = {}
+    for file in os.listdir(folder):
+        name = file.split('.', 1)[0]
+        samples.setdefault(name, []).append(file)
+    return samples
+
+
+def moveSampleFiles(files, srcDir, desDir, desName):
+    '''
+    move the files of a sample to desDir and rename them to desName, keeping their extensions
+    '''
+    for file in files:
+        extension = file.split('.', 1)[1]
+        desFile = os.path.join(desDir, desName + '.' + extension)
+        if os.path.exists(desFile):
+            os.remove(desFile)
+        shutil.move(os.path.join(srcDir, file), desFile)
+
 def getArcpyVersion():
     version = arcpy.GetInstallInfo()['Version']
     numbers = str(version).split('.')
@@ -51,4 +73,17 @@ def checkInputOutput(inputShp, outputFolder):
     if str(getPolygonType(inputShp)).lower() != 'polygon':
         raise Exception('input shpfile must be polygon type')
     if not os.path.exists(outputFolder):
-        os.mkdir(outputFolder)
\ No newline at end of file
+        os.mkdir(outputFolder)
+
+
+def linkFile(srcFile, desFile):
+    '''
+    hard link srcFile to desFile, the file is copied where hard links are not supported,
+    eg. python 2 on Windows or another drive
+    '''
+    if os.path.exists(desFile):
+        os.remove(desFile)
+    try:
+        os.link(srcFile, desFile)
+    except (AttributeError, OSError):
+        shutil.copyfile(srcFile, desFile)
@@ -0,0 +1,106 @@
+# coding=utf-8
+'''
+asynchronous output stage, the tiles are encoded and written by a pool of threads
+while the main loop goes on reading the next window
+'''
+import atexit
+import threading
+
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+
+class AsyncWriter():
+    '''
+    a bounded queue drained by writer threads. submit blocks while the queue is full,
+    so at most maxPending tiles are held in memory. cv2 and PIL release the GIL while encoding
+    '''
+    def __init__(self, threads=2, maxPending=16):
+        self.queue = Queue.Queue(maxsize=maxPending)
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.error = None
+        self.closed = False
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        # write the queued tiles before the interpreter exits, also when the main loop failed
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            path, func, args, depends = job
+            try:
+                for depend in depends:
+                    # a job may rewrite its own path, eg. the boxes drawn on a tile, then only the earlier writes count
+                    self.wait(depend, 1 if depend == path else 0)
+                if self.error is None:
+                    func(*args)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                with self.condition:
+                    self.pending[path] -= 1
+                    if self.pending[path] == 0:
+                        del self.pending[path]
+                    self.condition.notify_all()
+                self.queue.task_done()
+
+    def submit(self, path, func, *args, **kwargs):
+        '''
+        queue func(*args), which writes path
+        :param depends: paths which must be written before func runs, eg. the image of an annotation
+        '''
+        self.raiseError()
+        with self.condition:
+            self.pending[path] = self.pending.get(path, 0) + 1
+        self.queue.put((path, func, args, kwargs.get('depends', [])))
+
+    def wait(self, path, remaining=0):
+        '''
+        block until the queued writes of path are done
+        :param remaining: writes of path which may still be queued
+        '''
+        with self.condition:
+            while self.pending.get(path, 0) > remaining:
+                self.condition.wait()
+
+    def flush(self):
+        self.queue.join()
+        self.raiseError()
+
+    def raiseError(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.raiseError()
+
+
+def submitWrite(writer, path, func, *args, **kwargs):
+    '''
+    run func(*args) now, or queue it when an AsyncWriter is given
+    '''
+    if writer is None:
+        func(*args)
+    else:
+        writer.submit(path, func, *args, **kwargs)
@@ -7,14 +7,22 @@ import arcpy
 import os
 import sys
 import shutil
+import math
+import multiprocessing
 import arcpy.cartography as CA
 import argparse
 from tqdm import tqdm
 
-from RS_Libs.Labels import getLabelMappingList, makeLabel, writeLabelXML
-from RS_Libs.Polygons import simplify_polygon, extentToPolygon
+from RS_Libs.Containers import makeShards, makeArrayStore, arrayStorePath, ArrayStore
+from RS_Libs.Georeference import removeSidecars
+from RS_Libs.Labels import getLabelMappingList, labelLUT, makeLabel, makeWindowLabel, writeLabelXML, foregroundPrefilter
+from RS_Libs.Polygons import simplify_polygon, occupancy_grids, extentToPolygon, makePolygon, labelFeatures
+from RS_Libs.Rasterize import FeatureRasterizer
+from RS_Libs.Statistics import PixelCounts, makeBandMoments, writeStatistics
 from RS_Libs.Rasters import get_raster_info, generateImg
-from RS_Libs.Utils import checkInput, copyFeatures, checkInputOutput
+from RS_Libs.Tiles import TileReader, generateTile, getImageCutPoints
+from RS_Libs.Utils import checkInput, copyFeatures, checkInputOutput, groupSampleFiles, moveSampleFiles
+from RS_Libs.Writers import AsyncWriter, submitWrite
 
 reload(sys)
 sys.setdefaultencoding('utf-8')
@@ -66,6 +74,64 @@ def parse_args():
     parser.add_argument('--filter', type=float, default=0.05, required=False,
                         help='Images with foreground pixels less than filter will be discarded')
 
+    parser.add_argument('--stretch-statistics', type=str, default='tile', choices=['tile', 'scene'],
+                        required=False,
+                        help='tile, stretch every tile with its own statistics; '
+                             'scene, compute the statistics once for the whole image (requires GDAL)')
+
+    parser.add_argument('--workers', type=int, default=1, required=False,
+                        help='number of worker processes used to create the samples')
+
+    parser.add_argument('--writer-threads', type=int, default=0, required=False,
+                        help='number of threads encoding and writing tiles, labels and metadata in the background, '
+                             '0 writes synchronously. the arcpy tile engine still clips on the main thread')
+
+    parser.add_argument('--write-aux', type=bool, default=False, required=False,
+                        help='also write the spatial reference of every tile to a .aux.xml file')
+
+    parser.add_argument('--band-statistics', type=str, default='none', choices=['none', 'moments', 'histogram'],
+                        required=False,
+                        help='none, no band statistics; moments, write the mean and std of every band of the output '
+                             'tiles to band_statistics.json; histogram, also count the values of every band. '
+                             'TIFF tiles of the arcpy tile engine are read once more for it')
+
+    parser.add_argument('--output-container', type=str, default='folder', choices=['folder', 'tar'],
+                        required=False,
+                        help='folder, write the files of every sample into the output folders; '
+                             'tar, stream the samples into size bounded tar shards in the shards folder')
+
+    parser.add_argument('--shard-size', type=int, default=1024, required=False,
+                        help='maximum size in MB of a tar shard')
+
+    parser.add_argument('--array-store', type=str, default='none', choices=['none', 'hdf5', 'zarr'], required=False,
+                        help='also write the tiles into a chunked array store in the output folder, '
+                             'samples.h5 (requires h5py) or samples.zarr (requires zarr), '
+                             'an existing store is appended to')
+
+    parser.add_argument('--prefilter-block', type=int, default=8, required=False,
+                        help='block size in pixels of the foreground prefilter, which skips grid cells '
+                             'whose label fails the filter before clipping, 0 disables it')
+
+    parser.add_argument('--grid-planner', type=str, default='vector', choices=['vector', 'bitmap'],
+                        required=False,
+                        help='vector, simplify, buffer and split the labels into grids; '
+                             'bitmap, keep the grids near labels in a coarse occupancy bitmap of the labels')
+
+    parser.add_argument('--label-mode', type=str, default='rgb', choices=['rgb', 'gray', 'palette', 'gray16'],
+                        required=False,
+                        help='rgb, three identical channels; gray, 8 bit single channel; '
+                             'palette, 8 bit with a class colour table; gray16, 16 bit for more than 255 classes')
+
+    parser.add_argument('--label-engine', type=str, default='raster', choices=['raster', 'window'],
+                        required=False,
+                        help='raster, rasterize the labels over the whole image and clip every tile; '
+                             'window, burn only the labels intersecting every tile in memory')
+
+    parser.add_argument('--tile-engine', type=str, default='arcpy', choices=['arcpy', 'gdal'],
+                        required=False,
+                        help='arcpy, clip every tile with Clip_management; '
+                             'gdal, read every tile as a window of the source image in memory')
+
     args = parser.parse_args()
 
     return args
@@ -94,63 +160,103 @@ def segmentation(inputShp, inputTif,resultFolder,tag=0):
     processingFeatures = copyFeatures(inputShp, resultFolder, create_temp_id=False)
 
     labelMapping_dict = getLabelMappingList(processingFeatures, args.class_field,
-                                               GLT, GLT_para)
+                                               GLT, GLT_para, 65535 if args.label_mode == 'gray16' else 255)
+    # the label tiles are mapped with one gather through the lookup table
+    labelMapping_lut = labelLUT(GLT, labelMapping_dict)
     arcpy.AddMessage('Creating vector grids ...')
 
     # polygon simplify
-    gridsPath, matchcount = simplify_polygon(tempWorkSpace, processingFeatures,
-                                resultFolder, img_meta_info,
-                                args.tile_size, args.overlap_size)
+    if args.grid_planner == 'bitmap':
+        gridsPath, matchcount = occupancy_grids(tempWorkSpace, processingFeatures,
+                                                resultFolder, img_meta_info,
+                                                args.tile_size, args.overlap_size)
+    else:
+        gridsPath, matchcount = simplify_polygon(tempWorkSpace, processingFeatures,
+                                    resultFolder, img_meta_info,
+                                    args.tile_size, args.overlap_size)
 
     # generate label tif
-    labelTiff = os.path.join(tempWorkSpace, 'label.tif')
-    arcpy.env.extent = img_meta_info['extent']
-    if GLT in [0, 1]:
-        arcpy.PolygonToRaster_conversion(processingFeatures, args.class_field, labelTiff, '#', '#', inputTif)
+    valueField = args.class_field if GLT in [0, 1] else 'ClassValue'
+    labelTiff = None
+    if args.label_engine == 'window':
+        extent = img_meta_info['extent']
+        geoTransform = (extent.XMin, img_meta_info['cell_width'], 0.0,
+                        extent.YMax, 0.0, -img_meta_info['cell_height'])
+        label = FeatureRasterizer(labelFeatures(processingFeatures, valueField), geoTransform,
+                                  args.tile_size * img_meta_info['cell_width'])
     else:
-        arcpy.PolygonToRaster_conversion(processingFeatures, 'ClassValue', labelTiff, '#', '#', inputTif)
+        labelTiff = os.path.join(tempWorkSpace, 'label.tif')
+        arcpy.env.extent = img_meta_info['extent']
+        arcpy.PolygonToRaster_conversion(processingFeatures, valueField, labelTiff, '#', '#', inputTif)
+        label = labelTiff
     arcpy.Delete_management("in_memory")
     arcpy.ResetEnvironments()
 
     pbar = tqdm(total=matchcount)
     pbar.set_description("creating")
-    fields = ['FID', 'SHAPE@']
-    band_split = False
-    if len(bands_order) > 0:
-        band_split = True
     arcpy.env.workspace = tempWorkSpace
-    with arcpy.da.SearchCursor(gridsPath, fields) as cursor:
-        for row in cursor:
-            tempShp = os.path.join(tempWorkSpace, 'temp0.shp')
-            if os.path.exists(tempShp):
-                arcpy.Delete_management(tempShp)
-            arcpy.FeatureClassToFeatureClass_conversion(row[1], tempWorkSpace, 'temp0.shp')
-            pbar.update(1)
-            # generate label
-            outLabel = os.path.join(labelDir, str(tag).zfill(6) + '.png')
-            succeed = makeLabel(tag, tempShp, labelTiff, labelDir, GLT,
-                                labelMapping_dict, args.tile_size, args.filter)
-            if not succeed:
-                continue
-            # generate img
-            status, _ = generateImg(tag, inputTif, tempShp, imageDir,labelDir=labelDir,
-                                    output_img_format=args.output_img_format,
-                                    splitBands=band_split, bandsOrder=bands_order,
-                                    stretch_method=args.stretch_method, stretch_parameters=args.stretch_parameters)
-            if not status:
-                if os.path.exists(outLabel):
-                    os.remove(outLabel)
-                continue
-
-            # generate xml
-            if args.write_xml:
-                xmlPath = os.path.join(labelDir, str(tag).zfill(6) + '.xml')
-                writeLabelXML(xmlPath, inputTif, outLabel, args.overlap_size,
-                              GLT, labelMapping_dict, img_meta_info['spatial_reference'])
-            arcpy.Delete_management(tempShp)
-            tag += 1
-
-    arcpy.Delete_management(labelTiff)
+    cut_points = None
+    if args.stretch_statistics == 'scene':
+        cut_points = getImageCutPoints(inputTif, bands_order, args.stretch_method, args.stretch_parameters)
+    statistics = PixelCounts()
+    bandStatistics = makeBandMoments(args.band_statistics)
+    shards = makeShards(args, resultFolder)
+    store = makeArrayStore(args, resultFolder, inputTif)
+    if store is not None:
+        store.setAttribute('gray_levels', dict((str(key), value) for key, value in labelMapping_dict.items()))
+    # drop the grid cells whose label surely fails the filter before anything is clipped
+    prefilter = None
+    if labelTiff is not None and args.prefilter_block > 0:
+        prefilter = foregroundPrefilter(labelTiff, args.prefilter_block)
+    if args.workers > 1:
+        tag = parallel_segmentation(gridsPath, label, tempWorkSpace, labelMapping_dict, labelMapping_lut,
+                                    bands_order, cut_points, img_meta_info, pbar, tag, prefilter, statistics,
+                                    bandStatistics, shards, store)
+    else:
+        reader = None
+        if args.tile_engine == 'gdal':
+            reader = TileReader(inputTif, bands_order)
+        writer = None
+        if args.writer_threads > 0:
+            writer = AsyncWriter(args.writer_threads)
+        with arcpy.da.SearchCursor(gridsPath, ['FID', 'SHAPE@']) as cursor:
+            for row in cursor:
+                pbar.update(1)
+                extent = row[1].extent
+                if prefilter is not None and not prefilter.passes(extent.XMin, extent.YMin, extent.XMax,
+                                                                  extent.YMax, args.filter):
+                    continue
+                if not make_sample(tag, row[1], tempWorkSpace, imageDir, labelDir, label,
+                                   labelMapping_lut, bands_order, reader, cut_points, args, writer, statistics,
+                                   bandStatistics, store):
+                    continue
+                # generate xml
+                if args.write_xml:
+                    xmlPath = os.path.join(labelDir, str(tag).zfill(6) + '.xml')
+                    outLabel = os.path.join(labelDir, str(tag).zfill(6) + '.png')
+                    submitWrite(writer, xmlPath, writeLabelXML, xmlPath, inputTif, outLabel, args.overlap_size,
+                                GLT, labelMapping_dict, img_meta_info['spatial_reference'],
+                                (args.tile_size, args.tile_size))
+                if shards is not None:
+                    name = str(tag).zfill(6)
+                    shards.addSample(name, [(imageDir, name, 'image'), (labelDir, name, 'label')], writer=writer)
+                tag += 1
+        if reader is not None:
+            reader.close()
+        if writer is not None:
+            writer.close()
+    if shards is not None:
+        shards.close()
+    if store is not None:
+        store.close()
+
+    # class balance of the dataset, the gray levels are named after the classes
+    names = dict((int(value), key) for key, value in labelMapping_dict.items())
+    writeStatistics(os.path.join(resultFolder, 'statistics.json'), statistics.summary(names))
+    if bandStatistics is not None:
+        writeStatistics(os.path.join(resultFolder, 'band_statistics.json'), bandStatistics.summary())
+    if labelTiff is not None:
+        arcpy.Delete_management(labelTiff)
     arcpy.Delete_management(gridsPath)
     arcpy.Delete_management(processingFeatures)
     shutil.rmtree(tempWorkSpace)
@@ -158,6 +264,194 @@ def segmentation(inputShp, inputTif,resultFolder,tag=0):
     return tag
 
 
+def make_sample(tag, polygon, workSpace, imageDir, labelDir, label, labelMapping_lut,
+                bands_order, reader, cut_points, args, writer=None, statistics=None, bandStatistics=None,
+                store=None):
+    '''
+    create the label and the image of one grid cell, return False if the sample is discarded
+    :param label: the label raster, or a FeatureRasterizer with the window label engine
+    :param statistics: optional Statistics.PixelCounts the label of an accepted sample is counted in
+    :param bandStatistics: optional Statistics.BandMoments the image of an accepted sample is accumulated in
+    :param store: optional Containers.ArrayStore the image and the label of an accepted sample are appended to
+    '''
+    tempShp = os.path.join(workSpace, 'temp0.shp')
+    if args.label_engine != 'window' or reader is None:
+        if os.path.exists(tempShp):
+            arcpy.Delete_management(tempShp)
+        arcpy.FeatureClassToFeatureClass_conversion(polygon, workSpace, 'temp0.shp')
+    # generate label
+    outLabel = os.path.join(labelDir, str(tag).zfill(6) + '.png')
+    if args.label_engine == 'window':
+        extent = polygon.extent
+        labelArray = makeWindowLabel(tag, (extent.XMin, extent.YMin, extent.XMax, extent.YMax), label, labelDir,
+                                  int(args.gray_level_transformation), labelMapping_lut, args.tile_size,
+                                  args.filter, args.label_mode, writer)
+    else:
+        labelArray = makeLabel(tag, tempShp, label, labelDir, int(args.gray_level_transformation),
+                               labelMapping_lut, args.tile_size, args.filter, args.label_mode, writer)
+    if labelArray is None:
+        return False
+    # generate img
+    if reader is not None:
+        status, _ = generateTile(tag, reader, polygon.extent, imageDir, labelDir=labelDir,
+                                 output_img_format=args.output_img_format,
+                                 stretch_method=args.stretch_method,
+                                 stretch_parameters=args.stretch_parameters,
+                                 cut_points=cut_points, writer=writer,
+                                 write_aux=args.write_aux, band_statistics=bandStatistics,
+                                 array_store=store)
+    else:
+        status, _ = generateImg(tag, args.input_image, tempShp, imageDir, labelDir=labelDir,
+                                output_img_format=args.output_img_format,
+                                splitBands=len(bands_order) > 0, bandsOrder=bands_order,
+                                stretch_method=args.stretch_method, stretch_parameters=args.stretch_parameters,
+                                cut_points=cut_points, writer=writer,
+                                write_aux=args.write_aux, band_statistics=bandStatistics,
+                                array_store=store)
+    if not status:
+        if writer is not None:
+            # the label may still be queued
+            writer.wait(outLabel)
+            writer.raiseError()
+        if os.path.exists(outLabel):
+            os.remove(outLabel)
+        removeSidecars(outLabel)
+        return False
+    if os.path.exists(tempShp):
+        arcpy.Delete_management(tempShp)
+    if statistics is not None:
+        statistics.add(labelArray)
+    if store is not None:
+        store.append(tag, label=labelArray)
+    return True
+
+
+def segmentation_task(task):
+    '''
+    process a shard of grid cells in a worker process. Every shard has its own workspace,
+    the samples are named by the index of their grid cell and renamed by the main process
+    '''
+    args = task['args']
+    workSpace = task['workspace']
+    shardImageDir = os.path.join(workSpace, 'images')
+    shardLabelDir = os.path.join(workSpace, 'labels')
+    for folder in [workSpace, shardImageDir, shardLabelDir]:
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+    arcpy.env.workspace = workSpace
+    spatial_reference = arcpy.SpatialReference()
+    spatial_reference.loadFromString(task['spatial_reference'])
+    reader = None
+    if args.tile_engine == 'gdal':
+        reader = TileReader(args.input_image, task['bands_order'])
+    writer = None
+    if args.writer_threads > 0:
+        writer = AsyncWriter(args.writer_threads)
+    accepted = []
+    statistics = PixelCounts()
+    bandStatistics = makeBandMoments(args.band_statistics)
+    store = makeArrayStore(args, workSpace, args.input_image)
+    for index, (xmin, ymin, xmax, ymax) in task['cells']:
+        polygon = makePolygon(xmin, xmax, ymin, ymax, spatial_reference)
+        if make_sample(index, polygon, workSpace, shardImageDir, shardLabelDir, task['label'],
+                       task['label_mapping'], task['bands_order'], reader, task['cut_points'], args, writer,
+                       statistics, bandStatistics, store):
+            accepted.append(index)
+    if reader is not None:
+        reader.close()
+    if writer is not None:
+        writer.close()
+    if store is not None:
+        store.close()
+    arcpy.ResetEnvironments()
+    return workSpace, accepted, len(task['cells']), statistics, bandStatistics
+
+
+def parallel_segmentation(gridsPath, label, tempWorkSpace, labelMapping_dict, labelMapping_lut,
+                          bands_order, cut_points, img_meta_info, pbar, tag=0, prefilter=None, statistics=None,
+                          bandStatistics=None, shards=None, store=None):
+    '''
+    shard the grid cells across a pool of worker processes. The accepted samples are numbered
+    in grid order afterwards, so the tags and output files do not depend on the number of workers
+    '''
+    cells = []
+    index = 0
+    with arcpy.da.SearchCursor(gridsPath, ['SHAPE@']) as cursor:
+        for row in cursor:
+            extent = row[0].extent
+            bounds = (extent.XMin, extent.YMin, extent.XMax, extent.YMax)
+            if prefilter is None or prefilter.passes(bounds[0], bounds[1], bounds[2], bounds[3], args.filter):
+                cells.append((index, bounds))
+            else:
+                pbar.update(1)
+            index += 1
+    shardSize = max(1, int(math.ceil(len(cells) / float(args.workers * 4))))
+    tasks = []
+    for i in range(0, len(cells), shardSize):
+        tasks.append({'args': args, 'cells': cells[i:i + shardSize],
+                      'workspace': os.path.join(tempWorkSpace, 'shard' + str(len(tasks))),
+                      'label': label, 'label_mapping': labelMapping_lut,
+                      'bands_order': bands_order, 'cut_points': cut_points,
+                      'spatial_reference': img_meta_info['spatial_reference'].exportToString()})
+    owners = {}
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        for workSpace, accepted, count, shardStatistics, shardBands in pool.imap_unordered(segmentation_task,
+                                                                                          tasks):
+            for index in accepted:
+                owners[index] = workSpace
+            if statistics is not None:
+                statistics.merge(shardStatistics)
+            if bandStatistics is not None and shardBands is not None:
+                bandStatistics.merge(shardBands)
+            pbar.update(count)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    shardFiles = {}
+    shardStores = {}
+    writer = None
+    if args.writer_threads > 0:
+        writer = AsyncWriter(args.writer_threads)
+    for index in sorted(owners.keys()):
+        workSpace = owners[index]
+        if not workSpace in shardFiles:
+            shardFiles[workSpace] = (groupSampleFiles(os.path.join(workSpace, 'images')),
+                                     groupSampleFiles(os.path.join(workSpace, 'labels')))
+        imageFiles, labelFiles = shardFiles[workSpace]
+        name = str(tag).zfill(6)
+        moveSampleFiles(imageFiles[str(index).zfill(6)], os.path.join(workSpace, 'images'), imageDir, name)
+        moveSampleFiles(labelFiles[str(index).zfill(6)], os.path.join(workSpace, 'labels'), labelDir, name)
+        if args.write_xml:
+            xmlPath = os.path.join(labelDir, name + '.xml')
+            submitWrite(writer, xmlPath, writeLabelXML, xmlPath, args.input_image,
+                        os.path.join(labelDir, name + '.png'), args.overlap_size,
+                        int(args.gray_level_transformation), labelMapping_dict,
+                        img_meta_info['spatial_reference'], (args.tile_size, args.tile_size))
+        if shards is not None:
+            shards.addSample(name, [(imageDir, name, 'image'), (labelDir, name, 'label')], writer=writer)
+        if store is not None:
+            # the samples of every shard store are copied in grid order
+            if not workSpace in shardStores:
+                shardStore = ArrayStore(arrayStorePath(workSpace, args.array_store), args.array_store, mode='r')
+                rows = dict((int(index), row) for row, index in enumerate(shardStore.tags()))
+                shardStores[workSpace] = (shardStore, rows)
+            shardStore, rows = shardStores[workSpace]
+            image, labelArray, geoTransform = shardStore.read(rows[index])
+            store.stage(image, geoTransform)
+            store.append(tag, label=labelArray)
+        tag += 1
+    if writer is not None:
+        writer.close()
+    for shardStore, _ in shardStores.values():
+        shardStore.close()
+    return tag
+
+
 if __name__ == "__main__":
 
     args = parse_args()
@@ -0,0 +1,89 @@
+# coding=utf-8
+'''
+benchmark of SpatialIndex.GridIndex, the neighbour search of get_objects_info.
+random 5-40 m boxes at a constant density, 0.5 m cells and 512 px tiles, a query is the tile centred on a box
+searched with half a tile distance. every query is checked against the brute force rectDistance over all boxes,
+the brute force is timed on a sample of the queries
+usage: python benchmarks/bench_spatial_index.py [--sizes 10000,100000,1000000] [--queries 1000]
+'''
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from RS_Libs.SpatialIndex import GridIndex, rectDistance
+
+
+def randomBoxes(count, spacing=32.0, minSize=5.0, maxSize=40.0, seed=0):
+    '''
+    array (count, 4) of boxes in a square scene, about one box per spacing x spacing
+    '''
+    random = np.random.RandomState(seed)
+    side = spacing * np.sqrt(count)
+    xmin = random.uniform(0, side, count)
+    ymin = random.uniform(0, side, count)
+    width = random.uniform(minSize, maxSize, count)
+    height = random.uniform(minSize, maxSize, count)
+    return np.stack([xmin, ymin, xmin + width, ymin + height], axis=1)
+
+
+def bruteForce(boxes, xmin, ymin, xmax, ymax, distance):
+    return np.nonzero(rectDistance(boxes, xmin, ymin, xmax, ymax) < distance)[0]
+
+
+def benchmark(count, queries, cellSize=0.5, tileSize=512, checks=None):
+    '''
+    :param queries: number of queries timed, the tiles are centred on randomly chosen boxes
+    :param checks: number of queries checked and timed with brute force, all of them by default
+    '''
+    boxes = randomBoxes(count)
+    tileWidth = cellSize * tileSize
+    distance = tileWidth / 2
+    start = time.time()
+    index = GridIndex(boxes, tileWidth)
+    build = time.time() - start
+
+    random = np.random.RandomState(1)
+    centers = boxes[random.choice(count, min(queries, count), replace=False)]
+    centerX = (centers[:, 0] + centers[:, 2]) / 2
+    centerY = (centers[:, 1] + centers[:, 3]) / 2
+    tiles = np.stack([centerX - distance, centerY - distance, centerX + distance, centerY + distance], axis=1)
+
+    results = []
+    start = time.time()
+    for tile in tiles:
+        results.append(index.query(tile[0], tile[1], tile[2], tile[3], distance))
+    perQuery = (time.time() - start) / len(tiles)
+
+    checks = len(tiles) if checks is None else min(checks, len(tiles))
+    start = time.time()
+    for i in range(checks):
+        expected = bruteForce(boxes, tiles[i][0], tiles[i][1], tiles[i][2], tiles[i][3], distance)
+        if not np.array_equal(results[i], expected):
+            raise Exception('grid index and brute force differ for query {} of {} boxes'.format(i, count))
+    perBrute = (time.time() - start) / max(checks, 1)
+    neighbours = np.mean([len(found) for found in results])
+    return build, perQuery, perBrute, neighbours, checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the grid index of the neighbour search')
+    parser.add_argument('--sizes', type=str, default='10000,100000,1000000', help='numbers of boxes')
+    parser.add_argument('--queries', type=int, default=1000, help='queries timed per size')
+    parser.add_argument('--checks', type=int, default=100, help='queries checked against brute force per size')
+    args = parser.parse_args()
+
+    print('{:>9} {:>10} {:>12} {:>14} {:>14} {:>11}'.format(
+        'boxes', 'build', 'per query', 'all queries', 'brute force', 'neighbours'))
+    for count in [int(v) for v in args.sizes.split(',')]:
+        build, perQuery, perBrute, neighbours, checks = benchmark(count, args.queries, checks=args.checks)
+        # every box gets a tile in get_objects_info
+        print('{:>9} {:>8.3f} s {:>9.1f} us {:>12.1f} s {:>11.1f} us {:>11.0f}'.format(
+            count, build, perQuery * 1e6, perQuery * count, perBrute * 1e6, neighbours))
+    print('the index results matched brute force rectDistance in every checked query')
+
+
+if __name__ == '__main__':
+    main()
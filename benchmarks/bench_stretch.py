@@ -0,0 +1,155 @@
+# coding=utf-8
+'''
+benchmark of the lookup table stretch of RS_Libs.Stretch against the per pixel stretch it replaced.
+the outputs are checked to be identical on 3x512x512 uint8, int16 and uint16 tiles, then time and
+peak memory (tracemalloc, python 3) are measured on a larger array
+usage: python benchmarks/bench_stretch.py [--shape 4,2048,2048] [--dtype uint16] [--repeat 3]
+'''
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from RS_Libs.Stretch import percentStretch, stdStretch, minmaxStretch
+
+
+def referencePercentStretch(tifArray, lower_percent=0.5, higher_percent=99.5):
+    '''
+    the per pixel percentStretch before the lookup table
+    '''
+    data = tifArray
+    n = data.shape[0]
+    out = np.zeros_like(data, dtype=np.uint8)
+    for i in range(n):
+        a = 0
+        b = 255
+        c = np.percentile(data[i, :, :], lower_percent)
+        d = np.percentile(data[i, :, :], higher_percent)
+        t = a + (data[i, :, :] - c) * (b - a) / (d - c)
+        t[t < a] = a
+        t[t > b] = b
+        out[i, :, :] = t
+    return out
+
+
+def referenceStdStretch(tifArray, multiple=2.5):
+    '''
+    the per pixel stdStretch before the lookup table
+    '''
+    data = tifArray
+    n = data.shape[0]
+    out = np.zeros_like(data, dtype=np.uint8)
+    for i in range(n):
+        band = data[i, :, :]
+        mean = np.mean(band)
+        stdDev = np.std(band, ddof=1)
+        max = mean + multiple * stdDev
+        min = mean - multiple * stdDev
+        k = 255 / (max - min)
+        b = (0 - min * 255) / (max - min)
+        if min <= 0:
+            min = 0
+        band = np.select([band <= min, band >= max, k * band + b < 0,
+                          k * band + b > 255, (k * band + b > 0) & (k * band + b < 255)],
+                         [0, 255, 0, 255, k * band + b], band)
+        out[i, :, :] = band
+    return out
+
+
+def referenceMinmaxStretch(tifArray):
+    '''
+    the per pixel minmaxStretch before the lookup table, min and max are python scalars
+    as in the new one, the numpy scalars of before overflowed in min * 255 on uint16
+    '''
+    data = tifArray
+    n = data.shape[0]
+    out = np.zeros_like(data, dtype=np.uint8)
+    for i in range(n):
+        band = data[i, :, :]
+        min = int(np.min(band))
+        max = int(np.max(band))
+        if max == min:
+            out[i, :, :] = band
+        else:
+            k = 255 * 1.0 / (max - min)
+            b = (0 - min * 255) * 1.0 / (max - min)
+            band = np.select([k * band + b < 0, k * band + b > 255, (k * band + b >= 0) & (k * band + b <= 255)],
+                             [0, 255, k * band + b], band)
+            out[i, :, :] = band
+    return out
+
+
+METHODS = [('percent', referencePercentStretch, percentStretch),
+           ('std', referenceStdStretch, stdStretch),
+           ('minmax', referenceMinmaxStretch, minmaxStretch)]
+
+
+def randomImage(shape, dtype, seed=0):
+    '''
+    bands of normally distributed values around the middle of the dtype range, like a dark scene
+    '''
+    random = np.random.RandomState(seed)
+    info = np.iinfo(dtype)
+    low, high = float(info.min), float(info.max)
+    scale = min(high - low, 4096.0)
+    data = random.normal(low + scale / 4, scale / 16, shape)
+    return np.clip(np.round(data), low, high).astype(dtype)
+
+
+def measure(func, data, repeat):
+    '''
+    best time of repeat runs and the peak memory of one run in bytes, None without tracemalloc
+    '''
+    seconds = []
+    for i in range(repeat):
+        start = time.time()
+        func(data)
+        seconds.append(time.time() - start)
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func(data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(seconds), peak
+
+
+def formatPeak(peak):
+    return 'n/a' if peak is None else '{:.1f} MB'.format(peak / 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the lookup table stretch')
+    parser.add_argument('--shape', type=str, default='4,2048,2048', help='bands,rows,cols of the timed array')
+    parser.add_argument('--dtype', type=str, default='uint16', choices=['uint8', 'int8', 'uint16', 'int16'])
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of every stretch')
+    args = parser.parse_args()
+
+    for dtype in [np.uint8, np.int16, np.uint16]:
+        tile = randomImage((3, 512, 512), dtype)
+        for name, reference, stretch in METHODS:
+            if not np.array_equal(reference(tile), stretch(tile)):
+                raise Exception('{} stretch of {} differs from the per pixel stretch'.format(
+                    name, np.dtype(dtype).name))
+    print('the lookup table stretch matches the per pixel stretch on uint8, int16 and uint16 tiles')
+
+    shape = tuple([int(v) for v in args.shape.split(',')])
+    data = randomImage(shape, np.dtype(args.dtype))
+    print('{} {}'.format('x'.join([str(v) for v in shape]), args.dtype))
+    print('{:>8} {:>12} {:>12} {:>10} {:>10}'.format('method', 'peak before', 'peak after', 'before', 'after'))
+    for name, reference, stretch in METHODS:
+        referenceTime, referencePeak = measure(reference, data, args.repeat)
+        stretchTime, stretchPeak = measure(stretch, data, args.repeat)
+        print('{:>8} {:>12} {:>12} {:>8.2f} s {:>8.2f} s'.format(
+            name, formatPeak(referencePeak), formatPeak(stretchPeak), referenceTime, stretchTime))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# coding=utf-8
+'''
+tests of the tar shards, they run without arcpy
+'''
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import unittest
+
+from RS_Libs.Containers import TarShards
+from RS_Libs.Writers import AsyncWriter, submitWrite
+
+
+def slowWrite(path, content, delay=0.2):
+    time.sleep(delay)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+class TarShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.imageDir = os.path.join(self.folder, 'images')
+        self.labelDir = os.path.join(self.folder, 'labels')
+        os.mkdir(self.imageDir)
+        os.mkdir(self.labelDir)
+        self.shardDir = os.path.join(self.folder, 'shards')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def members(self):
+        with open(os.path.join(self.shardDir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        names = []
+        for shard in index['shards']:
+            with tarfile.open(os.path.join(self.shardDir, shard['name'])) as tar:
+                names += tar.getnames()
+        return index, sorted(names)
+
+    def test_add_sample(self):
+        for path in [os.path.join(self.imageDir, '000000.jpg'), os.path.join(self.imageDir, '000000.jgw'),
+                     os.path.join(self.labelDir, '000000.png')]:
+            slowWrite(path, b'x', 0)
+        shards = TarShards(self.shardDir)
+        shards.addSample('000000', [(self.imageDir, '000000', 'image'), (self.labelDir, '000000', 'label')],
+                         {'cls': b'water'})
+        shards.close()
+        index, names = self.members()
+        self.assertEqual(names, ['000000.cls', '000000.image.jgw', '000000.image.jpg', '000000.label.png'])
+        self.assertEqual(index['shards'][0]['keys'], ['000000'])
+        self.assertEqual(os.listdir(self.imageDir) + os.listdir(self.labelDir), [])
+
+    def test_add_queued_sample(self):
+        # the writes are still queued when the sample is packed
+        writer = AsyncWriter(2)
+        for folder, extension in [(self.imageDir, 'jpg'), (self.imageDir, 'jgw'), (self.labelDir, 'xml')]:
+            path = os.path.join(folder, '000000.' + extension)
+            submitWrite(writer, path, slowWrite, path, extension.encode('ascii'))
+        shards = TarShards(self.shardDir)
+        shards.addSample('000000', [(self.imageDir, '000000', 'image'), (self.labelDir, '000000', 'label')],
+                         writer=writer)
+        shards.close()
+        writer.close()
+        _, names = self.members()
+        self.assertEqual(names, ['000000.image.jgw', '000000.image.jpg', '000000.label.xml'])
+        self.assertEqual(os.listdir(self.imageDir) + os.listdir(self.labelDir), [])
+
+    def test_shard_size(self):
+        shards = TarShards(self.shardDir, maxSize=4096)
+        for i in range(3):
+            name = str(i).zfill(6)
+            slowWrite(os.path.join(self.imageDir, name + '.png'), b'x' * 2048, 0)
+            shards.addSample(name, [(self.imageDir, name, 'image')])
+        shards.close()
+        index, names = self.members()
+        self.assertEqual(len(index['shards']), 3)
+        self.assertEqual(len(names), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
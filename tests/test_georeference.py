@@ -0,0 +1,115 @@
+# coding=utf-8
+'''
+tests of the geotransform arithmetic and the sidecar files, they run without arcpy
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from RS_Libs.Georeference import invertGeoTransform, applyGeoTransform, windowGeoTransform, worldFileValues, \
+    worldFileGeoTransform, readWorldFile, writeSidecars, removeSidecars
+
+NORTH_UP = (500000.0, 2.0, 0.0, 3400000.0, 0.0, -2.0)
+ROTATED = (500000.0, 1.8, 0.3, 3400000.0, 0.4, -1.9)
+
+
+class GeoTransformTest(unittest.TestCase):
+    def assertValuesEqual(self, first, second, places=6):
+        self.assertEqual(len(first), len(second))
+        for a, b in zip(first, second):
+            self.assertAlmostEqual(a, b, places=places)
+
+    def test_world_file_round_trip(self):
+        for geoTransform in [NORTH_UP, ROTATED]:
+            self.assertValuesEqual(worldFileGeoTransform(worldFileValues(geoTransform)), geoTransform)
+
+    def test_world_file_refers_to_pixel_center(self):
+        values = worldFileValues(NORTH_UP)
+        self.assertValuesEqual(values, [2.0, 0.0, 0.0, -2.0, 500001.0, 3399999.0])
+        centerX, centerY = applyGeoTransform(ROTATED, 0.5, 0.5)
+        self.assertValuesEqual(worldFileValues(ROTATED)[4:], [centerX, centerY])
+
+    def test_invert(self):
+        for geoTransform in [NORTH_UP, ROTATED]:
+            inverse = invertGeoTransform(geoTransform)
+            for x, y in [(0, 0), (10, 0), (0, 10), (123.5, 456.25)]:
+                geoX, geoY = applyGeoTransform(geoTransform, x, y)
+                self.assertValuesEqual(applyGeoTransform(inverse, geoX, geoY), (x, y))
+
+    def test_invert_singular(self):
+        with self.assertRaises(Exception):
+            invertGeoTransform((0.0, 1.0, 2.0, 0.0, 2.0, 4.0))
+
+    def test_window(self):
+        for geoTransform in [NORTH_UP, ROTATED]:
+            window = windowGeoTransform(geoTransform, 100, 50)
+            for x, y in [(0, 0), (7, 3), (255, 255)]:
+                self.assertValuesEqual(applyGeoTransform(window, x, y),
+                                       applyGeoTransform(geoTransform, 100 + x, 50 + y))
+
+    def test_window_resampled(self):
+        # a 512 pixel window written as a 256 pixel tile
+        for geoTransform in [NORTH_UP, ROTATED]:
+            window = windowGeoTransform(geoTransform, 100, 50, 2.0, 2.0)
+            for x, y in [(0, 0), (7, 3), (255, 255)]:
+                self.assertValuesEqual(applyGeoTransform(window, x, y),
+                                       applyGeoTransform(geoTransform, 100 + 2 * x, 50 + 2 * y))
+
+
+class SidecarTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_world_file(self):
+        imgPath = os.path.join(self.folder, '000001.jpg')
+        writeSidecars(imgPath, ROTATED)
+        worldPath = os.path.join(self.folder, '000001.jgw')
+        with open(worldPath, 'r') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 6)
+        for line, value in zip(lines, worldFileValues(ROTATED)):
+            self.assertEqual(float(line), value)
+        self.assertEqual(readWorldFile(worldPath), worldFileValues(ROTATED))
+        self.assertFalse(os.path.exists(imgPath + '.aux.xml'))
+
+    def test_world_file_path(self):
+        imgPath = os.path.join(self.folder, '000001.png')
+        worldPath = os.path.join(self.folder, 'other.pgw')
+        writeSidecars(imgPath, NORTH_UP, worldPath=worldPath)
+        self.assertTrue(os.path.exists(worldPath))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, '000001.pgw')))
+
+    def test_aux_xml(self):
+        imgPath = os.path.join(self.folder, '000001.tif')
+        projection = 'PROJCS["WGS_1984_UTM_Zone_50N",GEOGCS["GCS_WGS_1984"],UNIT["Meter",1.0]]'
+        writeSidecars(imgPath, ROTATED, projection)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, '000001.tfw')))
+        with open(imgPath + '.aux.xml', 'r') as f:
+            content = f.read()
+        self.assertIn('<PAMDataset>', content)
+        self.assertIn('<SRS>{}</SRS>'.format(projection), content)
+        start = content.index('<GeoTransform>') + len('<GeoTransform>')
+        values = content[start:content.index('</GeoTransform>')].split(',')
+        self.assertEqual([float(v) for v in values], list(ROTATED))
+
+    def test_aux_xml_escaped(self):
+        imgPath = os.path.join(self.folder, '000001.tif')
+        writeSidecars(imgPath, NORTH_UP, 'LOCAL_CS["a<b&c"]')
+        with open(imgPath + '.aux.xml', 'r') as f:
+            self.assertIn('<SRS>LOCAL_CS["a&lt;b&amp;c"]</SRS>', f.read())
+
+    def test_remove(self):
+        imgPath = os.path.join(self.folder, '000001.png')
+        writeSidecars(imgPath, NORTH_UP, 'LOCAL_CS["a"]')
+        removeSidecars(imgPath)
+        self.assertEqual(os.listdir(self.folder), [])
+        # nothing left to remove is fine
+        removeSidecars(imgPath)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# coding=utf-8
+'''
+tests of the asynchronous output stage
+'''
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from RS_Libs.Writers import AsyncWriter, submitWrite
+
+
+def slowWrite(path, content, delay=0.1):
+    time.sleep(delay)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def appendLine(path, content):
+    with open(path, 'a') as f:
+        f.write(content)
+
+
+class AsyncWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_wait(self):
+        writer = AsyncWriter(2)
+        path = os.path.join(self.folder, '000000.jpg')
+        submitWrite(writer, path, slowWrite, path, 'image')
+        writer.wait(path)
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), 'image')
+        writer.close()
+
+    def test_depends(self):
+        writer = AsyncWriter(2)
+        imgPath = os.path.join(self.folder, '000000.jpg')
+        xmlPath = os.path.join(self.folder, '000000.xml')
+        submitWrite(writer, imgPath, slowWrite, imgPath, 'image')
+        submitWrite(writer, xmlPath, shutil.copyfile, imgPath, xmlPath, depends=[imgPath])
+        writer.close()
+        with open(xmlPath, 'r') as f:
+            self.assertEqual(f.read(), 'image')
+
+    def test_depends_on_own_path(self):
+        # eg. the boxes drawn on a visualization tile which is still being encoded
+        writer = AsyncWriter(2)
+        path = os.path.join(self.folder, '000000.jpg')
+        submitWrite(writer, path, slowWrite, path, 'image')
+        submitWrite(writer, path, appendLine, path, ' boxes', depends=[path])
+        closer = threading.Thread(target=writer.close)
+        closer.daemon = True
+        closer.start()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), 'image boxes')
+
+    def test_error(self):
+        writer = AsyncWriter(1)
+        path = os.path.join(self.folder, 'missing', '000000.jpg')
+        submitWrite(writer, path, slowWrite, path, 'image', 0)
+        writer.wait(path)
+        with self.assertRaises(Exception):
+            writer.raiseError()
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()